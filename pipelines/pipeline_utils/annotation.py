@@ -0,0 +1,188 @@
+'''A local, versioned store of the gene annotations.
+
+The Ensembl to Entrez to gene symbol mappings and the GO and KEGG
+genesets are held in an SQLite database, keyed by species and Ensembl
+release. The store is populated once from the files written by
+R/wgcna_fetch_geneset_annotations.R (run on a machine with internet
+access) and each pipeline run then exports the files that it needs by
+lookup, without network access.
+
+    genes(species, release, ensembl_id, entrez_id, gene_name)
+    genesets(species, release, collection, geneset_id, entrez_id)
+    descriptions(species, release, collection, geneset_id, description)
+'''
+
+import os
+import gzip
+import sqlite3
+import contextlib
+import datetime
+import pandas as pd
+
+from pipeline_utils import enrichment
+
+
+COLLECTIONS = ["GO.BP", "GO.MF", "GO.CC", "KEGG"]
+
+ANNOTATION_FILE = "ensembl.to.entrez.tsv.gz"
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS releases (
+    species TEXT, release TEXT, loaded TEXT,
+    PRIMARY KEY (species, release)) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS genes (
+    species TEXT, release TEXT,
+    ensembl_id TEXT, entrez_id INTEGER, gene_name TEXT);
+
+CREATE INDEX IF NOT EXISTS genes_idx ON genes (species, release);
+
+CREATE TABLE IF NOT EXISTS genesets (
+    species TEXT, release TEXT, collection TEXT,
+    geneset_id TEXT, entrez_id INTEGER);
+
+CREATE INDEX IF NOT EXISTS genesets_idx
+    ON genesets (species, release, collection);
+
+CREATE TABLE IF NOT EXISTS descriptions (
+    species TEXT, release TEXT, collection TEXT,
+    geneset_id TEXT, description TEXT,
+    PRIMARY KEY (species, release, collection, geneset_id)) WITHOUT ROWID;
+'''
+
+
+class AnnotationStore(object):
+    '''An SQLite annotation store'''
+
+    def __init__(self, path):
+
+        self.path = path
+
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with self._connect() as con:
+            con.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        '''A connection that commits (or rolls back) and is closed when
+           the block ends'''
+
+        con = sqlite3.connect(self.path, timeout=600)
+
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def releases(self, species):
+        '''The releases that are held for a species'''
+
+        with self._connect() as con:
+            rows = con.execute("SELECT release FROM releases "
+                               "WHERE species=?", (species,)).fetchall()
+
+        return [x[0] for x in rows]
+
+    def resolve(self, species, release):
+        '''Return the stored release to use, or None if it is not held.
+           "latest" resolves to the most recent release in the store.'''
+
+        held = self.releases(species)
+        release = str(release)
+
+        if release == "latest":
+            numeric = [x for x in held if x.isdigit()]
+            return max(numeric, key=int) if numeric else None
+
+        return release if release in held else None
+
+    def load(self, species, release, annotation_dir):
+        '''Populate the store from an annotation directory (i.e. the
+           ensembl.to.entrez.tsv.gz and GMT files)'''
+
+        release = str(release)
+
+        anno = pd.read_csv(os.path.join(annotation_dir, ANNOTATION_FILE),
+                           sep="\t")
+        anno = anno[["ensembl_id", "entrez_id", "gene_name"]]
+        anno = anno.astype({"entrez_id": "Int64"})
+        anno.insert(0, "release", release)
+        anno.insert(0, "species", species)
+
+        with self._connect() as con:
+
+            for table in ["releases", "genes", "genesets", "descriptions"]:
+                con.execute("DELETE FROM %s WHERE species=? AND release=?"
+                            % table, (species, release))
+
+            con.executemany("INSERT INTO genes VALUES (?,?,?,?,?)",
+                            anno.astype(object)
+                                .where(anno.notna(), None)
+                                .itertuples(index=False, name=None))
+
+            for collection in COLLECTIONS:
+
+                gmt = os.path.join(annotation_dir, collection + ".gmt")
+                if not os.path.exists(gmt):
+                    continue
+
+                genesets = enrichment.read_gmt(gmt)
+
+                con.executemany(
+                    "INSERT INTO descriptions VALUES (?,?,?,?,?)",
+                    ((species, release, collection, x[0], x[1])
+                     for x in genesets))
+
+                con.executemany(
+                    "INSERT INTO genesets VALUES (?,?,?,?,?)",
+                    ((species, release, collection, x[0], int(gene))
+                     for x in genesets for gene in x[2]))
+
+            con.execute("INSERT INTO releases VALUES (?,?,?)",
+                        (species, release,
+                         datetime.datetime.now().isoformat()))
+
+    def export(self, species, release, annotation_dir):
+        '''Write the annotation files for a species and release'''
+
+        os.makedirs(annotation_dir, exist_ok=True)
+
+        with self._connect() as con:
+
+            anno = pd.read_sql_query(
+                "SELECT ensembl_id, entrez_id, gene_name FROM genes "
+                "WHERE species=? AND release=?", con,
+                params=(species, release))
+
+            anno["entrez_id"] = anno["entrez_id"].astype("Int64")
+
+            with gzip.open(os.path.join(annotation_dir, ANNOTATION_FILE),
+                           "wt") as fh:
+                anno.to_csv(fh, sep="\t", index=False)
+
+            for collection in COLLECTIONS:
+
+                sets = pd.read_sql_query(
+                    "SELECT g.geneset_id, d.description, g.entrez_id "
+                    "FROM genesets g JOIN descriptions d "
+                    "ON g.species=d.species AND g.release=d.release "
+                    "AND g.collection=d.collection "
+                    "AND g.geneset_id=d.geneset_id "
+                    "WHERE g.species=? AND g.release=? AND g.collection=?",
+                    con, params=(species, release, collection))
+
+                if len(sets) == 0:
+                    continue
+
+                sets["entrez_id"] = sets["entrez_id"].astype(str)
+                grouped = sets.groupby(["geneset_id", "description"],
+                                       sort=True)["entrez_id"]
+
+                with open(os.path.join(annotation_dir,
+                                       collection + ".gmt"), "w") as fh:
+                    for (geneset_id, description), genes in grouped:
+                        fh.write("\t".join([geneset_id, description]
+                                           + list(genes)) + "\n")
@@ -0,0 +1,95 @@
+'''Comparison of benchmark results with a baseline.
+
+The benchmark (python/wgcna_benchmark.py) writes one row per data set
+scale and pipeline stage:
+
+    n_genes, n_samples, stage, status, wall_time, cpu_time, max_rss,
+    n_modules, ari
+
+(max_rss in bytes; n_modules and ari, the adjusted Rand index of the
+modules found and the planted modules, only for the module detection
+stages). A stage is flagged when, compared to the baseline run of the
+same stage on the same scale:
+
+    failed: it failed (and did not fail in the baseline)
+    time: its wall time grew by more than the tolerance (and min_time)
+    memory: its peak memory grew by more than the tolerance (and min_rss)
+    recovery: the ari fell by more than max_ari_drop, or below min_ari
+'''
+
+import numpy as np
+import pandas as pd
+
+
+KEYS = ["n_genes", "n_samples", "stage"]
+
+COLUMNS = KEYS + ["status", "wall_time", "cpu_time", "max_rss",
+                  "n_modules", "ari"]
+
+
+def compare(results, baseline=None, tolerance=0.25, min_time=1.0,
+            min_rss=50e6, max_ari_drop=0.05, min_ari=0.8):
+    '''Return the results with the baseline values, the ratios and the
+       flags (a comma separated string, empty if the stage is fine)'''
+
+    if baseline is None:
+        baseline = pd.DataFrame(columns=COLUMNS)
+
+    table = results.merge(baseline[COLUMNS], on=KEYS, how="left",
+                          suffixes=("", "_baseline"))
+
+    table["time_ratio"] = table["wall_time"] / table["wall_time_baseline"]
+    table["rss_ratio"] = table["max_rss"] / table["max_rss_baseline"]
+
+    def _flags(row):
+        flags = []
+
+        # a stage that fails in the baseline too is not a regression
+        if row.status != 0 and row.status_baseline != row.status:
+            flags.append("failed")
+
+        if (row.time_ratio > 1 + tolerance
+                and row.wall_time - row.wall_time_baseline > min_time):
+            flags.append("time")
+
+        if (row.rss_ratio > 1 + tolerance
+                and row.max_rss - row.max_rss_baseline > min_rss):
+            flags.append("memory")
+
+        if not np.isnan(row.ari) and (
+                row.ari < min_ari
+                or row.ari < row.ari_baseline - max_ari_drop):
+            flags.append("recovery")
+
+        return ",".join(flags)
+
+    table["flags"] = [_flags(row) for row in table.itertuples()]
+
+    return table
+
+
+def report(table):
+    '''The comparison as text'''
+
+    row_format = "%-24s %7s %7s %6s %10s %10s %7s %10s %7s %6s %8s  %s"
+
+    lines = [row_format % ("stage", "genes", "samples", "status",
+                           "time (s)", "baseline", "ratio", "RSS (GB)",
+                           "ratio", "ari", "baseline", "flags")]
+
+    def _fmt(x, fmt):
+        return "-" if pd.isna(x) else fmt % x
+
+    for row in table.itertuples():
+        lines.append(row_format
+                     % (row.stage, row.n_genes, row.n_samples, row.status,
+                        _fmt(row.wall_time, "%.1f"),
+                        _fmt(row.wall_time_baseline, "%.1f"),
+                        _fmt(row.time_ratio, "%.2f"),
+                        _fmt(row.max_rss / 1e9, "%.2f"),
+                        _fmt(row.rss_ratio, "%.2f"),
+                        _fmt(row.ari, "%.3f"),
+                        _fmt(row.ari_baseline, "%.3f"),
+                        row.flags))
+
+    return "\n".join(lines)
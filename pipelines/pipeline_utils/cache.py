@@ -0,0 +1,257 @@
+'''Parameter-aware, content-addressed caching of pipeline task outputs.
+
+Each task is keyed on a hash of
+(i) the keys of its upstream tasks (stored in their sentinel files),
+(ii) the digests of any raw input files (e.g. the expression data,
+     the scripts that are run) and
+(iii) exactly the PARAMS values that it consumes.
+
+Because a task's key is written into its sentinel, keys chain down
+the pipeline: a task only needs to rerun when something that it
+depends on has actually changed. Outputs are stored in the cache
+directory under their key so that returning to an earlier
+parameterisation restores the results rather than recomputing them.
+The least recently used entries are evicted when the cache grows
+beyond its maximum size.
+'''
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import fnmatch
+
+
+CACHE_VERSION = "1"
+
+
+def parse_size(size):
+    '''Convert e.g. "500M" or "50G" to bytes'''
+
+    size = str(size).strip().upper()
+    units = {"K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12}
+
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+
+    return int(float(size))
+
+
+class TaskCache(object):
+    '''A content-addressed store of task outputs.'''
+
+    def __init__(self, cache_dir, max_size="50G", enabled=True):
+
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = parse_size(max_size)
+        self.enabled = enabled
+
+        self.digest_file = os.path.join(self.cache_dir, "file.digests.json")
+
+    # ---------------------------- keys ---------------------------------- #
+
+    def file_digest(self, path):
+        '''sha256 of a file, memoised on (path, size, mtime)'''
+
+        return file_digest(path, self.digest_file)
+
+    def key(self, task, sentinels=(), params=None, files=()):
+        '''Compute the key of a task from the keys stored in its upstream
+           sentinels, the digests of raw input files and its parameters.'''
+
+        upstream = []
+        for sentinel in sentinels:
+            if sentinel is None:
+                continue
+            upstream.append(read_key(sentinel))
+
+        record = {"version": CACHE_VERSION,
+                  "task": task,
+                  "upstream": upstream,
+                  "files": [self.file_digest(x) for x in files
+                            if x is not None and os.path.isfile(x)],
+                  "params": params or {}}
+
+        blob = json.dumps(record, sort_keys=True, default=str)
+
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    # -------------------------- storage --------------------------------- #
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, out_dir, patterns):
+        '''Restore the outputs stored under key into out_dir.
+
+           Returns True on a cache hit. On a miss the existing outputs
+           matching the patterns are removed so that the task writes
+           fresh files (cached files are hard-linked and must never be
+           modified in place).
+        '''
+
+        outputs = _match(out_dir, patterns)
+
+        if self.enabled:
+            entry = self._entry(key)
+            manifest = os.path.join(entry, "manifest.json")
+
+            if os.path.exists(manifest):
+                with open(manifest) as fh:
+                    names = json.load(fh)
+
+                for path in outputs:
+                    os.remove(path)
+
+                os.makedirs(out_dir, exist_ok=True)
+                for name in names:
+                    _link_or_copy(os.path.join(entry, name),
+                                  os.path.join(out_dir, name))
+
+                # record the use for least-recently-used eviction
+                os.utime(entry)
+                return True
+
+        for path in outputs:
+            os.remove(path)
+
+        return False
+
+    def store(self, key, out_dir, patterns):
+        '''Store the outputs in out_dir that match the patterns'''
+
+        if not self.enabled:
+            return
+
+        entry = self._entry(key)
+        tmp = entry + ".%d.tmp" % os.getpid()
+
+        if os.path.exists(entry):
+            return
+
+        os.makedirs(tmp, exist_ok=True)
+
+        names = []
+        for path in _match(out_dir, patterns):
+            name = os.path.basename(path)
+            _link_or_copy(path, os.path.join(tmp, name))
+            names.append(name)
+
+        with open(os.path.join(tmp, "manifest.json"), "w") as fh:
+            json.dump(names, fh)
+
+        os.replace(tmp, entry)
+
+        self.evict()
+
+    def size(self):
+        '''Return a list of (last used, bytes, entry) for all entries'''
+
+        entries = []
+        for entry in glob.glob(os.path.join(self.cache_dir, "??", "*")):
+            if entry.endswith(".tmp") or not os.path.isdir(entry):
+                continue
+            nbytes = sum(os.path.getsize(os.path.join(entry, x))
+                         for x in os.listdir(entry))
+            entries.append((os.stat(entry).st_mtime, nbytes, entry))
+
+        return entries
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache is
+           smaller than max_size'''
+
+        entries = sorted(self.size())
+        total = sum(x[1] for x in entries)
+
+        while total > self.max_size and len(entries) > 1:
+            _, nbytes, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= nbytes
+
+
+# ------------------------------ helpers --------------------------------- #
+
+def file_digest(path, memo_file):
+    '''sha256 of a file. The digests are memoised in memo_file on
+       (path, size, modification time) so that large files are only
+       read when they change.'''
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    memo_key = "%s:%d:%d" % (path, stat.st_size, stat.st_mtime_ns)
+
+    digests = {}
+    if os.path.exists(memo_file):
+        with open(memo_file) as fh:
+            digests = json.load(fh)
+
+    if memo_key not in digests:
+        sha = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 24), b""):
+                sha.update(chunk)
+
+        digests[memo_key] = sha.hexdigest()
+
+        os.makedirs(os.path.dirname(memo_file), exist_ok=True)
+        tmp = memo_file + ".%d.tmp" % os.getpid()
+        with open(tmp, "w") as fh:
+            json.dump(digests, fh)
+        os.replace(tmp, memo_file)
+
+    return digests[memo_key]
+
+
+def _match(out_dir, patterns):
+    '''Files in out_dir that match the patterns (sentinels excluded)'''
+
+    if not os.path.exists(out_dir):
+        return []
+
+    return sorted(os.path.join(out_dir, x) for x in os.listdir(out_dir)
+                  if any(fnmatch.fnmatch(x, p) for p in patterns)
+                  and not x.endswith(".sentinel")
+                  and os.path.isfile(os.path.join(out_dir, x)))
+
+
+def _link_or_copy(source, target):
+    '''Hard-link source to target, copying across file systems'''
+
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def read_key(sentinel):
+    '''Read the key stored in a sentinel file. Sentinels written before
+       caching was introduced are empty, in which case their path and
+       modification time are used.'''
+
+    with open(sentinel) as fh:
+        key = fh.read().strip()
+
+    if key == "":
+        key = "%s:%d" % (os.path.abspath(sentinel),
+                         os.stat(sentinel).st_mtime_ns)
+
+    return key
+
+
+def write_key(sentinel, key):
+    '''Write the key of a completed task into its sentinel'''
+
+    with open(sentinel, "w") as fh:
+        fh.write(key + "\n")
+
+
+def is_current(sentinel, key):
+    '''True if the sentinel exists and records the given key'''
+
+    if not os.path.exists(sentinel):
+        return False
+
+    with open(sentinel) as fh:
+        return fh.read().strip() == key
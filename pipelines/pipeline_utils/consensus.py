@@ -0,0 +1,135 @@
+'''Consensus networks across several expression data sets.
+
+The additional data sets are given in the consensus section of the
+pipeline.yml as "set_<name>: <path>". Each set is cleaned on its own and
+the input expression data (the "reference" set) is restricted to the
+genes that are present in all of the sets. The TOM of each set is then
+computed over these genes, in the order of the reference, and the
+consensus TOM is an elementwise quantile (by default the minimum) of the
+set TOMs.
+
+As in WGCNA's consensus analysis, the set TOMs can first be calibrated
+("single_quantile"): each TOM is raised to the power that brings its
+calibration quantile to that of the TOM of a reference set (by default
+the input expression data), so that a set with generally stronger
+correlations does not dominate the consensus.
+
+The consensus is computed from the memory-mapped set dissTOMs a tile of
+rows at a time. The number of rows per tile is divided by the number of
+sets so that the memory used does not grow with the number of sets.
+'''
+
+import numpy as np
+
+from pipeline_utils import network
+
+
+SET_PREFIX = "consensus_set_"
+
+REFERENCE = "reference"
+
+CALIBRATIONS = ["none", "single_quantile"]
+
+
+def data_sets(params):
+    '''The (name, path) of the additional data sets, sorted by name'''
+
+    sets = sorted((x[len(SET_PREFIX):], params[x]) for x in params.keys()
+                  if x.startswith(SET_PREFIX) and params[x] is not None)
+
+    if REFERENCE in [name for name, _ in sets]:
+        raise ValueError('"%s" is reserved for the input expression data'
+                         % REFERENCE)
+
+    return sets
+
+
+def is_active(params):
+    '''True if any additional data set has been given'''
+
+    return len(data_sets(params)) > 0
+
+
+def common_genes(gene_lists):
+    '''The genes present in all of the lists, in the order of the first'''
+
+    shared = set(gene_lists[0])
+    for genes in gene_lists[1:]:
+        shared &= set(genes)
+
+    return [x for x in gene_lists[0] if x in shared]
+
+
+def calibration_powers(diss_toms, quantile=0.95, reference=0,
+                       n_values=1000000, seed=1):
+    '''The powers that scale the TOM of each set so that its quantile
+       matches that of the set diss_toms[reference].
+
+       The quantiles are estimated from the off-diagonal values of a
+       random sample of (whole) rows of each dissTOM, which are read
+       sequentially from the memory-mapped files.
+    '''
+
+    n = diss_toms[0].shape[0]
+
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(n, size=min(n, max(1, n_values // n)),
+                              replace=False))
+
+    off_diagonal = np.ones((len(rows), n), dtype=bool)
+    off_diagonal[np.arange(len(rows)), rows] = False
+
+    quantiles = np.array([np.quantile(1 - np.asarray(x[rows])[off_diagonal],
+                                      quantile)
+                          for x in diss_toms])
+
+    powers = np.ones(len(diss_toms))
+
+    # a set whose quantile is 0 or 1 cannot be rescaled by a power
+    scalable = (quantiles > 0) & (quantiles < 1)
+
+    if scalable[reference]:
+        powers[scalable] = (np.log(quantiles[reference])
+                            / np.log(quantiles[scalable]))
+
+    return powers, quantiles
+
+
+def consensus_diss_tom(diss_toms, out, quantile=0.0, powers=None,
+                       tile_size=2000, threads=1):
+    '''Fill the n x n array "out" with 1 - the elementwise quantile of
+       the (calibrated) TOMs of the sets, given as (memory-mapped)
+       dissTOMs. A quantile of 0 gives the minimum.'''
+
+    n_sets = len(diss_toms)
+    n = diss_toms[0].shape[0]
+
+    if powers is None:
+        powers = np.ones(n_sets)
+
+    rows_per_tile = max(1, tile_size // n_sets)
+
+    def _fill(tile):
+        start, end = tile
+
+        tom = np.empty((n_sets, end - start, n))
+
+        for i, diss_tom in enumerate(diss_toms):
+            np.subtract(1, diss_tom[start:end], out=tom[i])
+
+            if powers[i] != 1:
+                np.power(tom[i], powers[i], out=tom[i])
+
+        if quantile == 0:
+            consensus = tom.min(axis=0)
+        else:
+            consensus = np.quantile(tom, quantile, axis=0)
+
+        np.subtract(1, consensus, out=consensus)
+        consensus[np.arange(end - start), np.arange(start, end)] = 0
+
+        out[start:end] = consensus
+
+    network.map_tiles(_fill, network.tiles(n, rows_per_tile), threads)
+
+    return out
@@ -0,0 +1,195 @@
+'''Rasterised rendering of gene dendrograms and module colour bars.
+
+The tree (in R's hclust format, as written by python/wgcna_cut_tree.py
+or R/wgcna_detect_modules.R) is drawn straight into an RGB image with
+numpy: every merge is a horizontal segment joining two vertical
+segments, and the segments of all of the merges are rasterised at once
+by accumulating their end points in difference arrays. Only the
+max_merges highest merges are drawn; the branches below them are
+collapsed into single stubs, which at the width of an image would not
+show anyway. The cost is therefore bounded by the size of the image and
+the number of merges drawn, whatever the number of genes, and the
+output is a PNG of a fixed size rather than a vector PDF with one
+segment per gene.
+
+The colour bars (one "#RRGGBB" colour per gene) are drawn below the
+tree with the genes in the order of the leaves. They are not labelled
+in the image (there is no text rendering), so the report captions say
+which bar is which. Light grey lines mark
+the heights 0.1, 0.2, ... of the tree.
+'''
+
+import struct
+import zlib
+import numpy as np
+
+
+# the size (pixels) of the parts of the image
+WIDTH = 3600
+TREE_HEIGHT = 2000
+BAR_HEIGHT = 160
+MARGIN = 60
+GAP = 20
+LINE_WIDTH = 2
+
+BLACK = (0, 0, 0)
+GRID = (220, 220, 220)
+
+
+def layout(merge, order):
+    '''The x positions (in leaf order) of the leaves and of the merges of
+       an hclust tree (merge: 1-based, negative for leaves)'''
+
+    n = len(order)
+
+    leaf_x = np.empty(n)
+    leaf_x[np.asarray(order, dtype=np.int64) - 1] = np.arange(n)
+
+    node_x = np.empty(len(merge))
+
+    for i, (a, b) in enumerate(merge):
+        xa = leaf_x[-a - 1] if a < 0 else node_x[a - 1]
+        xb = leaf_x[-b - 1] if b < 0 else node_x[b - 1]
+        node_x[i] = (xa + xb) / 2
+
+    return leaf_x, node_x
+
+
+def segments(merge, height, order, max_merges=20000, hang=0.03):
+    '''The vertical (x, bottom, top) and horizontal (x0, x1, y) segments
+       of the tree, drawing only the max_merges highest merges. Leaves
+       and collapsed branches hang below the merge that they join.'''
+
+    merge = np.asarray(merge, dtype=np.int64)
+    height = np.asarray(height, dtype=np.float64)
+
+    leaf_x, node_x = layout(merge, order)
+
+    cut = -np.inf
+    if len(height) > max_merges:
+        cut = np.sort(height)[-max_merges]
+
+    drawn = np.flatnonzero(height >= cut)
+    top = height[drawn]
+
+    hang = hang * (height.max() - height.min())
+
+    xs, bottoms = [], []
+
+    for side in [0, 1]:
+        child = merge[drawn, side]
+        is_merge = child > 0
+
+        x = np.empty(len(child))
+        x[is_merge] = node_x[child[is_merge] - 1]
+        x[~is_merge] = leaf_x[-child[~is_merge] - 1]
+
+        bottom = top - hang
+        shown = is_merge.copy()
+        shown[is_merge] = height[child[is_merge] - 1] >= cut
+        bottom[shown] = height[child[shown] - 1]
+
+        xs.append(x)
+        bottoms.append(bottom)
+
+    verticals = (np.concatenate(xs), np.concatenate(bottoms),
+                 np.concatenate([top, top]))
+    horizontals = (np.minimum(xs[0], xs[1]), np.maximum(xs[0], xs[1]), top)
+
+    return verticals, horizontals
+
+
+def hex_to_rgb(colors):
+    '''Convert "#RRGGBB" strings to an (n x 3) uint8 array'''
+
+    levels, codes = np.unique(np.asarray(colors, dtype=str),
+                              return_inverse=True)
+
+    rgb = np.array([[int(x[i:i + 2], 16) for i in (1, 3, 5)]
+                    for x in levels], dtype=np.uint8)
+
+    return rgb[codes.ravel()]
+
+
+def render(merge, height, order, bars=(), max_merges=20000, hang=0.03,
+           width=WIDTH):
+    '''Draw the tree with a colour bar for each of bars (arrays of the
+       "#RRGGBB" colour of each gene, in the order of the genes).
+       Returns the (rows x columns x 3) uint8 image.'''
+
+    order = np.asarray(order, dtype=np.int64)
+    n = len(order)
+
+    (vx, bottom, top), (hx0, hx1, hy) = segments(merge, height, order,
+                                                 max_merges, hang)
+
+    plot_width = width - 2 * MARGIN
+    rows = 2 * MARGIN + TREE_HEIGHT + len(bars) * (GAP + BAR_HEIGHT)
+
+    ymin, ymax = bottom.min(), top.max()
+
+    def _col(x):
+        c = MARGIN + np.floor((x + 0.5) / n * plot_width).astype(np.int64)
+        return np.clip(c, MARGIN, MARGIN + plot_width - LINE_WIDTH)
+
+    def _row(y):
+        r = np.round((ymax - y) / (ymax - ymin) * (TREE_HEIGHT - LINE_WIDTH))
+        return MARGIN + r.astype(np.int64)
+
+    image = np.full((rows, width, 3), 255, dtype=np.uint8)
+
+    for level in np.arange(np.ceil(ymin * 10), np.floor(ymax * 10) + 1):
+        image[_row(np.array([level / 10]))[0],
+              MARGIN:MARGIN + plot_width] = GRID
+
+    # each segment adds 1 at its start and -1 after its end, so that the
+    # cumulative sum along the segments covers them
+    vertical = np.zeros((rows + 1, width), dtype=np.int32)
+    horizontal = np.zeros((rows, width + 1), dtype=np.int32)
+
+    for offset in range(LINE_WIDTH):
+        np.add.at(vertical, (_row(top), _col(vx) + offset), 1)
+        np.add.at(vertical, (_row(bottom) + 1, _col(vx) + offset), -1)
+
+        np.add.at(horizontal, (_row(hy) + offset, _col(hx0)), 1)
+        np.add.at(horizontal, (_row(hy) + offset,
+                               _col(hx1) + LINE_WIDTH), -1)
+
+    covered = np.cumsum(vertical, axis=0)[:rows] > 0
+    covered |= np.cumsum(horizontal, axis=1)[:, :width] > 0
+
+    image[covered] = BLACK
+
+    # the gene at the centre of each column of pixels
+    genes = order[np.floor((np.arange(plot_width) + 0.5)
+                           * n / plot_width).astype(np.int64)] - 1
+
+    for i, colors in enumerate(bars):
+        start = MARGIN + TREE_HEIGHT + GAP + i * (GAP + BAR_HEIGHT)
+
+        image[start:start + BAR_HEIGHT,
+              MARGIN:MARGIN + plot_width] = hex_to_rgb(
+                  np.asarray(colors)[genes])[None]
+
+    return image
+
+
+def write_png(path, image):
+    '''Write an (rows x columns x 3) uint8 image as a PNG file'''
+
+    rows, columns, _ = image.shape
+
+    # each scanline starts with its filter type (0: none)
+    raw = np.zeros((rows, columns * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(rows, columns * 3)
+
+    def _chunk(tag, data):
+        return (struct.pack(">I", len(data)) + tag + data
+                + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+    with open(path, "wb") as fh:
+        fh.write(b"\x89PNG\r\n\x1a\n")
+        fh.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", columns, rows,
+                                             8, 2, 0, 0, 0)))
+        fh.write(_chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        fh.write(_chunk(b"IEND", b""))
@@ -0,0 +1,254 @@
+'''Module eigengenes and the merging of close modules.
+
+The eigengene of a module is the first principal component of the
+scaled expression of its genes (as WGCNA::moduleEigengenes, aligned
+along the average expression). Each module is reduced once to a small
+factor B = U S (samples x rank) of its scaled expression X, computed
+from the samples x samples cross-product of X so that the work is a
+single matrix product per module. Because
+
+    [X_a X_b] [X_a X_b]^T = B_a B_a^T + B_b B_b^T
+
+the factor of two merged modules is obtained from the factors of the
+modules alone (exactly if the rank is not truncated), so that during
+the merging of close modules (as WGCNA::mergeCloseModules) only the
+eigengenes of the modules that were merged are recomputed.
+
+Missing values are imputed by the mean of the gene (WGCNA uses
+impute.knn within each module).
+'''
+
+from collections import namedtuple
+import numpy as np
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.spatial.distance import squareform
+
+from pipeline_utils import network
+
+
+# factor: the (samples x rank) B = U S of the scaled module expression,
+# sums: the sum of the scaled expression of the genes in each sample
+Factor = namedtuple("Factor", ["factor", "sums", "n_genes"])
+
+
+def scaling(x):
+    '''The mean and standard deviation of the columns of x (samples x
+       genes), ignoring missing values. Zero deviations are set to 1.'''
+
+    x = np.asarray(x, dtype=np.float64)
+
+    mean = np.nanmean(x, axis=0)
+
+    n = np.sum(~np.isnan(x), axis=0)
+    sd = np.sqrt(np.nansum((x - mean) ** 2, axis=0) / (n - 1))
+    sd[~(sd > 0)] = 1
+
+    return mean, sd
+
+
+def _scale(x, mean=None, sd=None):
+    '''centre and scale the columns of x (samples x genes) in place, as
+       R's scale(), with missing values set to the mean'''
+
+    if mean is None:
+        mean, sd = scaling(x)
+
+    x -= mean
+    x /= sd
+    np.nan_to_num(x, copy=False, nan=0.0)
+
+    return x
+
+
+def _truncate(u, s, rank):
+    '''The factor U S of the leading "rank" components (all if None)'''
+
+    keep = s > (s.max() * 1e-12 if len(s) > 0 else 0)
+
+    if rank is not None:
+        keep[rank:] = False
+
+    return u[:, keep] * s[keep]
+
+
+def _eig_factor(gram, rank=None):
+    '''The factor B (B B^T = gram) of a symmetric positive semi-definite
+       matrix'''
+
+    values, vectors = np.linalg.eigh(gram)
+
+    values, vectors = values[::-1], vectors[:, ::-1]
+
+    return _truncate(vectors, np.sqrt(np.clip(values, 0, None)), rank)
+
+
+def decompose(x, rank=None):
+    '''Reduce the (scaled) expression x (samples x genes) of a module to
+       its Factor'''
+
+    x = np.asarray(x, dtype=np.float64)
+
+    if x.shape[1] > x.shape[0]:
+        factor = _eig_factor(x @ x.T, rank)
+    else:
+        u, s, _ = np.linalg.svd(x, full_matrices=False)
+        factor = _truncate(u, s, rank)
+
+    return Factor(factor, x.sum(axis=1), x.shape[1])
+
+
+def merge(factors, rank=None):
+    '''The Factor of the union of several modules'''
+
+    stacked = np.hstack([f.factor for f in factors])
+
+    u, s, _ = np.linalg.svd(stacked, full_matrices=False)
+
+    return Factor(_truncate(u, s, rank),
+                  np.sum([f.sums for f in factors], axis=0),
+                  sum(f.n_genes for f in factors))
+
+
+def eigengene(f):
+    '''The eigengene (unit length) of a module from its Factor, with the
+       sign chosen to correlate positively with the average expression'''
+
+    if f.factor.shape[1] == 0:
+        return np.zeros(len(f.sums))
+
+    u, _, _ = np.linalg.svd(f.factor, full_matrices=False)
+
+    pc = u[:, 0]
+
+    # the columns of the scaled expression are centred, so is pc
+    if np.dot(pc, f.sums) < 0:
+        pc = -pc
+
+    return pc
+
+
+def module_factors(datExpr, colors, rank=None, threads=1):
+    '''Return a dict of the Factors of each module. datExpr is samples x
+       genes, colors gives the module of each gene.'''
+
+    colors = np.asarray(colors)
+    modules = np.unique(colors)
+
+    factors = {}
+
+    def _decompose(module):
+        genes = np.flatnonzero(colors == module)
+        x = np.array(datExpr[:, genes], dtype=np.float64)
+        factors[module] = decompose(_scale(x), rank)
+
+    network.map_tiles(_decompose, list(modules), threads)
+
+    return factors
+
+
+def eigengene_matrix(factors, modules):
+    '''The (samples x modules) matrix of the eigengenes of the modules'''
+
+    return np.column_stack([eigengene(factors[m]) for m in modules])
+
+
+def _diss(MEs, cor_fnc):
+    '''1 - the correlation of the eigengenes'''
+
+    z = network.standardise(MEs, cor_fnc)
+
+    return 1 - np.clip(network.correlation_rows(z, (0, z.shape[0])), -1, 1)
+
+
+def merge_close_modules(factors, colors, cut_height=0.25,
+                        cor_fnc="pearson", unassigned="grey", rank=None):
+    '''Merge the modules whose eigengenes are closer than cut_height
+       (1 - correlation, average linkage) until no more are merged.
+
+       The modules on each branch are merged into the first of them (in
+       alphabetical order), as WGCNA::mergeCloseModules. The unassigned
+       genes are not merged. Returns the merged colors and a dict of
+       the Factors of the merged modules; factors is not modified.
+    '''
+
+    colors = np.array(colors, copy=True)
+    factors = dict(factors)
+
+    cache = {}
+
+    while True:
+
+        modules = sorted(m for m in factors if m != unassigned)
+
+        if len(modules) < 2:
+            break
+
+        for m in modules:
+            if m not in cache:
+                cache[m] = eigengene(factors[m])
+
+        diss = _diss(np.column_stack([cache[m] for m in modules]), cor_fnc)
+        np.fill_diagonal(diss, 0)
+
+        Z = linkage(squareform(diss, checks=False), method="average")
+        branches = fcluster(Z, t=cut_height, criterion="distance")
+
+        merged = False
+
+        for branch in np.unique(branches):
+
+            members = [m for m, b in zip(modules, branches) if b == branch]
+
+            if len(members) < 2:
+                continue
+
+            target = members[0]
+
+            factors[target] = merge([factors[m] for m in members], rank)
+            cache.pop(target)
+
+            for m in members[1:]:
+                colors[colors == m] = target
+                del factors[m]
+                del cache[m]
+
+            merged = True
+
+        if not merged:
+            break
+
+    return colors, factors
+
+
+def loadings(datExpr, colors, modules, threads=1):
+    '''Return the gene scaling (mean, sd) and the (genes x modules)
+       loadings that project scaled expression onto the eigengenes.
+
+       The eigengene u of a module with scaled expression X and leading
+       singular value s is X v / s, so the loadings of its genes are
+       v / s = X^T u / s^2 (and zero for the genes of other modules).
+       Projecting the samples that the modules were built from gives
+       back their eigengenes.
+    '''
+
+    colors = np.asarray(colors)
+
+    mean, sd = scaling(datExpr)
+
+    weights = np.zeros((len(colors), len(modules)))
+
+    def _loadings(column):
+        genes = np.flatnonzero(colors == modules[column])
+        x = _scale(np.array(datExpr[:, genes], dtype=np.float64),
+                   mean[genes], sd[genes])
+
+        u = eigengene(decompose(x))
+        w = x.T @ u
+
+        s2 = np.dot(w, w)
+        if s2 > 0:
+            weights[genes, column] = w / s2
+
+    network.map_tiles(_loadings, list(range(len(modules))), threads)
+
+    return mean, sd, weights
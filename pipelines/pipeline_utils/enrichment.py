@@ -0,0 +1,184 @@
+'''Batched geneset over-representation analysis.
+
+The foreground gene sets (e.g. the modules) and the genesets are held
+as sparse incidence matrices over the genes of the universe so that the
+overlaps between every foreground and every geneset are obtained from
+a single sparse matrix product. The one-sided hypergeometric (Fisher
+exact) p-values are then computed for all of the overlaps at once.
+
+The result tables follow the format of the gsfisher package.
+'''
+
+import gzip
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.stats import hypergeom
+
+
+def read_gmt(path):
+    '''Read a GMT file. Returns a list of (id, description, genes)'''
+
+    genesets = []
+
+    opener = gzip.open if path.endswith(".gz") else open
+
+    with opener(path, "rt") as fh:
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 3:
+                continue
+            genesets.append((fields[0], fields[1],
+                             [x for x in fields[2:] if x != ""]))
+
+    return genesets
+
+
+def incidence(members, genes):
+    '''Build a sparse (sets x genes) 0/1 incidence matrix.
+
+       members is a list of gene lists, genes is the ordered list of the
+       universe. Genes that are not in the universe are ignored.
+    '''
+
+    gene_index = {gene: i for i, gene in enumerate(genes)}
+
+    rows, cols = [], []
+    for i, set_genes in enumerate(members):
+        idx = {gene_index[x] for x in set_genes if x in gene_index}
+        rows += [i] * len(idx)
+        cols += list(idx)
+
+    return sp.csr_matrix((np.ones(len(rows), dtype=np.int32),
+                          (rows, cols)),
+                         shape=(len(members), len(genes)))
+
+
+def test(foreground, genesets):
+    '''Test every foreground for over-representation of every geneset.
+
+       foreground: sparse (n_foregrounds x n_genes) incidence matrix
+       genesets: sparse (n_genesets x n_genes) incidence matrix
+
+       Returns the overlap counts, the total foreground sizes, the
+       geneset sizes within the universe, the enrichment ratios and the
+       p-values. The matrices are (n_foregrounds x n_genesets).
+    '''
+
+    n_fg = np.asarray((foreground @ genesets.T).todense())
+
+    total_n_fg = np.asarray(foreground.sum(axis=1)).ravel()
+    n_bg = np.asarray(genesets.sum(axis=1)).ravel()
+    total_n_bg = genesets.shape[1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        odds_ratio = (n_fg / total_n_fg[:, None]) / (n_bg / total_n_bg)[None, :]
+
+    # P(X >= n_fg) for X ~ hypergeometric
+    p_val = hypergeom.sf(n_fg - 1, total_n_bg,
+                         n_bg[None, :], total_n_fg[:, None])
+
+    return n_fg, total_n_fg, n_bg, odds_ratio, np.clip(p_val, 0, 1)
+
+
+def overlap_genes(fg_row, genesets, genes):
+    '''Return the (comma separated) foreground genes in each geneset'''
+
+    hits = genesets.multiply(fg_row).tocsr()
+    genes = np.asarray(genes)
+
+    return [",".join(genes[hits.indices[hits.indptr[i]:hits.indptr[i + 1]]])
+            for i in range(hits.shape[0])]
+
+
+def result_tables(foreground, foreground_names, genesets, ids,
+                  descriptions, genes):
+    '''Yield (foreground name, results table) for every foreground.
+
+       Only genesets that overlap the universe are reported.
+    '''
+
+    n_fg, total_n_fg, n_bg, odds_ratio, p_val = test(foreground, genesets)
+
+    in_universe = n_bg > 0
+    genesets = genesets[in_universe]
+    ids = np.asarray(ids)[in_universe]
+    descriptions = np.asarray(descriptions)[in_universe]
+
+    for i, name in enumerate(foreground_names):
+
+        table = pd.DataFrame(
+            {"geneset_id": ids,
+             "description": descriptions,
+             "p.val": p_val[i, in_universe],
+             "odds.ratio": odds_ratio[i, in_universe],
+             "n_fg": n_fg[i, in_universe],
+             "n_bg": n_bg[in_universe],
+             "total_n_fg": total_n_fg[i],
+             "total_n_bg": foreground.shape[1],
+             "genes": overlap_genes(foreground[i], genesets, genes)})
+
+        yield name, table.sort_values("p.val", kind="stable")
+
+
+def p_adjust(p, method="BH"):
+    '''Adjust p-values for multiple testing (as R's p.adjust)'''
+
+    p = np.asarray(p, dtype=float)
+    n = len(p)
+
+    if n == 0 or method == "none":
+        return p.copy()
+
+    if method == "bonferroni":
+        return np.minimum(p * n, 1)
+
+    if method == "holm":
+        order = np.argsort(p, kind="stable")
+        adjusted = np.maximum.accumulate((n - np.arange(n)) * p[order])
+
+    elif method in ("BH", "fdr", "BY"):
+        order = np.argsort(p, kind="stable")[::-1]
+        rank = np.arange(n, 0, -1)
+        factor = np.sum(1.0 / np.arange(1, n + 1)) if method == "BY" else 1
+        adjusted = np.minimum.accumulate(factor * n / rank * p[order])
+
+    else:
+        raise ValueError("p-value adjustment method not supported: "
+                         + method)
+
+    result = np.empty(n)
+    result[order] = np.minimum(adjusted, 1)
+
+    return result
+
+
+def filter_genesets(results, min_foreground_genes=2, max_genes_geneset=500,
+                    min_odds_ratio=1.5, padjust_method="BH",
+                    use_adjusted_pvalues=True, pvalue_threshold=0.05):
+    '''Select the significantly enriched genesets (as gsfisher's
+       filterGenesets).
+
+       The genesets that pass the size and odds ratio filters are
+       corrected for multiple testing together (i.e. across all of the
+       modules) and the p-value threshold is applied. Returns a copy of
+       results with the adjusted p-values in a p.adj column, which is
+       NaN for the genesets that were not selected.
+    '''
+
+    results = results.copy()
+
+    keep = ((results["n_fg"] >= min_foreground_genes)
+            & (results["n_bg"] <= max_genes_geneset)
+            & (results["odds.ratio"] >= min_odds_ratio)).values.copy()
+
+    p_adj = np.full(len(results), np.nan)
+    p_adj[keep] = p_adjust(results["p.val"].values[keep], padjust_method)
+
+    p = p_adj if use_adjusted_pvalues else results["p.val"].values
+    keep &= p < pvalue_threshold
+
+    p_adj[~keep] = np.nan
+    results["p.adj"] = p_adj
+
+    return results
@@ -0,0 +1,138 @@
+'''Pre-compiled binary indexes of geneset collections.
+
+A GMT file is compiled once into a sparse (genesets x genes) incidence
+matrix which is saved, together with the gene, geneset id and
+description maps, as an uncompressed .npz file. The index is named by
+the sha256 of the GMT file and the index format version so that it can
+be shared between runs and projects (see the genesets_index_dir
+parameter): the GMT text only needs to be parsed again if the file
+changes.
+
+    <index_dir>/<sha256>.v<INDEX_VERSION>.npz
+'''
+
+import os
+import numpy as np
+import scipy.sparse as sp
+
+from pipeline_utils import cache
+from pipeline_utils import enrichment
+
+
+INDEX_VERSION = "1"
+
+
+class GenesetIndex(object):
+    '''A compiled geneset collection'''
+
+    def __init__(self, matrix, genes, ids, descriptions):
+
+        self.matrix = matrix
+        self.genes = genes
+        self.ids = ids
+        self.descriptions = descriptions
+
+    def incidence(self, universe):
+        '''Return the sparse (genesets x universe) incidence matrix.
+
+           Genes of the universe that are not in any geneset have empty
+           columns.
+        '''
+
+        universe = np.asarray(universe, dtype=str)
+
+        # an empty collection (e.g. an empty GMT file)
+        if len(self.genes) == 0:
+            return sp.csr_matrix((self.matrix.shape[0], len(universe)),
+                                 dtype=self.matrix.dtype)
+
+        pos = np.searchsorted(self.genes, universe)
+        pos = np.clip(pos, 0, len(self.genes) - 1)
+        found = self.genes[pos] == universe
+
+        select = sp.csr_matrix((np.ones(found.sum(), dtype=np.int32),
+                                (pos[found], np.flatnonzero(found))),
+                               shape=(len(self.genes), len(universe)))
+
+        return (self.matrix @ select).tocsr()
+
+
+def compile_gmt(gmt_file):
+    '''Parse a GMT file into a GenesetIndex'''
+
+    genesets = enrichment.read_gmt(gmt_file)
+
+    genes = np.unique(np.array([g for x in genesets for g in x[2]] or [""],
+                               dtype=str))
+    genes = genes[genes != ""]
+
+    matrix = enrichment.incidence([x[2] for x in genesets], genes)
+    matrix.data[:] = 1
+
+    return GenesetIndex(matrix, genes,
+                        np.array([x[0] for x in genesets], dtype=str),
+                        np.array([x[1] for x in genesets], dtype=str))
+
+
+def index_path(gmt_file, index_dir):
+    '''The location of the index of a GMT file'''
+
+    digest = cache.file_digest(gmt_file,
+                               os.path.join(index_dir, "gmt.digests.json"))
+
+    return os.path.join(index_dir,
+                        "%s.v%s.npz" % (digest, INDEX_VERSION))
+
+
+def save(index, path):
+    '''Write an index (atomically, as indexes may be shared)'''
+
+    tmp = path[:-len(".npz")] + ".%d.tmp.npz" % os.getpid()
+
+    np.savez(tmp,
+             indptr=index.matrix.indptr,
+             indices=index.matrix.indices,
+             shape=np.array(index.matrix.shape),
+             genes=index.genes,
+             ids=index.ids,
+             descriptions=index.descriptions)
+
+    os.replace(tmp, path)
+
+
+def read(path):
+    '''Open a saved index'''
+
+    with np.load(path) as npz:
+
+        indices = npz["indices"]
+        matrix = sp.csr_matrix((np.ones(len(indices), dtype=np.int32),
+                                indices, npz["indptr"]),
+                               shape=tuple(npz["shape"]))
+
+        return GenesetIndex(matrix, npz["genes"], npz["ids"],
+                            npz["descriptions"])
+
+
+def build(gmt_file, index_dir):
+    '''Compile a GMT file into the index directory (if it is not
+       already there). Returns the path of the index.'''
+
+    os.makedirs(index_dir, exist_ok=True)
+
+    path = index_path(gmt_file, index_dir)
+
+    if not os.path.exists(path):
+        save(compile_gmt(gmt_file), path)
+
+    return path
+
+
+def load(gmt_file, index_dir=None):
+    '''Load the index of a GMT file, compiling it if necessary.
+       Without an index directory the GMT file is parsed directly.'''
+
+    if index_dir is None:
+        return compile_gmt(gmt_file)
+
+    return read(build(gmt_file, index_dir))
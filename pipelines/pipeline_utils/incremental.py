@@ -0,0 +1,213 @@
+'''Incremental update of the correlation matrix as samples are added.
+
+The Pearson correlation of the genes is kept as its sufficient
+statistics in a state directory:
+
+    crossprod.npy: the (genes x genes) cross-product X^T X
+    sums.npy: the sum of each gene over the samples
+    shift.npy: a per-gene shift subtracted from X (for precision)
+    datExpr.npy: the (samples x genes) data that has been folded in
+    state.json: the number of samples and the status of the state
+
+(the sums of squares being the diagonal of the cross-product). When
+samples are added to (or removed from, or changed in) the cleaned data
+the statistics are updated with a rank-k update of the cross-product,
+k being the number of samples that changed, rather than recomputed
+from all of the samples. The correlation (and adjacency) is then read
+off the statistics one tile of rows at a time.
+
+Only complete data (no missing values) and Pearson correlation can be
+updated in this way.
+'''
+
+import os
+import json
+import numpy as np
+
+from pipeline_utils import matrixio
+from pipeline_utils import network
+
+
+class CorrelationStats(object):
+    '''The sufficient statistics of the Pearson correlation of the genes,
+       stored in state_dir'''
+
+    def __init__(self, state_dir):
+
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def _read_state(self):
+
+        if not os.path.exists(self._path("state.json")):
+            return None
+
+        with open(self._path("state.json")) as fh:
+            return json.load(fh)
+
+    def _write_state(self, n_samples, status):
+
+        tmp = self._path("state.json.%d.tmp" % os.getpid())
+        with open(tmp, "w") as fh:
+            json.dump({"n_samples": n_samples, "status": status}, fh)
+        os.replace(tmp, self._path("state.json"))
+
+    def _check(self, datExpr):
+
+        if np.isnan(datExpr).any():
+            raise ValueError("the incremental mode requires complete data "
+                             "(the clean data has missing values)")
+
+    def rebuild(self, datExpr, samples, genes, tile_size=2000, threads=1):
+        '''Compute the statistics from all of the samples'''
+
+        x = np.array(datExpr, dtype=np.float64)
+        self._check(x)
+
+        self._write_state(0, "updating")
+
+        shift = x.mean(axis=0)
+        x -= shift
+
+        n_genes = x.shape[1]
+
+        crossprod = matrixio.create(self._path("crossprod.npy"),
+                                    (n_genes, n_genes),
+                                    rownames=genes, colnames=genes)
+
+        def _fill(tile):
+            start, end = tile
+            crossprod[start:end] = x[:, start:end].T @ x
+
+        network.map_tiles(_fill, network.tiles(n_genes, tile_size), threads)
+        crossprod.flush()
+        del crossprod
+
+        matrixio.write(self._path("shift.npy"), shift, rownames=genes)
+        matrixio.write(self._path("sums.npy"), x.sum(axis=0), rownames=genes)
+        matrixio.write(self._path("datExpr.npy"), np.asarray(datExpr),
+                       rownames=samples, colnames=genes)
+
+        self._write_state(len(samples), "ok")
+
+    def update(self, datExpr, samples, genes, tile_size=2000, threads=1):
+        '''Bring the statistics up to date with datExpr (samples x genes).
+
+           Only the samples that were added, removed or changed are
+           folded in (or out). The statistics are rebuilt if the genes
+           differ, if the state is missing or incomplete or if that is
+           cheaper. Returns (n_added, n_removed) or None if rebuilt.
+        '''
+
+        datExpr = np.asarray(datExpr)
+        self._check(datExpr)
+
+        state = self._read_state()
+
+        if state is None or state["status"] != "ok":
+            print("No complete statistics found, computing them")
+            self.rebuild(datExpr, samples, genes, tile_size, threads)
+            return None
+
+        old, old_samples, old_genes = matrixio.read(self._path("datExpr.npy"))
+
+        if list(old_genes) != list(genes):
+            print("The genes have changed, recomputing the statistics")
+            self.rebuild(datExpr, samples, genes, tile_size, threads)
+            return None
+
+        old_index = {x: i for i, x in enumerate(old_samples)}
+        new_index = {x: i for i, x in enumerate(samples)}
+
+        removed = [old_index[x] for x in old_samples
+                   if x not in new_index
+                   or not np.array_equal(old[old_index[x]],
+                                         datExpr[new_index[x]])]
+        added = [new_index[x] for x in samples
+                 if x not in old_index
+                 or not np.array_equal(old[old_index[x]],
+                                       datExpr[new_index[x]])]
+
+        if len(added) + len(removed) >= len(samples):
+            print("Most samples have changed, recomputing the statistics")
+            self.rebuild(datExpr, samples, genes, tile_size, threads)
+            return None
+
+        print("Adding %d and removing %d samples" % (len(added), len(removed)))
+
+        self._write_state(len(samples), "updating")
+
+        if len(added) + len(removed) > 0:
+            self._fold(np.vstack([datExpr[added], old[removed]]),
+                       np.concatenate([np.ones(len(added)),
+                                       -np.ones(len(removed))]),
+                       tile_size, threads)
+
+        del old
+
+        matrixio.write(self._path("datExpr.npy"), datExpr,
+                       rownames=samples, colnames=genes)
+
+        self._write_state(len(samples), "ok")
+
+        return len(added), len(removed)
+
+    def _fold(self, rows, signs, tile_size, threads):
+        '''The rank-k update of the statistics with the rows (samples)
+           weighted by signs (+1 to add, -1 to remove)'''
+
+        shift, _, _ = matrixio.read(self._path("shift.npy"), mmap=False)
+        sums, genes, _ = matrixio.read(self._path("sums.npy"), mmap=False)
+
+        d = np.array(rows, dtype=np.float64) - shift
+        weighted = d * signs[:, None]
+
+        crossprod = np.load(self._path("crossprod.npy"), mmap_mode="r+")
+
+        def _update(tile):
+            start, end = tile
+            crossprod[start:end] += weighted[:, start:end].T @ d
+
+        network.map_tiles(_update,
+                          network.tiles(crossprod.shape[0], tile_size),
+                          threads)
+        crossprod.flush()
+        del crossprod
+
+        matrixio.write(self._path("sums.npy"), sums + weighted.sum(axis=0),
+                       rownames=genes)
+
+    def compute_adjacency(self, out, network_type, power,
+                          tile_size=2000, threads=1):
+        '''Fill the n x n array "out" with the adjacency matrix (as
+           network.compute_adjacency) from the statistics'''
+
+        n_samples = self._read_state()["n_samples"]
+
+        crossprod = np.load(self._path("crossprod.npy"), mmap_mode="r")
+        sums, _, _ = matrixio.read(self._path("sums.npy"), mmap=False)
+
+        n_genes = len(sums)
+
+        ss = np.diagonal(crossprod).copy() - sums ** 2 / n_samples
+        sd = np.sqrt(np.clip(ss, 0, None))
+        sd[sd == 0] = 1
+
+        def _fill(tile):
+            start, end = tile
+
+            block = np.array(crossprod[start:end])
+            block -= np.outer(sums[start:end], sums) / n_samples
+            block /= np.outer(sd[start:end], sd)
+
+            network.adjacency_transform(block, network_type, power)
+            block[np.arange(end - start), np.arange(start, end)] = 1
+
+            out[start:end] = block
+
+        network.map_tiles(_fill, network.tiles(n_genes, tile_size), threads)
+
+        return out
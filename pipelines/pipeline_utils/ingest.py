@@ -0,0 +1,285 @@
+'''Parallel parsing and caching of the expression data matrix.
+
+The expression TSV (genes in rows, samples in columns) is split into
+line-aligned byte ranges that are parsed by a pool of worker processes.
+Each worker writes its rows straight into a memory-mapped float64 .npy
+file so that the text is never held in memory as a whole. The parsed
+matrix is kept in a cache directory, named by the sha256 of the TSV
+file, so that it is only parsed again when the file changes:
+
+    <cache_dir>/<sha256>.<idcol>.v<PARSE_VERSION>.npy
+    (with .rownames.txt and .colnames.txt sidecars)
+
+A gzipped TSV (.gz) is first decompressed next to the output, as the
+byte ranges cannot be read from the compressed stream.
+
+The WGCNA gene and sample filters (goodSamplesGenes) are then applied
+to the cached matrix with vectorised numpy operations.
+'''
+
+import io
+import os
+import gzip
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from pipeline_utils import cache
+from pipeline_utils import matrixio
+from pipeline_utils import network
+
+
+PARSE_VERSION = "1"
+
+# the smallest byte range given to a worker
+MIN_CHUNK_SIZE = 16 * 2 ** 20
+
+
+def make_unique(names):
+    '''Make names unique by appending .1, .2, .. to duplicates (as R's
+       make.unique)'''
+
+    seen = set(names)
+    counts = {}
+    unique = []
+
+    for name in names:
+        if name not in counts:
+            counts[name] = 0
+            unique.append(name)
+            continue
+
+        while True:
+            counts[name] += 1
+            candidate = "%s.%d" % (name, counts[name])
+            if candidate not in seen:
+                break
+
+        seen.add(candidate)
+        unique.append(candidate)
+
+    return unique
+
+
+def _chunks(path, data_start, n_chunks):
+    '''Split the file (after the header) into line-aligned byte ranges'''
+
+    size = os.path.getsize(path)
+    step = max((size - data_start) // max(n_chunks, 1), MIN_CHUNK_SIZE)
+
+    bounds = [data_start]
+
+    with open(path, "rb") as fh:
+        position = data_start + step
+        while position < size:
+            fh.seek(position)
+            fh.readline()
+            position = fh.tell()
+            if position >= size:
+                break
+            bounds.append(position)
+            position += step
+
+    bounds.append(size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _read_range(path, byte_range):
+    with open(path, "rb") as fh:
+        fh.seek(byte_range[0])
+        return fh.read(byte_range[1] - byte_range[0])
+
+
+def _count_rows(path, byte_range):
+    '''The number of (non-blank) lines in a byte range'''
+
+    return sum(1 for line in _read_range(path, byte_range).split(b"\n")
+               if line.strip())
+
+
+def _parse_range(path, byte_range, columns, idcol, out_path, offset):
+    '''Parse a byte range and write its rows to the output matrix.
+       Returns the gene ids.'''
+
+    table = pd.read_csv(io.BytesIO(_read_range(path, byte_range)),
+                        sep="\t", header=None, names=columns,
+                        dtype={idcol: str}, skip_blank_lines=True)
+
+    values = table.drop(columns=[idcol]).to_numpy(dtype=np.float64)
+
+    out = np.load(out_path, mmap_mode="r+")
+    out[offset:offset + len(values)] = values
+    out.flush()
+
+    return table[idcol].tolist()
+
+
+def parse_expression(path, out_path, idcol="gene_id", threads=4):
+    '''Parse an expression TSV into a (genes x samples) float64 .npy
+       matrix with the gene ids (made unique) and sample names in the
+       sidecars.'''
+
+    if path.endswith(".gz"):
+        tsv = out_path[:-len(".npy")] + ".%d.tmp.tsv" % os.getpid()
+
+        try:
+            with gzip.open(path, "rb") as src, open(tsv, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 24)
+
+            parse_expression(tsv, out_path, idcol, threads)
+
+        finally:
+            if os.path.exists(tsv):
+                os.remove(tsv)
+
+        return
+
+    with open(path, "rb") as fh:
+        header = fh.readline()
+        data_start = fh.tell()
+
+    columns = header.decode().rstrip("\r\n").split("\t")
+
+    if idcol not in columns:
+        raise ValueError('the id column "%s" was not found in %s'
+                         % (idcol, path))
+
+    samples = [x for x in columns if x != idcol]
+    ranges = _chunks(path, data_start, threads * 4)
+
+    with ProcessPoolExecutor(max_workers=threads) as pool:
+
+        counts = list(pool.map(_count_rows, [path] * len(ranges), ranges))
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+        tmp = out_path[:-len(".npy")] + ".%d.tmp.npy" % os.getpid()
+
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float64,
+                                        shape=(int(sum(counts)),
+                                               len(samples)))
+        del out
+
+        genes = pool.map(_parse_range,
+                         [path] * len(ranges), ranges,
+                         [columns] * len(ranges), [idcol] * len(ranges),
+                         [tmp] * len(ranges), offsets)
+
+        genes = [x for chunk in genes for x in chunk]
+
+    matrixio.write_names(out_path, "rownames", make_unique(genes))
+    matrixio.write_names(out_path, "colnames", samples)
+
+    os.replace(tmp, out_path)
+
+
+def cached_path(path, cache_dir, idcol="gene_id"):
+    '''The location of the parsed matrix of an expression TSV'''
+
+    digest = cache.file_digest(path,
+                               os.path.join(cache_dir, "tsv.digests.json"))
+
+    return os.path.join(cache_dir, "%s.%s.v%s.npy"
+                        % (digest, idcol, PARSE_VERSION))
+
+
+def load_expression(path, cache_dir, idcol="gene_id", threads=4):
+    '''Return the memory-mapped (genes x samples) matrix, gene ids and
+       sample names of an expression TSV, parsing it only if it is not
+       already in the cache directory.'''
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    out_path = cached_path(path, cache_dir, idcol)
+
+    if not os.path.exists(out_path):
+        parse_expression(path, out_path, idcol, threads)
+
+    return matrixio.read(out_path)
+
+
+def _gene_stats(x, samples, tile_size=5000):
+    '''The variance and the number of non-missing values of each gene
+       over the given samples, and the largest absolute value, a tile of
+       genes at a time'''
+
+    variance = np.empty(x.shape[0])
+    n_present = np.empty(x.shape[0], dtype=np.int64)
+    max_abs = 0.0
+
+    for start, end in network.tiles(x.shape[0], tile_size):
+        block = np.asarray(x[start:end])[:, samples]
+        present = ~np.isnan(block)
+
+        n_present[start:end] = present.sum(axis=1)
+
+        if present.any():
+            max_abs = max(max_abs, np.abs(block[present]).max())
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance[start:end] = np.nanvar(block, axis=1, ddof=1)
+
+    variance[np.isnan(variance)] = 0
+
+    return variance, n_present, max_abs
+
+
+def _sample_present(x, genes, tile_size=5000):
+    '''The number of non-missing values of each sample over the given
+       genes, a tile of genes at a time'''
+
+    n_present = np.zeros(x.shape[1], dtype=np.int64)
+
+    for start, end in network.tiles(x.shape[0], tile_size):
+        block = np.asarray(x[start:end])[genes[start:end]]
+        n_present += (~np.isnan(block)).sum(axis=0)
+
+    return n_present
+
+
+def good_samples_genes(x, min_fraction=0.5, min_n_samples=4, min_n_genes=4,
+                       tol=None):
+    '''Flag the good genes and samples of a (genes x samples) matrix
+       (as WGCNA::goodSamplesGenes without weights).
+
+       Genes need enough non-missing samples and a non-zero variance,
+       samples need enough non-missing genes. The filters are applied
+       in turn until nothing more is removed. Returns boolean vectors
+       (good_genes, good_samples).
+
+       The (memory-mapped) matrix is read a tile of genes at a time.
+    '''
+
+    n_genes, n_samples = x.shape
+
+    good_genes = np.ones(n_genes, dtype=bool)
+    good_samples = np.ones(n_samples, dtype=bool)
+
+    while True:
+
+        ns = good_samples.sum()
+        variance, n_present, max_abs = _gene_stats(x, good_samples)
+
+        # the first pass is over all of the samples
+        if tol is None:
+            tol = 1e-10 * max_abs
+
+        genes = (good_genes
+                 & (ns - n_present < (1 - min_fraction) * ns)
+                 & (n_present >= min_n_samples)
+                 & (variance > tol ** 2))
+
+        ng = genes.sum()
+        n_present = _sample_present(x, genes)
+
+        samples = (good_samples
+                   & (ng - n_present < (1 - min_fraction) * ng)
+                   & (n_present >= min_n_genes))
+
+        if (genes == good_genes).all() and (samples == good_samples).all():
+            break
+
+        good_genes, good_samples = genes, samples
+
+    return good_genes, good_samples
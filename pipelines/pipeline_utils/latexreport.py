@@ -0,0 +1,99 @@
+'''Build the summary report from separately compiled section fragments.
+
+Each section of the report (e.g. cleanSection.tex) is compiled on its
+own into a "fragment" PDF with the report preamble and variables, its
+section counter set to the number of the section in the report. The
+figures and tables are numbered within the sections (see
+latex/preamble.sty) so that their numbers do not depend on the other
+fragments. The table of contents entries of the fragment are written
+to its .toc file even though the fragment has no table of contents.
+
+The report itself is then assembled from the title page, the table of
+contents and the introduction (introReport.tex) and the fragment PDFs,
+which are included with pdfpages. The table of contents entries of the
+fragments are added to the report at the pages on which they fall, so
+that recompiling the report does not typeset the sections again.
+'''
+
+import re
+
+
+FRAGMENT = r'''\input{%(latex_vars)s}
+\documentclass{article}
+\usepackage{\wgcnaDir/latex/preamble}
+\pagestyle{empty}
+\begin{document}
+\makeatletter
+\if@filesw\newwrite\tf@toc\immediate\openout\tf@toc\jobname.toc\relax\fi
+\makeatother
+\setcounter{section}{%(offset)d}
+\input{%(section_tex)s}
+\end{document}
+'''
+
+ASSEMBLY = r'''\input{%(latex_vars)s}
+\def\reportTitle{pipeline\_wgcna.py: summary report}
+\input{%(wgcna_dir)s/pipelines/pipeline_wgcna/introReport.tex}
+%(fragments)s
+\input{%(wgcna_dir)s/latex/endmatter.tex}
+'''
+
+TOC_LEVELS = {"section": 1, "subsection": 2, "subsubsection": 3}
+
+TOC_LINE = re.compile(r"^\\contentsline \{(\w+)\}\{(.*)\}\{(\d+)\}"
+                      r"\{[^{}]*\}%?$")
+
+
+def write_fragment(path, latex_vars, section_tex, number):
+    '''Write the document that compiles a section as section "number"'''
+
+    with open(path, "w") as fh:
+        fh.write(FRAGMENT % dict(latex_vars=latex_vars,
+                                 section_tex=section_tex,
+                                 offset=number - 1))
+
+
+def read_toc(path):
+    '''Read the (level, heading, page) entries of a .toc file'''
+
+    entries = []
+
+    with open(path) as fh:
+        for line in fh:
+            match = TOC_LINE.match(line.strip())
+
+            if match and match.group(1) in TOC_LEVELS:
+                level, heading, page = match.groups()
+                heading = heading.replace("\\numberline ",
+                                          "\\protect\\numberline")
+                entries.append((level, heading, int(page)))
+
+    return entries
+
+
+def include_fragment(pdf, entries, label):
+    '''The \\includepdf command that adds a fragment to the report'''
+
+    toc = ",".join("%d,%s,%d,{%s},%s.%d" % (page, level, TOC_LEVELS[level],
+                                            heading, label, i)
+                   for i, (level, heading, page) in enumerate(entries))
+
+    options = ["pages=-", r"pagecommand={\thispagestyle{plain}}"]
+
+    if toc:
+        options.append("addtotoc={%s}" % toc)
+
+    return r"\includepdf[%s]{%s}" % (",".join(options), pdf)
+
+
+def write_assembly(path, latex_vars, wgcna_dir, fragments):
+    '''Write the report document. fragments is a list of (label, pdf,
+       toc) for the compiled sections, in order.'''
+
+    commands = [include_fragment(pdf, read_toc(toc), label)
+                for label, pdf, toc in fragments]
+
+    with open(path, "w") as fh:
+        fh.write(ASSEMBLY % dict(latex_vars=latex_vars,
+                                 wgcna_dir=wgcna_dir,
+                                 fragments="\n".join(commands)))
@@ -0,0 +1,122 @@
+'''Language-neutral intermediate files shared by the python and R stages.
+
+A matrix is stored as an uncompressed NumPy .npy file (which can be
+memory-mapped and sliced without reading the whole file) together with
+optional plain-text sidecar files holding the row and column names,
+one name per line:
+
+    <prefix>.npy
+    <prefix>.rownames.txt
+    <prefix>.colnames.txt
+
+Labels (e.g. the module colors) are stored as an int32 vector of codes
+with the levels in a <prefix>.levels.txt sidecar.
+
+Sparse matrices (e.g. the k-nearest-neighbour TOM) are stored as
+scipy .npz files with the same sidecars. These are only read by the
+python stages.
+
+The R counterpart is R/wgcna_matrixio.R.
+'''
+
+import os
+import numpy as np
+import scipy.sparse as sp
+
+
+def _sidecar(path, kind):
+    '''Return the path of the names sidecar file for an .npy file'''
+
+    for ext in [".npy", ".npz"]:
+        if path.endswith(ext):
+            path = path[:-len(ext)]
+
+    return path + "." + kind + ".txt"
+
+
+def write_names(path, kind, names):
+    '''Write a names sidecar (kind is rownames, colnames or levels)'''
+
+    if names is None:
+        return
+
+    with open(_sidecar(path, kind), "w") as fh:
+        for name in names:
+            fh.write(str(name) + "\n")
+
+
+def read_names(path, kind):
+    '''Read a names sidecar, returning None if it does not exist'''
+
+    sidecar = _sidecar(path, kind)
+
+    if not os.path.exists(sidecar):
+        return None
+
+    with open(sidecar) as fh:
+        return [line.rstrip("\n") for line in fh]
+
+
+def create(path, shape, dtype=np.float64, rownames=None, colnames=None):
+    '''Create a memory-mapped .npy matrix to be filled in place'''
+
+    write_names(path, "rownames", rownames)
+    write_names(path, "colnames", colnames)
+
+    return np.lib.format.open_memmap(path, mode="w+",
+                                     dtype=dtype, shape=shape)
+
+
+def write(path, x, rownames=None, colnames=None):
+    '''Write a matrix (and its names) to path'''
+
+    write_names(path, "rownames", rownames)
+    write_names(path, "colnames", colnames)
+
+    np.save(path, np.asarray(x))
+
+
+def read(path, mmap=True):
+    '''Open a matrix. Returns (array, rownames, colnames). The array is
+       memory-mapped (read only) unless mmap is False.'''
+
+    x = np.load(path, mmap_mode="r" if mmap else None)
+
+    return x, read_names(path, "rownames"), read_names(path, "colnames")
+
+
+def write_sparse(path, x, rownames=None, colnames=None):
+    '''Write a sparse matrix (and its names) to path (.npz)'''
+
+    write_names(path, "rownames", rownames)
+    write_names(path, "colnames", colnames)
+
+    sp.save_npz(path, sp.csr_matrix(x), compressed=False)
+
+
+def read_sparse(path):
+    '''Read a sparse matrix. Returns (CSR matrix, rownames, colnames)'''
+
+    return (sp.load_npz(path).tocsr(),
+            read_names(path, "rownames"), read_names(path, "colnames"))
+
+
+def write_labels(path, labels, names=None):
+    '''Write a vector of string labels as int32 codes plus levels'''
+
+    levels, codes = np.unique(np.asarray(labels, dtype=str),
+                              return_inverse=True)
+
+    write_names(path, "levels", levels)
+    write_names(path, "rownames", names)
+
+    np.save(path, codes.astype(np.int32))
+
+
+def read_labels(path):
+    '''Read a label vector. Returns (labels, names)'''
+
+    codes = np.load(path).ravel()
+    levels = np.array(read_names(path, "levels"))
+
+    return levels[codes], read_names(path, "rownames")
@@ -0,0 +1,103 @@
+'''Vectorised module membership (kME).
+
+The correlation of every gene with every module eigengene is computed
+with a few blocked matrix products over tiles of genes. Missing values
+are handled as cor(use="p") (pairwise complete observations): the sums
+and sums of squares of the eigengenes are taken over the samples in
+which each gene is present, which is again a matrix product with the
+0/1 presence mask. The p-values are those of WGCNA::corPvalueStudent.
+'''
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t as t_dist
+
+from pipeline_utils import network
+
+
+def kme(datExpr, MEs, tile_size=2000, threads=1):
+    '''Return the (genes x modules) correlations of the columns of
+       datExpr (samples x genes) with the columns of MEs (samples x
+       modules), using the pairwise complete observations.'''
+
+    e = np.array(MEs, dtype=np.float64)
+    e -= np.nanmean(e, axis=0)
+
+    n_genes = datExpr.shape[1]
+    out = np.empty((n_genes, e.shape[1]))
+
+    e2 = e ** 2
+
+    def _fill(tile):
+        start, end = tile
+
+        x = np.array(datExpr[:, start:end], dtype=np.float64).T
+        x -= np.nanmean(x, axis=1)[:, None]
+
+        present = ~np.isnan(x)
+        x[~present] = 0
+        present = present.astype(np.float64)
+
+        n = present.sum(axis=1)[:, None]
+
+        s_x = x.sum(axis=1)[:, None]
+        s_e = present @ e
+
+        cov = x @ e - s_x * s_e / n
+        var_x = (x ** 2).sum(axis=1)[:, None] - s_x ** 2 / n
+        var_e = present @ e2 - s_e ** 2 / n
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[start:end] = cov / np.sqrt(var_x * var_e)
+
+    network.map_tiles(_fill, network.tiles(n_genes, tile_size), threads)
+
+    return np.clip(out, -1, 1, out=out)
+
+
+def cor_pvalue_student(cor, n_samples):
+    '''Student asymptotic p-values of correlations (as
+       WGCNA::corPvalueStudent)'''
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.sqrt(n_samples - 2) * cor / np.sqrt(1 - cor ** 2)
+
+    return 2 * t_dist.sf(np.abs(t), n_samples - 2)
+
+
+def membership_table(kme_values, p_values, genes, modules, colors,
+                     gene_names=None):
+    '''Tabulate the membership of each gene in its own module.
+
+       kme_values and p_values are (genes x modules), colors gives the
+       module of each gene. The modules are ordered from smallest to
+       largest and the genes of each module by p-value.
+    '''
+
+    genes = np.asarray(genes)
+    colors = np.asarray(colors)
+
+    column = pd.Index(modules).get_indexer(colors)
+
+    if (column < 0).any():
+        raise ValueError("no eigengene found for modules: "
+                         + ", ".join(np.unique(colors[column < 0])))
+
+    rows = np.arange(len(genes))
+
+    table = pd.DataFrame({"module": colors,
+                          "gene_id": genes,
+                          "gene_name": (gene_names if gene_names is not None
+                                        else genes),
+                          "membership": kme_values[rows, column],
+                          "p.value": p_values[rows, column]})
+
+    # modules from smallest to largest (ties in alphabetical order)
+    sizes = table["module"].value_counts()
+    module_order = sorted(sizes.index, key=lambda x: (sizes[x], x))
+    rank = pd.Series(np.arange(len(module_order)), index=module_order)
+
+    order = np.lexsort((table["p.value"].values,
+                        rank[table["module"]].values))
+
+    return table.iloc[order].reset_index(drop=True)
@@ -0,0 +1,447 @@
+'''Blocked computation of WGCNA co-expression networks.
+
+The expression matrix is standardised once so that the correlation
+of a tile of genes with every other gene is a single (BLAS) matrix
+product. Data with missing values is correlated over the pairwise
+complete samples instead (as cor(use = "p")), which takes a few more
+products per tile (see PairwiseProfiles). Tiles of rows are computed in a thread pool and written
+straight into a (memory-mapped) output so that peak memory is bounded
+by the tile size rather than by the number of genes. The topological
+overlap is computed in the same way from pairs of adjacency tiles.
+
+For very large gene sets a sparse network can be built instead that
+keeps only the strongest adjacencies of each gene (knn_adjacency) and
+the topological overlap is then computed over the sparse graph
+(sparse_tom).
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+from scipy.stats import rankdata
+
+
+NETWORK_TYPES = ["unsigned", "signed", "signed_hybrid"]
+
+COR_FNCS = ["pearson", "spearman", "bicor"]
+
+
+class PairwiseProfiles(object):
+    '''Profiles (genes x samples) with missing values that are
+       correlated over the samples present for both genes of a pair.
+
+       When centre is True the means and variances of each pair are
+       those of the shared samples (Pearson correlation, as cor(use =
+       "p")). Otherwise the profiles are taken to be centred already
+       (the biweight midcorrelation) and only the norms are computed
+       over the shared samples. Pairs with no shared variance have a
+       correlation of 0.
+    '''
+
+    def __init__(self, x, centre=True):
+
+        present = ~np.isnan(x)
+
+        self.x = np.where(present, x, 0)
+        self.x2 = self.x ** 2
+        self.present = present.astype(np.float64)
+        self.centre = centre
+        self.shape = x.shape
+
+    def correlation(self, start, end):
+        '''The correlations of the genes start:end with all the genes'''
+
+        x_i, m_i = self.x[start:end], self.present[start:end]
+
+        cross = x_i @ self.x.T
+        ss_i = self.x2[start:end] @ self.present.T
+        ss_j = m_i @ self.x2.T
+
+        if self.centre:
+            n = m_i @ self.present.T
+            n[n == 0] = 1
+
+            s_i = x_i @ self.present.T
+            s_j = m_i @ self.x.T
+
+            cross -= s_i * s_j / n
+            ss_i -= s_i ** 2 / n
+            ss_j -= s_j ** 2 / n
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cross /= np.sqrt(ss_i * ss_j)
+
+        return np.nan_to_num(cross, copy=False, nan=0.0, posinf=0.0,
+                             neginf=0.0)
+
+
+def correlation_rows(z, tile):
+    '''The correlations of a tile of genes with all of the genes, from
+       the standardised profiles z (see standardise())'''
+
+    start, end = tile
+
+    if isinstance(z, PairwiseProfiles):
+        return z.correlation(start, end)
+
+    return z[start:end] @ z.T
+
+
+def _unit_norm(x):
+    '''centre and scale the rows of x (in place) to unit length'''
+
+    x -= np.mean(x, axis=1)[:, None]
+
+    norms = np.sqrt(np.einsum("ij,ij->i", x, x))
+    norms[norms == 0] = 1
+
+    x /= norms[:, None]
+
+    return x
+
+
+def _biweight(x):
+    '''Apply the biweight midcorrelation weights to the rows of x
+       (in place). Genes with a zero median absolute deviation fall
+       back to Pearson correlation as in WGCNA::bicor.'''
+
+    med = np.nanmedian(x, axis=1)[:, None]
+    mad = np.nanmedian(np.abs(x - med), axis=1)[:, None]
+
+    fallback = (mad == 0)[:, 0]
+    mad[mad == 0] = 1
+
+    u = (x - med) / (9 * mad)
+    w = (1 - u ** 2) ** 2
+    w[np.abs(u) >= 1] = 0
+
+    weighted = (x - med) * w
+
+    if np.isnan(x).any():
+        if fallback.any():
+            weighted[fallback] = (x[fallback]
+                                  - np.nanmean(x[fallback], axis=1)[:, None])
+
+        return PairwiseProfiles(weighted, centre=False)
+
+    norms = np.sqrt(np.einsum("ij,ij->i", weighted, weighted))
+    norms[norms == 0] = 1
+    weighted /= norms[:, None]
+
+    if fallback.any():
+        weighted[fallback] = _unit_norm(x[fallback])
+
+    return weighted
+
+
+def standardise(datExpr, cor_fnc="pearson"):
+    '''Return a genes x samples matrix of standardised profiles so that
+       the product z[i] . z[j] is the correlation of genes i and j.
+
+       datExpr is in the WGCNA orientation (samples in rows, genes in
+       columns). If it has missing values PairwiseProfiles are returned
+       instead; use correlation_rows() to correlate either.
+    '''
+
+    if cor_fnc not in COR_FNCS:
+        raise ValueError("Correlation function not recognised")
+
+    z = np.array(datExpr, dtype=np.float64).T.copy()
+
+    if cor_fnc == "spearman":
+        missing = np.isnan(z)
+        z = rankdata(z, axis=1, nan_policy="omit")
+        z[missing] = np.nan
+
+    if cor_fnc == "bicor":
+        return _biweight(z)
+
+    if np.isnan(z).any():
+        return PairwiseProfiles(z)
+
+    return _unit_norm(z)
+
+
+def adjacency_transform(cor, network_type, power):
+    '''Turn a block of correlations into adjacencies (in place)'''
+
+    np.clip(cor, -1, 1, out=cor)
+
+    if network_type == "unsigned":
+        np.abs(cor, out=cor)
+
+    elif network_type == "signed":
+        cor += 1
+        cor *= 0.5
+
+    elif network_type == "signed_hybrid":
+        np.maximum(cor, 0, out=cor)
+
+    else:
+        raise ValueError("Network type must be one of " +
+                         ", ".join(NETWORK_TYPES))
+
+    np.power(cor, power, out=cor)
+
+    return cor
+
+
+def tiles(n, tile_size):
+    '''Split range(n) into (start, end) tiles'''
+
+    return [(start, min(start + tile_size, n))
+            for start in range(0, n, tile_size)]
+
+
+def map_tiles(fnc, tile_list, threads=1):
+    '''Apply fnc to each tile, in a thread pool if threads > 1.
+       numpy releases the GIL for the heavy lifting.'''
+
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(fnc, tile_list))
+    else:
+        for tile in tile_list:
+            fnc(tile)
+
+
+def compute_adjacency(z, out, network_type, power,
+                      tile_size=2000, threads=1):
+    '''Fill the n x n array "out" with the adjacency matrix of the
+       standardised profiles z (see standardise()).'''
+
+    n = z.shape[0]
+
+    def _fill(tile):
+        start, end = tile
+
+        block = correlation_rows(z, tile)
+        adjacency_transform(block, network_type, power)
+
+        block[np.arange(end - start), np.arange(start, end)] = 1
+
+        out[start:end] = block
+
+    map_tiles(_fill, tiles(n, tile_size), threads)
+
+    return out
+
+
+TOM_TYPES = ["unsigned", "signed"]
+
+
+def _rows_without_diagonal(adj, tile):
+    '''Read a tile of rows of the adjacency with the diagonal zeroed'''
+
+    start, end = tile
+    block = np.array(adj[start:end], dtype=np.float64)
+    block[np.arange(end - start), np.arange(start, end)] = 0
+
+    return block
+
+
+def adjacency_rows(z, tile, network_type, power):
+    '''Compute a tile of rows of the adjacency directly from the
+       standardised profiles, with the diagonal zeroed'''
+
+    start, end = tile
+
+    block = correlation_rows(z, tile)
+    adjacency_transform(block, network_type, power)
+    block[np.arange(end - start), np.arange(start, end)] = 0
+
+    return block
+
+
+def _connectivity(read_rows, n, tile_size=2000, threads=1):
+    '''Return the connectivity (row sums excluding the diagonal)
+       reading one tile of adjacency rows at a time.'''
+
+    k = np.zeros(n)
+
+    def _sum(tile):
+        k[tile[0]:tile[1]] = np.abs(read_rows(tile)).sum(axis=1)
+
+    map_tiles(_sum, tiles(n, tile_size), threads)
+
+    return k
+
+
+def connectivity(adj, tile_size=2000, threads=1):
+    '''Return the connectivity of the (memory-mapped) adjacency matrix'''
+
+    return _connectivity(lambda tile: _rows_without_diagonal(adj, tile),
+                         adj.shape[0], tile_size, threads)
+
+
+def tom_block(a_i, a_j, a_ij, k_i, k_j, tom_type="unsigned"):
+    '''Compute a block of the topological overlap from the adjacency
+       rows a_i and a_j (diagonal zeroed), the adjacency block a_ij
+       and the connectivities k_i and k_j.'''
+
+    if tom_type not in TOM_TYPES:
+        raise ValueError("TOM type must be one of " + ", ".join(TOM_TYPES))
+
+    numerator = a_i @ a_j.T
+    numerator += a_ij
+
+    if tom_type == "signed":
+        np.abs(numerator, out=numerator)
+        a_ij = np.abs(a_ij)
+
+    denominator = np.minimum.outer(k_i, k_j)
+    denominator += 1
+    denominator -= a_ij
+
+    numerator /= denominator
+
+    return numerator
+
+
+def _diss_tom(read_rows, n, out, tom_type, tile_size, threads):
+    '''Fill "out" with 1 - TOM, obtaining tiles of adjacency rows
+       (diagonal zeroed) from read_rows(tile).
+
+       Each work item is a row tile i for which the upper triangle of
+       blocks (i, j >= i) is computed, so at most two row tiles
+       (2 * tile_size * n values) are held per thread.
+    '''
+
+    k = _connectivity(read_rows, n, tile_size, threads)
+
+    tile_list = tiles(n, tile_size)
+
+    def _fill(i):
+        tile_i = tile_list[i]
+        a_i = read_rows(tile_i)
+
+        for tile_j in tile_list[i:]:
+
+            a_j = a_i if tile_j == tile_i else read_rows(tile_j)
+            a_ij = a_i[:, tile_j[0]:tile_j[1]]
+
+            tom = tom_block(a_i, a_j, a_ij,
+                            k[tile_i[0]:tile_i[1]],
+                            k[tile_j[0]:tile_j[1]],
+                            tom_type)
+
+            np.subtract(1, tom, out=tom)
+
+            if tile_j == tile_i:
+                tom[np.arange(len(tom)), np.arange(len(tom))] = 0
+
+            out[tile_i[0]:tile_i[1], tile_j[0]:tile_j[1]] = tom
+            out[tile_j[0]:tile_j[1], tile_i[0]:tile_i[1]] = tom.T
+
+    map_tiles(_fill, range(len(tile_list)), threads)
+
+    return out
+
+
+def compute_diss_tom(adj, out, tom_type="unsigned",
+                     tile_size=2000, threads=1):
+    '''Fill the n x n array "out" with 1 - TOM for the (memory-mapped)
+       adjacency matrix "adj".'''
+
+    return _diss_tom(lambda tile: _rows_without_diagonal(adj, tile),
+                     adj.shape[0], out, tom_type, tile_size, threads)
+
+
+def compute_diss_tom_fused(z, out, network_type, power, tom_type="unsigned",
+                           tile_size=2000, threads=1):
+    '''Fill the n x n array "out" with 1 - TOM computed directly from
+       the standardised profiles z without materialising the adjacency.
+
+       Adjacency tiles are recomputed from the correlations when they
+       are needed. This adds roughly n_samples / tile_size to the cost
+       of the TOM products, which is cheaper than writing and re-reading
+       an n x n adjacency unless there are many more samples than genes
+       per tile.
+    '''
+
+    return _diss_tom(lambda tile: adjacency_rows(z, tile, network_type, power),
+                     z.shape[0], out, tom_type, tile_size, threads)
+
+
+def knn_adjacency(z, n_neighbours, network_type, power,
+                  tile_size=2000, threads=1):
+    '''Return the sparse (CSR) adjacency matrix that keeps only the
+       n_neighbours strongest adjacencies of each gene.
+
+       The correlations are computed in tiles of rows from the
+       standardised profiles z so that memory is linear in the number
+       of genes. An edge that is kept for either of its genes is kept
+       for both so that the matrix is symmetric.
+    '''
+
+    n = z.shape[0]
+    n_neighbours = min(n_neighbours, n - 1)
+
+    tile_list = tiles(n, tile_size)
+    edges = [None] * len(tile_list)
+
+    def _fill(i):
+        start, end = tile_list[i]
+
+        block = adjacency_rows(z, tile_list[i], network_type, power)
+
+        top = np.argpartition(-block, n_neighbours - 1,
+                              axis=1)[:, :n_neighbours]
+        rows = np.repeat(np.arange(start, end), n_neighbours)
+
+        edges[i] = (rows, top.ravel(),
+                    block[np.arange(end - start)[:, None], top].ravel())
+
+    map_tiles(_fill, range(len(tile_list)), threads)
+
+    rows, cols, values = [np.concatenate(x) for x in zip(*edges)]
+
+    adj = sp.csr_matrix((values, (rows, cols)), shape=(n, n))
+    adj = adj.maximum(adj.T).tocsr()
+    adj.eliminate_zeros()
+    adj.sort_indices()
+
+    return adj
+
+
+def sparse_tom(adj, tom_type="unsigned", tile_size=2000, threads=1):
+    '''Return the TOM of a sparse adjacency matrix (see knn_adjacency)
+       on the edges of the adjacency.
+
+       The shared neighbours and connectivities are those of the sparse
+       graph, so the TOM of the genes that are not neighbours is taken
+       to be 0. Memory is linear in the number of edges.
+    '''
+
+    if tom_type not in TOM_TYPES:
+        raise ValueError("TOM type must be one of " + ", ".join(TOM_TYPES))
+
+    n = adj.shape[0]
+    k = np.asarray(adj.sum(axis=1)).ravel()
+
+    data = np.empty(len(adj.data))
+
+    def _fill(tile):
+        start, end = tile
+
+        a_i = adj[start:end]
+        shared = (a_i @ adj).tocsr()
+
+        rows = np.repeat(np.arange(end - start), np.diff(a_i.indptr))
+        cols = a_i.indices
+
+        numerator = np.asarray(shared[rows, cols]).ravel() + a_i.data
+        a_ij = a_i.data
+
+        if tom_type == "signed":
+            numerator = np.abs(numerator)
+            a_ij = np.abs(a_ij)
+
+        denominator = np.minimum(k[start + rows], k[cols]) + 1 - a_ij
+
+        data[adj.indptr[start]:adj.indptr[end]] = numerator / denominator
+
+    map_tiles(_fill, tiles(n, tile_size), threads)
+
+    return sp.csr_matrix((data, adj.indices.copy(), adj.indptr.copy()),
+                         shape=adj.shape)
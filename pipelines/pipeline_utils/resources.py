@@ -1,4 +1,9 @@
 import math
+import gzip
+import numpy as np
+
+from pipeline_utils import cache
+
 
 def get(memory="4G", cpu=1):
     '''calculate the resource requirements and return a
@@ -16,3 +21,239 @@ def get(memory="4G", cpu=1):
             "r_memory": gb_requested * 1000}
 
     return spec
+
+
+# ------------------------------------------------------------------------- #
+# Memory model and resource planner
+# ------------------------------------------------------------------------- #
+
+# the memory used by an R session with WGCNA loaded and by a python
+# process with numpy and scipy loaded
+R_BASE = 0.5e9
+PY_BASE = 0.2e9
+
+# the smallest block size that the planner will choose
+MIN_BLOCK_SIZE = 1000
+
+
+def dimensions(path):
+    '''Return (n_genes, n_samples) of the expression data: either a
+       clean (samples x genes) .npy matrix or the input TSV (genes in
+       rows, samples in columns, plus the gene identifier column),
+       which may be gzipped'''
+
+    if path.endswith(".npy"):
+        n_samples, n_genes = np.load(path, mmap_mode="r").shape
+        return n_genes, n_samples
+
+    opener = gzip.open if path.endswith(".gz") else open
+
+    with opener(path, "rb") as fh:
+        # the header is read here so the lines counted below are genes
+        header = fh.readline()
+        n_samples = len(header.rstrip(b"\r\n").split(b"\t")) - 1
+
+        n_genes = 0
+        last = b"\n"
+        for chunk in iter(lambda: fh.read(1 << 24), b""):
+            n_genes += chunk.count(b"\n")
+            last = chunk[-1:]
+
+    if last != b"\n":
+        n_genes += 1
+
+    return n_genes, n_samples
+
+
+def predict(n_genes, n_samples, detection="stepwise", tree_engine="R",
+            block_size=None, tile_size=2000, threads=1, knn=None):
+    '''Predict the peak memory (bytes) of the tasks for data with n_genes
+       genes and n_samples samples.
+
+       The estimates count the matrices held by the R and python steps
+       (e.g. R's hclust needs the dissTOM, its dist() copy and the copy
+       made by fastcluster, some 3 x n_genes^2 doubles, while the python
+       engines need a few tiles of rows per thread).
+    '''
+
+    g, n = n_genes, n_samples
+    tile = min(tile_size, g)
+
+    data = 8.0 * g * n
+    tiles = 8.0 * threads * tile * g
+
+    peaks = {"cleanData": R_BASE + 6 * data,
+             "softPower": PY_BASE + 2 * data + 3 * tiles,
+             "characteriseModules": R_BASE + 4 * data}
+
+    if detection == "stepwise":
+
+        if knn:
+            peaks["computeSparseNetwork"] = (PY_BASE + 2 * data + 2 * tiles
+                                             + 48.0 * g * knn)
+            python_cut = PY_BASE + 3 * 8.0 * tile * g + 96.0 * g * knn
+
+        else:
+            peaks["computeAdjacency"] = PY_BASE + 2 * data + 2 * tiles
+            peaks["computeTOM"] = (PY_BASE + 2 * tiles
+                                   + 24.0 * threads * tile * tile)
+            peaks["computeNetwork"] = peaks["computeTOM"] + 2 * data
+            # the TOM of each consensus set (assumed to be of about the
+            # same size as the input)
+            peaks["consensusNetwork"] = peaks["computeNetwork"]
+            python_cut = PY_BASE + 3 * 8.0 * tile * g + 40.0 * g
+
+        merging = R_BASE + 5 * data
+
+        if tree_engine == "R" and not knn:
+            peaks["detectModules"] = merging + 24.0 * g * g
+        else:
+            peaks["detectModules"] = max(python_cut, merging)
+
+    elif detection == "blockwise":
+
+        block = min(block_size or g, g)
+
+        # adjacency, TOM, dissTOM and the hclust copy of each block
+        peaks["detectModulesBlockwise"] = (R_BASE + 5 * data
+                                           + 32.0 * block ** 2)
+
+    else:
+        raise ValueError('detection must be either "stepwise" or "blockwise"')
+
+    return peaks
+
+
+class Plan(object):
+    '''The detection mode, block size, tree engine, threads and memory
+       chosen for a data set'''
+
+    def __init__(self, n_genes, n_samples, detection, tree_engine,
+                 block_size, threads, peaks, budget, safety, fits=True):
+
+        self.n_genes = n_genes
+        self.n_samples = n_samples
+        self.detection = detection
+        self.tree_engine = tree_engine
+        self.block_size = block_size
+        self.threads = threads
+        self.peaks = peaks
+        self.budget = budget
+        self.safety = safety
+        self.fits = fits
+
+    def job_memory(self, task, threads=None):
+        '''The per-thread job_memory for a task (e.g. "1500M")'''
+
+        peak = self.peaks[task] * self.safety
+        threads = threads or self.threads
+
+        return "%dM" % int(math.ceil(peak / threads / 1e6))
+
+    def table(self):
+        '''The plan as text'''
+
+        lines = ["resource plan for %d genes x %d samples "
+                 "(max memory %.1fG):" % (self.n_genes, self.n_samples,
+                                          self.budget / 1e9),
+                 "  detection: %s" % self.detection]
+
+        if self.detection == "stepwise":
+            lines.append("  tree engine: %s" % self.tree_engine)
+        else:
+            lines.append("  block size: %d" % self.block_size)
+
+        lines.append("  threads: %d" % self.threads)
+
+        if not self.fits:
+            lines.append("  WARNING: the given settings do not fit in the "
+                         "max memory")
+
+        lines.append("  %-24s %12s %14s" % ("task", "peak memory",
+                                             "job_memory"))
+
+        for task in sorted(self.peaks):
+            lines.append("  %-24s %11.2fG %14s" % (task,
+                                                   self.peaks[task] / 1e9,
+                                                   self.job_memory(task)))
+
+        return "\n".join(lines)
+
+
+def plan(n_genes, n_samples, max_memory="64G", max_threads=12,
+         tile_size=2000, knn=None, safety=1.25, detection=None,
+         tree_engine=None, block_size=None, threads=None):
+    '''Choose the detection mode, tree engine, block size and threads
+       that fit in max_memory.
+
+       Stepwise detection is preferred (with R's hclust if the dissTOM
+       fits in memory, otherwise with the python tree engine) as it
+       gives a single network. Blockwise detection is chosen only when
+       neither fits, with the largest block size that does. The thread
+       count is reduced if the tiles of the python engines do not fit.
+
+       A detection, tree_engine, block_size or threads that is given is
+       kept as it is and only the others are chosen. If the given
+       settings do not fit in max_memory the plan is returned anyway
+       (with fits False) so that the memory of the tasks is still set.
+    '''
+
+    budget = cache.parse_size(max_memory)
+
+    def _fits(peaks):
+        return max(peaks.values()) * safety <= budget
+
+    def _plan(detection, tree_engine, block_size, threads, peaks):
+        return Plan(n_genes, n_samples, detection, tree_engine, block_size,
+                    threads, peaks, budget, safety, fits=_fits(peaks))
+
+    # blockwise detection (R) does not use the python tiles
+    block_threads = threads or max_threads
+
+    if threads is None:
+        threads = max_threads
+
+        while threads > 1 and not _fits(
+                predict(n_genes, n_samples, "stepwise", "python",
+                        tile_size=tile_size, threads=threads, knn=knn)):
+            threads -= 1
+
+    if detection in (None, "stepwise"):
+
+        if tree_engine is not None:
+            engines = [tree_engine]
+        else:
+            engines = ["python"] if knn else ["R", "python"]
+
+        for engine in engines:
+
+            peaks = predict(n_genes, n_samples, "stepwise", engine,
+                            tile_size=tile_size, threads=threads, knn=knn)
+
+            if _fits(peaks) or (detection == "stepwise"
+                                and engine == engines[-1]):
+                return _plan("stepwise", engine, None, threads, peaks)
+
+    if block_size is not None:
+        return _plan("blockwise", None, block_size, block_threads,
+                     predict(n_genes, n_samples, "blockwise",
+                             block_size=block_size, tile_size=tile_size,
+                             threads=block_threads))
+
+    # the largest block (in steps of 500 genes) that fits
+    block_size = n_genes
+
+    while block_size >= MIN_BLOCK_SIZE:
+
+        peaks = predict(n_genes, n_samples, "blockwise",
+                        block_size=block_size, tile_size=tile_size,
+                        threads=block_threads)
+
+        if _fits(peaks):
+            return _plan("blockwise", None, block_size, block_threads,
+                         peaks)
+
+        block_size = (block_size - 1) // 500 * 500
+
+    raise ValueError("%s is not enough memory for %d genes x %d samples"
+                     % (max_memory, n_genes, n_samples))
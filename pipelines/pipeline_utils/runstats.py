@@ -0,0 +1,189 @@
+'''A database of the run time and memory use of the pipeline tasks.
+
+Each statement run by a task is wrapped by python/wgcna_job_stats.py,
+which records the wall time, CPU time and largest process peak (the
+peak resident memory of the largest single process, not of the whole
+job) of the job (and the timings of any steps reported by the R
+scripts, see R/wgcna_timing.R) in a JSON file. After the job has
+finished, whether or not it succeeded, these are added to an SQLite
+database together with the size of the data and the parameters of the
+task:
+
+    tasks(run_dir, task, outfile, finished, wall_time, cpu_time,
+          max_rss, n_genes, n_samples, params, status)
+    steps(run_dir, task, outfile, finished, step, wall_time)
+
+The database can be shared between runs (projects are distinguished by
+their run directory) so that trends in the run times and memory use
+can be followed.
+'''
+
+import os
+import json
+import sqlite3
+import contextlib
+import datetime
+import pandas as pd
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    run_dir TEXT, task TEXT, outfile TEXT, finished TEXT,
+    wall_time REAL, cpu_time REAL, max_rss INTEGER,
+    n_genes INTEGER, n_samples INTEGER, params TEXT, status INTEGER);
+
+CREATE INDEX IF NOT EXISTS tasks_idx ON tasks (run_dir, task);
+
+CREATE TABLE IF NOT EXISTS steps (
+    run_dir TEXT, task TEXT, outfile TEXT, finished TEXT,
+    step TEXT, wall_time REAL);
+
+CREATE INDEX IF NOT EXISTS steps_idx ON steps (run_dir, task);
+'''
+
+# the environment variable through which the scripts find the file to
+# which their step timings are appended
+STEP_LOG = "WGCNA_STEP_LOG"
+
+
+def stats_path(outfile):
+    '''The JSON file in which the statistics of a job are written (kept
+       out of the task outputs, which are cached)'''
+
+    return os.path.join(os.path.dirname(outfile), ".runstats",
+                        os.path.basename(outfile) + ".json")
+
+
+def read_steps(path):
+    '''Read the (step, seconds) lines appended by the scripts'''
+
+    steps = []
+
+    if os.path.exists(path):
+        with open(path) as fh:
+            for line in fh:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 2:
+                    steps.append((fields[0], float(fields[1])))
+
+    return steps
+
+
+class RunDatabase(object):
+    '''An SQLite database of task statistics'''
+
+    def __init__(self, path):
+
+        self.path = path
+
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with self._connect() as con:
+            con.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        '''A connection that commits (or rolls back) and is closed when
+           the block ends'''
+
+        con = sqlite3.connect(self.path, timeout=600)
+
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def record(self, task, outfile, stats, run_dir=None,
+               n_genes=None, n_samples=None, params=None):
+        '''Add the statistics of a job (as written by
+           python/wgcna_job_stats.py)'''
+
+        run_dir = run_dir or os.getcwd()
+        finished = datetime.datetime.now().isoformat()
+
+        with self._connect() as con:
+
+            con.execute("INSERT INTO tasks VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                        (run_dir, task, outfile, finished,
+                         stats["wall_time"], stats["cpu_time"],
+                         stats["max_rss"], n_genes, n_samples,
+                         json.dumps(params or {}, sort_keys=True,
+                                    default=str),
+                         stats["status"]))
+
+            con.executemany("INSERT INTO steps VALUES (?,?,?,?,?,?)",
+                            ((run_dir, task, outfile, finished, step, seconds)
+                             for step, seconds in stats["steps"]))
+
+    def summary(self, run_dir=None):
+        '''Summarise the most recent job of each task output (and pass)
+           of a run directory by task'''
+
+        run_dir = run_dir or os.getcwd()
+
+        with self._connect() as con:
+            jobs = pd.read_sql_query(
+                "SELECT * FROM tasks WHERE run_dir=? ORDER BY finished",
+                con, params=(run_dir,))
+
+            steps = pd.read_sql_query(
+                "SELECT * FROM steps WHERE run_dir=? ORDER BY finished",
+                con, params=(run_dir,))
+
+        # the jobs of a task that makes one output in several passes
+        # (e.g. the two pdflatex runs of the report) are told apart by
+        # the "pass" recorded with their parameters
+        jobs["pass"] = [json.loads(x).get("pass") if x else None
+                        for x in jobs["params"]]
+
+        jobs = jobs.drop_duplicates(["task", "outfile", "pass"],
+                                    keep="last")
+
+        summary = jobs.groupby("task", sort=False).agg(
+            jobs=("outfile", "size"),
+            wall_time=("wall_time", "sum"),
+            max_wall_time=("wall_time", "max"),
+            cpu_time=("cpu_time", "sum"),
+            max_rss_gb=("max_rss", "max"),
+            n_genes=("n_genes", "max"),
+            n_samples=("n_samples", "max"))
+
+        summary["max_rss_gb"] = summary["max_rss_gb"] / 1e9
+
+        steps = steps.merge(jobs[["task", "outfile", "finished"]])
+        steps = steps.groupby(["task", "step"], sort=False)["wall_time"].sum()
+
+        return summary.reset_index(), steps.reset_index()
+
+    def write_latex(self, path, run_dir=None):
+        '''Write the summary as LaTeX tables'''
+
+        summary, steps = self.summary(run_dir)
+
+        with open(path, "w") as fh:
+
+            fh.write("\\begin{tabular}{lrrrrr}\n"
+                     "task & jobs & wall time (s) & max wall time (s) & "
+                     "CPU time (s) & largest process (GB) \\\\\n\\hline\n")
+
+            for row in summary.itertuples():
+                fh.write("%s & %d & %.1f & %.1f & %.1f & %.2f \\\\\n"
+                         % (row.task, row.jobs, row.wall_time,
+                            row.max_wall_time, row.cpu_time, row.max_rss_gb))
+
+            fh.write("\\end{tabular}\n")
+
+            if len(steps) > 0:
+                fh.write("\n\\vspace{1em}\n\n"
+                         "\\begin{tabular}{llr}\n"
+                         "task & step & wall time (s) \\\\\n\\hline\n")
+
+                for row in steps.itertuples():
+                    fh.write("%s & %s & %.1f \\\\\n"
+                             % (row.task, row.step, row.wall_time))
+
+                fh.write("\\end{tabular}\n")
+
+        return summary, steps
@@ -0,0 +1,96 @@
+'''Projection of new samples onto a frozen set of modules.
+
+A module set is frozen as the scaling of each gene and the loadings
+that project the scaled expression onto the module eigengenes (see
+eigengenes.loadings):
+
+    <prefix>.scaling.npy: (genes x 2) the mean and sd of each gene
+    <prefix>.loadings.npy: (genes x modules) the gene loadings
+
+New samples are scored one chunk of samples at a time with a single
+matrix product per chunk, so that expression matrices larger than
+memory can be scored from a memory-mapped (genes x samples) matrix.
+Missing values and genes that are missing from the new data are
+imputed by the mean of the gene, i.e. they contribute nothing.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from pipeline_utils import matrixio
+from pipeline_utils import network
+
+
+def save_model(prefix, mean, sd, weights, genes, modules):
+    '''Write the scaling and loadings of a module set'''
+
+    matrixio.write(prefix + ".scaling.npy", np.column_stack([mean, sd]),
+                   rownames=genes, colnames=["mean", "sd"])
+    matrixio.write(prefix + ".loadings.npy", weights,
+                   rownames=genes, colnames=["ME" + m for m in modules])
+
+
+class ModuleModel(object):
+    '''A frozen module set'''
+
+    def __init__(self, prefix):
+
+        scaling, genes, _ = matrixio.read(prefix + ".scaling.npy", mmap=False)
+        weights, _, names = matrixio.read(prefix + ".loadings.npy",
+                                          mmap=False)
+
+        self.genes = genes
+        self.eigengenes = names
+        self.mean = scaling[:, 0]
+        self.sd = scaling[:, 1]
+        self.loadings = weights
+
+    def align(self, genes):
+        '''Return the rows of the model genes in a matrix with the given
+           genes and the model genes that were found'''
+
+        index = {x: i for i, x in enumerate(genes)}
+
+        found = np.array([x in index for x in self.genes])
+        rows = np.array([index[x] for x, y in zip(self.genes, found) if y],
+                        dtype=np.int64)
+
+        return rows, found
+
+    def project(self, x):
+        '''Score the samples of x (samples x model genes)'''
+
+        x = np.array(x, dtype=np.float64)
+        x -= self.mean
+        x /= self.sd
+        np.nan_to_num(x, copy=False, nan=0.0)
+
+        return x @ self.loadings
+
+
+def score(model, x, genes, chunk_size=1000, threads=1):
+    '''Score the samples (columns) of the (genes x samples) matrix x,
+       one chunk of samples at a time. Yields (start, end, scores).'''
+
+    rows, found = model.align(genes)
+
+    n_samples = x.shape[1]
+
+    def _score(chunk):
+        start, end = chunk
+
+        block = np.full((end - start, len(model.genes)), np.nan)
+        block[:, found] = np.asarray(x[rows, start:end]).T
+
+        return start, end, model.project(block)
+
+    chunks = network.tiles(n_samples, chunk_size)
+
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for i in range(0, len(chunks), threads):
+                for result in pool.map(_score, chunks[i:i + threads]):
+                    yield result
+    else:
+        for chunk in chunks:
+            yield _score(chunk)
@@ -0,0 +1,151 @@
+'''Single-pass soft-power analysis.
+
+The gene-gene correlations are computed once, tile by tile (see
+network.py). For every candidate power the transformed tile is summed
+into the per-gene connectivity so that a finer grid of powers only
+costs an extra elementwise pass per power, not an extra correlation.
+
+The scale-free topology fit follows WGCNA::scaleFreeFitIndex so that
+the table matches the "fitIndices" returned by pickSoftThreshold.
+'''
+
+import numpy as np
+import pandas as pd
+
+from pipeline_utils import network
+
+
+def parse_powers(spec):
+    '''Parse a comma separated list of powers and from:to:by ranges,
+       e.g. "1:10,12:20:2" or "1:20:0.5".'''
+
+    powers = []
+
+    for item in str(spec).split(","):
+        item = item.strip()
+
+        if item == "":
+            continue
+
+        if ":" in item:
+            fields = [float(x) for x in item.split(":")]
+
+            if len(fields) == 2:
+                fields.append(1)
+
+            start, stop, step = fields
+
+            if step <= 0:
+                raise ValueError("power step must be positive: " + item)
+
+            powers += list(np.arange(start, stop + step / 2, step))
+
+        else:
+            powers.append(float(item))
+
+    powers = sorted(set(float(round(x, 6)) for x in powers))
+
+    if len(powers) == 0 or powers[0] <= 0:
+        raise ValueError("powers must be positive: " + str(spec))
+
+    return powers
+
+
+def connectivity_sweep(z, powers, network_type,
+                       tile_size=2000, threads=1):
+    '''Return a (n_powers x n_genes) array of connectivities computed
+       from a single pass over the correlation tiles of z.'''
+
+    n = z.shape[0]
+    k = np.zeros((len(powers), n))
+
+    def _sweep(tile):
+        start, end = tile
+
+        base = network.adjacency_rows(z, tile, network_type, 1)
+        block = np.empty_like(base)
+
+        for idx, power in enumerate(powers):
+            np.power(base, power, out=block)
+            k[idx, start:end] = block.sum(axis=1)
+
+    network.map_tiles(_sweep, network.tiles(n, tile_size), threads)
+
+    return k
+
+
+def _r_squared(x, y):
+    '''Least-squares fit of y on the columns of x (plus an intercept).
+       Returns the coefficients, R^2 and adjusted R^2.'''
+
+    design = np.column_stack([np.ones(len(y))] + list(x))
+
+    coef = np.linalg.lstsq(design, y, rcond=None)[0]
+
+    ss_res = np.sum((y - design @ coef) ** 2)
+    ss_tot = np.sum((y - y.mean()) ** 2)
+
+    r2 = 1 - ss_res / ss_tot if ss_tot > 0 else np.nan
+
+    n, p = len(y), design.shape[1] - 1
+    adj_r2 = 1 - (1 - r2) * (n - 1) / (n - p - 1) if n > p + 1 else np.nan
+
+    return coef, r2, adj_r2
+
+
+def scale_free_fit(k, n_breaks=10):
+    '''Scale-free topology fit of connectivities k as computed by
+       WGCNA::scaleFreeFitIndex. Returns (R^2, slope, truncated R^2).'''
+
+    k = np.asarray(k, dtype=np.float64)
+    kmin, kmax = k.min(), k.max()
+
+    # cut(k, n_breaks): equal width, right-closed bins over the
+    # range extended by 0.1% on each side.
+    dx = kmax - kmin if kmax > kmin else abs(kmin) if kmin != 0 else 1
+    edges = np.linspace(kmin, kmax, n_breaks + 1)
+    cut_edges = edges.copy()
+    cut_edges[0] -= dx / 1000
+    cut_edges[-1] += dx / 1000
+
+    bins = np.clip(np.searchsorted(cut_edges, k, side="left") - 1,
+                   0, n_breaks - 1)
+
+    counts = np.bincount(bins, minlength=n_breaks)
+    sums = np.bincount(bins, weights=k, minlength=n_breaks)
+
+    mids = (edges[:-1] + edges[1:]) / 2
+
+    dk = np.where(counts > 0, sums / np.maximum(counts, 1), mids)
+    dk = np.where(dk == 0, mids, dk)
+    p_dk = counts / len(k)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_dk = np.log10(dk)
+    log_p_dk = np.log10(p_dk + 1e-09)
+
+    ok = np.isfinite(log_dk)
+
+    coef, r2, _ = _r_squared([log_dk[ok]], log_p_dk[ok])
+    _, _, trunc_r2 = _r_squared([log_dk[ok], 10 ** log_dk[ok]], log_p_dk[ok])
+
+    return r2, coef[1], trunc_r2
+
+
+def fit_indices(k, powers, n_breaks=10):
+    '''Build the pickSoftThreshold style "fitIndices" table'''
+
+    rows = []
+
+    for idx, power in enumerate(powers):
+        r2, slope, trunc_r2 = scale_free_fit(k[idx], n_breaks)
+
+        rows.append({"Power": power,
+                     "SFT.R.sq": r2,
+                     "slope": slope,
+                     "truncated.R.sq": trunc_r2,
+                     "mean.k.": k[idx].mean(),
+                     "median.k.": np.median(k[idx]),
+                     "max.k.": k[idx].max()})
+
+    return pd.DataFrame(rows)
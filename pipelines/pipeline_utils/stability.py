@@ -0,0 +1,258 @@
+'''Bootstrap stability of the modules.
+
+In each replicate the samples of the clean expression data are drawn
+with replacement and the modules are detected again with the python
+engines of the stepwise module detection: the TOM is computed in tiles
+(network.compute_diss_tom_fused), the genes are clustered and the tree
+is cut on the memory-mapped dissTOM (treecut) and the close modules are
+merged (eigengenes). The replicates are run in a process pool, each
+with a few threads. The samples of a replicate are drawn from a random
+stream seeded by the seed and the number of the replicate, so the
+results do not depend on the number of processes.
+
+The modules of each replicate are compared with the modules found on all
+of the samples (the reference modules):
+
+    co_assignment (gene): the fraction of the other genes of its module
+        that are in the same replicate module as the gene
+    assigned (gene): whether the gene is in a replicate module (rather
+        than unassigned)
+    stability (module): the Jaccard index of the module and the
+        replicate module that matches it best
+
+each averaged over the replicates. The 5% quantile of the stability
+of each module is reported when there are at least 20 replicates.
+'''
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from pipeline_utils import eigengenes
+from pipeline_utils import matrixio
+from pipeline_utils import network
+from pipeline_utils import treecut
+
+
+UNASSIGNED = "grey"
+
+# the fewest replicates for which the 5% quantile of the stability is
+# reported (with fewer it is just the minimum)
+MIN_QUANTILE_REPLICATES = 20
+
+
+def bootstrap_samples(n_samples, seed, replicate):
+    '''The (sorted) indices of the samples drawn for a replicate'''
+
+    rng = np.random.default_rng([seed, replicate])
+
+    return np.sort(rng.integers(0, n_samples, n_samples))
+
+
+def detect_modules(datExpr, settings, work_prefix, tile_size=2000,
+                   threads=1):
+    '''Detect the modules of datExpr (samples x genes). settings holds the
+       soft_power, network_type, cor_fnc, tom_type, min_size, deepsplit
+       and diss_threshold. The dissTOM and the clustering working file
+       are written to (and removed from) work_prefix.*. Returns the
+       module of each gene as an integer, 0 for the unassigned genes.'''
+
+    z = network.standardise(datExpr, settings["cor_fnc"])
+    n = z.shape[0]
+
+    diss_file = work_prefix + ".dissTOM.tmp.npy"
+    condensed_file = work_prefix + ".condensed.tmp.npy"
+
+    try:
+        diss_tom = matrixio.create(diss_file, (n, n))
+
+        network.compute_diss_tom_fused(z, diss_tom,
+                                       network_type=settings["network_type"],
+                                       power=settings["soft_power"],
+                                       tom_type=settings["tom_type"],
+                                       tile_size=tile_size,
+                                       threads=threads)
+
+        condensed = treecut.condense(diss_tom, condensed_file,
+                                     tile_size=tile_size)
+        Z = treecut.average_linkage(condensed, n)
+        del condensed
+
+        merge, height, _ = treecut.to_hclust(Z)
+
+        labels = treecut.cutree_hybrid(diss_tom, merge, height,
+                                       min_cluster_size=settings["min_size"],
+                                       deep_split=settings["deepsplit"],
+                                       tile_size=tile_size)
+        del diss_tom
+
+    finally:
+        for path in [diss_file, condensed_file]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    colors = np.where(labels == 0, UNASSIGNED, labels.astype(str))
+
+    factors = eigengenes.module_factors(datExpr, colors, threads=threads)
+
+    merged, _ = eigengenes.merge_close_modules(
+        factors, colors,
+        cut_height=settings["diss_threshold"],
+        cor_fnc=settings["cor_fnc"],
+        unassigned=UNASSIGNED)
+
+    modules = np.unique(merged[merged != UNASSIGNED])
+
+    codes = np.zeros(len(merged), dtype=np.int32)
+    for i, module in enumerate(modules):
+        codes[merged == module] = i + 1
+
+    return codes
+
+
+# the clean data and the settings of the replicates of a worker process
+_WORKER = {}
+
+
+def _init_worker(clean_data, settings, work_dir, seed, tile_size, threads):
+
+    _WORKER.update(datExpr=matrixio.read(clean_data)[0],
+                   settings=settings, work_dir=work_dir, seed=seed,
+                   tile_size=tile_size, threads=threads)
+
+
+def _replicate(replicate):
+
+    datExpr = _WORKER["datExpr"]
+
+    samples = bootstrap_samples(datExpr.shape[0], _WORKER["seed"], replicate)
+
+    return detect_modules(np.asarray(datExpr[samples], dtype=np.float64),
+                          _WORKER["settings"],
+                          os.path.join(_WORKER["work_dir"],
+                                       "replicate.%d" % replicate),
+                          tile_size=_WORKER["tile_size"],
+                          threads=_WORKER["threads"])
+
+
+def bootstrap(clean_data, settings, replicates, work_dir, seed=1,
+              workers=1, threads=1, tile_size=2000):
+    '''Detect the modules of bootstrap replicates of the clean data (a
+       .npy file, read by each worker once) in a pool of worker
+       processes. Yields the (replicate, labels) as they complete, in
+       order.'''
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(clean_data, settings, work_dir, seed,
+                                       tile_size, threads)) as pool:
+
+        for replicate, labels in enumerate(pool.map(_replicate,
+                                                    range(replicates))):
+            yield replicate, labels
+
+
+def compare(reference, labels):
+    '''Compare the reference module colors of the genes with the module
+       labels of a replicate (0: unassigned). Returns the co-assignment
+       of each gene (NaN for the unassigned reference genes) and the
+       Jaccard index of each reference module (sorted) with its best
+       matching replicate module.'''
+
+    reference = np.asarray(reference)
+    labels = np.asarray(labels)
+
+    modules = np.unique(reference[reference != UNASSIGNED])
+
+    sizes = np.bincount(labels)
+
+    co_assignment = np.full(len(labels), np.nan)
+    jaccard = np.zeros(len(modules))
+
+    for i, module in enumerate(modules):
+
+        genes = np.flatnonzero(reference == module)
+        module_labels = labels[genes]
+
+        # the number of genes of the module in each replicate module
+        counts = np.bincount(module_labels, minlength=len(sizes))
+        counts[0] = 0
+
+        others = counts[module_labels] - (module_labels != 0)
+        co_assignment[genes] = others / max(len(genes) - 1, 1)
+
+        if len(sizes) > 1:
+            union = len(genes) + sizes[1:] - counts[1:]
+            jaccard[i] = (counts[1:] / union).max()
+
+    return co_assignment, jaccard
+
+
+def summarise(reference, genes, replicate_labels):
+    '''Tabulate the stability of the genes and of the modules over the
+       replicates (replicate_labels: genes x replicates)'''
+
+    reference = np.asarray(reference)
+    replicate_labels = np.asarray(replicate_labels)
+
+    modules = np.unique(reference[reference != UNASSIGNED])
+
+    n_replicates = replicate_labels.shape[1]
+
+    co_assignment = np.zeros(len(reference))
+    jaccard = np.zeros((len(modules), n_replicates))
+
+    for r in range(n_replicates):
+        gene_scores, jaccard[:, r] = compare(reference,
+                                             replicate_labels[:, r])
+        co_assignment += gene_scores
+
+    co_assignment /= n_replicates
+
+    if n_replicates >= MIN_QUANTILE_REPLICATES:
+        stability_q05 = np.quantile(jaccard, 0.05, axis=1)
+    else:
+        stability_q05 = np.full(len(modules), np.nan)
+
+    gene_table = pd.DataFrame(
+        {"gene": genes,
+         "module": reference,
+         "co_assignment": co_assignment,
+         "assigned": (replicate_labels != 0).mean(axis=1)})
+
+    module_genes = gene_table[gene_table["module"] != UNASSIGNED]
+    by_module = module_genes.groupby("module")
+
+    module_table = pd.DataFrame(
+        {"module": modules,
+         "n_genes": by_module.size().loc[modules].values,
+         "stability": jaccard.mean(axis=1),
+         "stability_q05": stability_q05,
+         "co_assignment": by_module["co_assignment"].mean()
+                                                    .loc[modules].values,
+         "assigned": by_module["assigned"].mean().loc[modules].values})
+
+    module_table = module_table.sort_values("stability", ascending=False)
+
+    return gene_table, module_table
+
+
+def write_latex(module_table, path):
+    '''Write the module stability table as a LaTeX longtable'''
+
+    with open(path, "w") as fh:
+
+        fh.write("\\begin{longtable}{lrrrrr}\n"
+                 "module & genes & stability & stability (5\\%) & "
+                 "co-assignment & assigned \\\\\n\\hline\n\\endhead\n")
+
+        for row in module_table.itertuples():
+            q05 = ("--" if np.isnan(row.stability_q05)
+                   else "%.3f" % row.stability_q05)
+
+            fh.write("%s & %d & %.3f & %s & %.3f & %.3f \\\\\n"
+                     % (row.module, row.n_genes, row.stability, q05,
+                        row.co_assignment, row.assigned))
+
+        fh.write("\\end{longtable}\n")
@@ -0,0 +1,129 @@
+'''Expansion of a module detection parameter grid.
+
+The sweep section of the pipeline.yml gives comma separated lists of
+values for the network (soft power, TOM type) and module detection
+(deepsplit, minimum module size, eigengene dissimilarity threshold)
+parameters. Every combination is run, but the TOM is only computed once
+for each distinct (soft power, TOM type) pair and the module detection
+jobs fan out from it.
+'''
+
+import os
+import itertools
+import numpy as np
+import pandas as pd
+
+from pipeline_utils import matrixio
+
+
+# sweep parameter -> (pipeline parameter, directory label)
+NETWORK_PARAMS = [("soft_power", "module_soft_power", "power"),
+                  ("tom_type", "module_tom_type", "tom")]
+
+DETECTION_PARAMS = [("deepsplit", "module_deepsplit", "ds"),
+                    ("min_size", "module_min_size", "ms"),
+                    ("diss_threshold", "module_diss_threshold", "dt")]
+
+
+def _convert(value):
+    '''Convert a string value to an int or float where possible'''
+
+    value = value.strip()
+
+    for type_fnc in (int, float):
+        try:
+            return type_fnc(value)
+        except ValueError:
+            pass
+
+    return value
+
+
+def parse_values(value, default):
+    '''Parse a comma separated list of values. When the value is not set
+       the default (the value from the module section) is used.'''
+
+    if value is None or str(value).strip() == "":
+        return [default]
+
+    if isinstance(value, str):
+        return [_convert(x) for x in value.split(",")]
+
+    return [value]
+
+
+def is_active(params):
+    '''True if any of the sweep parameters has been set'''
+
+    return any(params.get("sweep_" + x) not in (None, "")
+               for x, _, _ in NETWORK_PARAMS + DETECTION_PARAMS)
+
+
+def _label(settings, spec):
+    return ".".join("%s.%s" % (label, settings[param])
+                    for _, param, label in spec)
+
+
+def _expand(params, spec):
+    '''Return a list of parameter dictionaries, one per combination'''
+
+    values = [parse_values(params.get("sweep_" + name), params[param])
+              for name, param, _ in spec]
+
+    return [dict(zip([x[1] for x in spec], combination))
+            for combination in itertools.product(*values)]
+
+
+def networks(params, sweep_dir):
+    '''The distinct networks of the sweep as (directory, settings)'''
+
+    return [(os.path.join(sweep_dir, _label(x, NETWORK_PARAMS)), x)
+            for x in _expand(params, NETWORK_PARAMS)]
+
+
+def detections(params, sweep_dir):
+    '''All the module detection runs of the sweep as
+       (network directory, detection directory, settings)'''
+
+    runs = []
+    for network_dir, network in networks(params, sweep_dir):
+        for detection in _expand(params, DETECTION_PARAMS):
+
+            settings = dict(network, **detection)
+            runs.append((network_dir,
+                         os.path.join(network_dir,
+                                      _label(detection, DETECTION_PARAMS)),
+                         settings))
+
+    return runs
+
+
+def summarise(module_prefixes, settings):
+    '''Tabulate the number and the sizes of the modules found by each run
+       of the sweep.
+
+       The unassigned ("grey") genes are counted separately and are not
+       included in the module statistics.
+    '''
+
+    rows = []
+    for prefix, run_settings in zip(module_prefixes, settings):
+
+        colors, _ = matrixio.read_labels(prefix + ".colors.npy")
+        modules, sizes = np.unique(colors[colors != "grey"],
+                                   return_counts=True)
+        sizes = np.sort(sizes)[::-1]
+
+        row = {x[1]: run_settings[x[1]]
+               for x in NETWORK_PARAMS + DETECTION_PARAMS}
+
+        row.update({"n_modules": len(modules),
+                    "n_unassigned": int((colors == "grey").sum()),
+                    "min_module_size": sizes.min() if len(sizes) else 0,
+                    "median_module_size": np.median(sizes) if len(sizes) else 0,
+                    "max_module_size": sizes.max() if len(sizes) else 0,
+                    "module_sizes": ",".join(str(x) for x in sizes),
+                    "path": os.path.dirname(prefix)})
+        rows.append(row)
+
+    return pd.DataFrame(rows)
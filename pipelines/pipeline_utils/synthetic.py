@@ -0,0 +1,252 @@
+'''Seeded synthetic expression data with planted modules, traits and
+genesets, for benchmarking the pipeline.
+
+Each module m has a hidden factor z_m (one value per sample) and the
+expression of a gene g in module m is
+
+    x_g = mean_g + sd_g * (a_g * z_m + sqrt(1 - a_g^2) * e_g)
+
+with a loading a_g drawn from "loading" and independent noise e_g, so
+that the genes of a module are correlated with each other (about
+a_g * a_h) and not with the genes of other modules. The remaining
+genes are noise (the "grey" module). Each trait is correlated with the
+factor of one module, and each module has a geneset that contains some
+of its genes (plus random genes) amongst a number of random genesets.
+
+The noise of each block of NOISE_BLOCK genes is drawn from its own
+seeded stream, so that the data can be generated (and written) a few
+genes at a time for matrices larger than memory, and the same seed
+always gives the same data.
+'''
+
+import gzip
+import os
+import numpy as np
+import pandas as pd
+
+from pipeline_utils import matrixio
+
+
+UNASSIGNED = "grey"
+
+# the number of genes whose noise is drawn from each seeded stream
+NOISE_BLOCK = 1000
+
+
+class Synthetic(object):
+    '''A synthetic data set of n_genes x n_samples'''
+
+    def __init__(self, n_genes, n_samples, n_modules=None,
+                 module_fraction=0.6, min_module_size=50,
+                 loading=(0.6, 0.95), n_traits=None, trait_cor=0.7,
+                 n_genesets=100, missing=0.0, seed=1):
+
+        rng = np.random.default_rng(seed)
+
+        self.seed = seed
+        self.n_genes = n_genes
+        self.n_samples = n_samples
+        self.missing = missing
+
+        if n_modules is None:
+            n_modules = int(np.clip(n_genes // 250, 4, 60))
+
+        n_assigned = int(n_genes * module_fraction)
+
+        if n_modules * min_module_size > n_assigned:
+            raise ValueError("%d genes cannot hold %d modules of at least "
+                             "%d genes" % (n_genes, n_modules,
+                                           min_module_size))
+
+        self.genes = ["ENSG%011d" % (i + 1) for i in range(n_genes)]
+        self.samples = ["S%05d" % (i + 1) for i in range(n_samples)]
+        self.modules = ["M%02d" % (i + 1) for i in range(n_modules)]
+
+        # module sizes: the minimum plus an uneven share of the rest
+        extra = rng.multinomial(n_assigned - n_modules * min_module_size,
+                                rng.dirichlet(np.ones(n_modules)))
+        sizes = min_module_size + extra
+
+        labels = np.repeat(np.arange(n_modules), sizes)
+        labels = np.concatenate([labels,
+                                 np.full(n_genes - n_assigned, -1)])
+        self.labels = rng.permutation(labels)
+
+        self.colors = np.array([self.modules[i] if i >= 0 else UNASSIGNED
+                                for i in self.labels])
+
+        self.loadings = np.where(self.labels >= 0,
+                                 rng.uniform(loading[0], loading[1],
+                                             n_genes), 0.0)
+        self.mean = rng.normal(8, 2, n_genes)
+        self.sd = rng.uniform(0.5, 2, n_genes)
+
+        # (modules x samples) hidden factors
+        self.factors = rng.standard_normal((n_modules, n_samples))
+
+        if n_traits is None:
+            n_traits = min(n_modules, 5)
+
+        self.trait_modules = [self.modules[i] for i in range(n_traits)]
+
+        traits = (trait_cor * self.factors[:n_traits]
+                  + np.sqrt(1 - trait_cor ** 2)
+                  * rng.standard_normal((n_traits, n_samples)))
+
+        self.traits = pd.DataFrame(traits.T,
+                                   columns=["trait_%s" % m
+                                            for m in self.trait_modules])
+        self.traits.insert(0, "sample_name", self.samples)
+
+        self.genesets = self._genesets(rng, n_genesets)
+
+    def _genesets(self, rng, n_genesets):
+        '''A geneset for each module (half of its genes plus as many
+           random genes) and n_genesets random genesets, of entrez ids'''
+
+        entrez = np.arange(1, self.n_genes + 1)
+        genesets = []
+
+        for i, module in enumerate(self.modules):
+            members = entrez[self.labels == i]
+            members = rng.choice(members, len(members) // 2, replace=False)
+            others = rng.choice(entrez, len(members), replace=False)
+
+            genesets.append(("SYNTHETIC_%s" % module,
+                             "planted geneset of module %s" % module,
+                             np.union1d(members, others)))
+
+        for i in range(n_genesets):
+            genesets.append(("RANDOM_%04d" % (i + 1),
+                             "random geneset %d" % (i + 1),
+                             np.sort(rng.choice(entrez,
+                                                rng.integers(15, 200),
+                                                replace=False))))
+
+        return genesets
+
+    def expression(self, start, end):
+        '''The (genes x samples) expression of genes start to end'''
+
+        block_size = NOISE_BLOCK
+
+        x = np.empty((end - start, self.n_samples))
+
+        for block in range(start // block_size,
+                           (end - 1) // block_size + 1):
+
+            lo = max(start, block * block_size)
+            hi = min(end, (block + 1) * block_size)
+
+            rng = np.random.default_rng([self.seed, block])
+
+            noise = rng.standard_normal((block_size, self.n_samples))
+            missing = rng.random((block_size, self.n_samples)) < self.missing
+
+            rows = slice(lo - block * block_size, hi - block * block_size)
+            genes = slice(lo, hi)
+
+            a = self.loadings[genes, None]
+            z = self.factors[np.clip(self.labels[genes], 0, None)]
+
+            y = a * z + np.sqrt(1 - a ** 2) * noise[rows]
+            y = self.mean[genes, None] + self.sd[genes, None] * y
+            y[missing[rows]] = np.nan
+
+            x[lo - start:hi - start] = y
+
+        return x
+
+    def write(self, outdir, block_size=1000):
+        '''Write the data set to outdir:
+
+             expression.tsv: the input expression data (gene_id column)
+             clean.datExpr.npy: the (samples x genes) data, as cleanData
+             traits.tsv: the trait data (sample_name column)
+             genesets.gmt: the genesets (entrez ids)
+             ensembl.to.entrez.tsv.gz: the gene annotation
+             truth.tsv: the planted module of each gene
+
+           Returns a dict of the paths.
+        '''
+
+        os.makedirs(outdir, exist_ok=True)
+
+        paths = {x: os.path.join(outdir, y) for x, y in [
+            ("expression", "expression.tsv"),
+            ("datExpr", "clean.datExpr.npy"),
+            ("traits", "traits.tsv"),
+            ("genesets", "genesets.gmt"),
+            ("annotation", "ensembl.to.entrez.tsv.gz"),
+            ("truth", "truth.tsv")]}
+
+        datExpr = matrixio.create(paths["datExpr"],
+                                  (self.n_samples, self.n_genes),
+                                  rownames=self.samples,
+                                  colnames=self.genes)
+
+        with open(paths["expression"], "w") as fh:
+
+            fh.write("\t".join(["gene_id"] + self.samples) + "\n")
+
+            for start in range(0, self.n_genes, block_size):
+                end = min(start + block_size, self.n_genes)
+
+                x = self.expression(start, end)
+                datExpr[:, start:end] = x.T
+
+                pd.DataFrame(x, index=self.genes[start:end]).to_csv(
+                    fh, sep="\t", header=False, na_rep="NA",
+                    float_format="%.5f")
+
+        datExpr.flush()
+        del datExpr
+
+        self.traits.to_csv(paths["traits"], sep="\t", index=False,
+                           float_format="%.5f")
+
+        with open(paths["genesets"], "w") as fh:
+            for name, description, members in self.genesets:
+                fh.write("\t".join([name, description]
+                                   + [str(x) for x in members]) + "\n")
+
+        annotation = pd.DataFrame({"ensembl_id": self.genes,
+                                   "entrez_id": np.arange(1,
+                                                          self.n_genes + 1),
+                                   "gene_name": ["SYN%d" % (i + 1) for i
+                                                 in range(self.n_genes)]})
+
+        with gzip.open(paths["annotation"], "wt") as fh:
+            annotation.to_csv(fh, sep="\t", index=False)
+
+        pd.DataFrame({"gene_id": self.genes,
+                      "module": self.colors}).to_csv(paths["truth"],
+                                                     sep="\t", index=False)
+
+        return paths
+
+
+def adjusted_rand_index(a, b):
+    '''The adjusted Rand index of two labelings of the same items'''
+
+    _, a = np.unique(np.asarray(a), return_inverse=True)
+    _, b = np.unique(np.asarray(b), return_inverse=True)
+
+    table = np.zeros((a.max() + 1, b.max() + 1))
+    np.add.at(table, (a, b), 1)
+
+    def _pairs(x):
+        return np.sum(x * (x - 1) / 2)
+
+    n = _pairs(np.array([len(a)], dtype=np.float64))
+    index = _pairs(table)
+    rows = _pairs(table.sum(axis=1))
+    cols = _pairs(table.sum(axis=0))
+
+    expected = rows * cols / n
+    maximum = (rows + cols) / 2
+
+    if maximum == expected:
+        return 1.0
+
+    return (index - expected) / (maximum - expected)
@@ -0,0 +1,589 @@
+'''Gene clustering and dynamic tree cutting on a memory-mapped dissTOM.
+
+The average linkage clustering is computed with the nearest-neighbour
+chain algorithm on a condensed (upper triangle) float32 copy of the
+dissTOM held in a memory-mapped working file, which is updated in
+place as clusters are merged. The working copy needs a quarter of the
+memory of the full float64 matrix and nothing else of size n x n is
+allocated.
+
+The tree is cut with the hybrid method of the dynamicTreeCut package
+(cutreeDynamic(method="hybrid", pamRespectsDendro=FALSE) as called by
+R/wgcna_detect_modules.R). Only the rows of the dissTOM that are needed
+for the branch core scatters and for the PAM stage are read from disk.
+
+A sparse (k-nearest-neighbour) TOM is clustered by exact average
+linkage under the assumption that the TOM of genes that are not
+neighbours is 0 (sparse_average_linkage). The link sums are held per
+cluster so that memory is linear in the number of edges.
+
+The tree is returned in the format of R's hclust object (merge matrix,
+heights and leaf order) so that it can be plotted by the R stages.
+'''
+
+import numpy as np
+
+from pipeline_utils import matrixio
+from pipeline_utils import network
+
+
+# the dynamicTreeCut defaults for deepSplit = 0, 1, 2, 3, 4
+DEFAULT_MAX_CORE_SCATTER = np.array([0.64, 0.73, 0.82, 0.91, 0.95])
+
+DEFAULT_MIN_GAP = (1 - DEFAULT_MAX_CORE_SCATTER) * 3 / 4
+
+
+def _offsets(n):
+    '''The condensed index of element (i, 0) for each row i, such that
+       (i, j) with i < j is found at offsets[i] + j'''
+
+    i = np.arange(n, dtype=np.int64)
+
+    return i * (2 * n - i - 3) // 2 - 1
+
+
+def condense(dist, path, tile_size=2000):
+    '''Write the upper triangle of the square (memory-mapped) matrix
+       dist to a condensed float32 .npy file, a tile of rows at a time.
+       Returns the (writable) memory-mapped condensed matrix.'''
+
+    n = dist.shape[0]
+    offsets = _offsets(n)
+
+    condensed = matrixio.create(path, (n * (n - 1) // 2,), dtype=np.float32)
+
+    for start, end in network.tiles(n, tile_size):
+
+        block = np.asarray(dist[start:end])
+
+        for i in range(start, min(end, n - 1)):
+            condensed[offsets[i] + i + 1:offsets[i] + n] = block[i - start,
+                                                                 i + 1:]
+
+    return condensed
+
+
+def _nn_chain(condensed, n):
+    '''Average linkage by the nearest-neighbour chain algorithm.
+
+       condensed is overwritten. Returns the merges as (x, y, height)
+       in the order in which they were made, where x and y are the
+       indices of the first members of the merged clusters.
+    '''
+
+    offsets = _offsets(n)
+    size = np.ones(n, dtype=np.int64)
+
+    active = np.arange(n, dtype=np.int64)
+    chain = []
+    merges = []
+
+    def _index(i, others):
+        lo = np.minimum(i, others)
+        return offsets[lo] + np.maximum(i, others)
+
+    for _ in range(n - 1):
+
+        if len(chain) == 0:
+            chain = [int(active[0])]
+
+        while True:
+
+            x = chain[-1]
+            others = active[active != x]
+            d = condensed[_index(x, others)]
+
+            nearest = int(np.argmin(d))
+            y = int(others[nearest])
+
+            # ties are resolved in favour of the previous chain element
+            if len(chain) > 1:
+                previous = chain[-2]
+                if d[nearest] >= condensed[_index(x, previous)]:
+                    y = previous
+                    height = float(d[nearest])
+                    break
+
+            chain.append(y)
+
+        chain = chain[:-2]
+        x, y = min(x, y), max(x, y)
+
+        merges.append((x, y, height))
+
+        # Lance-Williams update for average linkage, the new cluster
+        # takes the place of y
+        others = active[(active != x) & (active != y)]
+        if len(others) > 0:
+            ix = _index(x, others)
+            iy = _index(y, others)
+            condensed[iy] = ((size[x] * condensed[ix].astype(np.float64)
+                              + size[y] * condensed[iy].astype(np.float64))
+                             / (size[x] + size[y]))
+
+        size[y] += size[x]
+        size[x] = 0
+        active = active[active != x]
+
+    return merges
+
+
+def _label(merges, n):
+    '''Sort the merges by height and number the clusters as in
+       scipy.cluster.hierarchy.linkage (clusters formed by the k-th merge
+       are numbered n + k)'''
+
+    order = np.argsort([x[2] for x in merges], kind="stable")
+
+    parent = np.arange(2 * n - 1)
+    # the cluster number of the set whose root is i
+    number = np.arange(2 * n - 1)
+
+    def _find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    Z = np.zeros((n - 1, 4))
+
+    for k, m in enumerate(order):
+
+        x, y, height = merges[m]
+        rx, ry = _find(x), _find(y)
+
+        Z[k] = [min(number[rx], number[ry]), max(number[rx], number[ry]),
+                height, 0]
+
+        parent[rx] = ry
+        number[ry] = n + k
+
+    sizes = np.ones(2 * n - 1)
+    for k in range(n - 1):
+        sizes[n + k] = sizes[int(Z[k, 0])] + sizes[int(Z[k, 1])]
+    Z[:, 3] = sizes[n:]
+
+    return Z
+
+
+def average_linkage(condensed, n):
+    '''Average linkage clustering of a condensed dissimilarity matrix
+       (which is overwritten). Returns a scipy format linkage matrix.'''
+
+    return _label(_nn_chain(condensed, n), n)
+
+
+def sparse_average_linkage(tom):
+    '''Average linkage clustering on 1 - TOM of a sparse (CSR) TOM.
+
+       The average dissimilarity of two clusters is 1 - S / (n_a * n_b)
+       where S is the sum of the TOM over the pairs of their genes, so
+       only the link sums of the clusters that share an edge need to be
+       kept. The nearest-neighbour chain only has to scan the links of
+       the cluster at its end. Clusters that share no edge are joined at
+       a height of 1 at the end. Returns a scipy format linkage matrix.
+    '''
+
+    n = tom.shape[0]
+    tom = tom.tocsr()
+
+    size = np.ones(n, dtype=np.int64)
+    links = [{} for _ in range(n)]
+
+    # the TOM is symmetric, so each row holds the links of a gene
+    for i in range(n):
+        row = slice(tom.indptr[i], tom.indptr[i + 1])
+        for j, value in zip(tom.indices[row].tolist(), tom.data[row].tolist()):
+            if i != j and value > 0:
+                links[i][j] = value
+
+    def _distance(x, c):
+        return 1 - links[x][c] / (size[x] * size[c])
+
+    active = np.ones(n, dtype=bool)
+    merges = []
+    chain = []
+    start = 0
+
+    while True:
+
+        if len(chain) == 0:
+            # clusters without links never gain any
+            while start < n and not (active[start] and links[start]):
+                start += 1
+            if start == n:
+                break
+            chain = [start]
+
+        x = chain[-1]
+
+        height, y = min((_distance(x, c), c) for c in links[x])
+
+        # ties are resolved in favour of the previous chain element
+        if len(chain) > 1 and _distance(x, chain[-2]) <= height:
+
+            y = chain[-2]
+            height = _distance(x, y)
+            chain = chain[:-2]
+
+            merges.append((x, y, height))
+
+            # merge the smaller link map into the larger
+            if len(links[x]) > len(links[y]):
+                x, y = y, x
+
+            del links[x][y]
+            del links[y][x]
+
+            for c, value in links[x].items():
+                links[y][c] = links[y].get(c, 0) + value
+                links[c][y] = links[y][c]
+                del links[c][x]
+
+            links[x] = {}
+            size[y] += size[x]
+            active[x] = False
+
+        else:
+            chain.append(y)
+
+    # the unconnected clusters
+    remaining = np.flatnonzero(active)
+    for x in remaining[1:]:
+        merges.append((remaining[0], x, 1.0))
+
+    return _label(merges, n)
+
+
+def to_hclust(Z):
+    '''Convert a scipy linkage matrix to the merge matrix, heights and
+       (1-based) leaf order of an R hclust object, following the
+       conventions of hclust: singletons are negative and come first,
+       the lower numbered element of a pair comes first.'''
+
+    n = Z.shape[0] + 1
+
+    a = Z[:, 0].astype(np.int64)
+    b = Z[:, 1].astype(np.int64)
+
+    a = np.where(a < n, -(a + 1), a - n + 1)
+    b = np.where(b < n, -(b + 1), b - n + 1)
+
+    both_singletons = (a < 0) & (b < 0)
+    first = np.where(both_singletons, np.maximum(a, b), np.minimum(a, b))
+    second = np.where(both_singletons, np.minimum(a, b), np.maximum(a, b))
+
+    merge = np.column_stack([first, second]).astype(np.int32)
+
+    # the leaf order is a depth first traversal, first element on the left
+    order = []
+    stack = [n - 1]
+    while stack:
+        node = stack.pop()
+        if node < 0:
+            order.append(-node)
+        else:
+            stack.append(merge[node - 1, 1])
+            stack.append(merge[node - 1, 0])
+
+    return merge, Z[:, 2].copy(), np.array(order, dtype=np.int32)
+
+
+def _core_size(branch_size, min_cluster_size):
+    '''The number of genes in the core of a branch (as dynamicTreeCut)'''
+
+    base = min_cluster_size / 2 + 1
+
+    if base < branch_size:
+        return int(base + np.sqrt(branch_size - base))
+
+    return branch_size
+
+
+def _interpolate(values, index):
+    '''Interpolate the deepSplit defaults'''
+
+    i = int(np.floor(index))
+
+    if i >= len(values) - 1:
+        return values[-1]
+
+    if i < 0:
+        return values[0]
+
+    return values[i] + (index - i) * (values[i + 1] - values[i])
+
+
+class SparseDissimilarity(object):
+    '''1 - TOM of a sparse TOM, for cutree_hybrid. The genes that are
+       not neighbours have a dissimilarity of 1.'''
+
+    def __init__(self, tom):
+
+        self.tom = tom.tocsr()
+        self.shape = tom.shape
+
+    def block(self, rows, cols):
+        '''The dense block of the dissimilarity for rows x cols'''
+
+        block = 1 - self.tom[rows][:, cols].toarray()
+        block[rows[:, None] == cols[None, :]] = 0
+
+        return block
+
+    def weighted_sums(self, rows, cols, weights):
+        '''block(rows, cols) @ weights without forming the block'''
+
+        sums = (weights.sum(axis=0)[None, :]
+                - self.tom[rows][:, cols] @ weights)
+
+        # the dissimilarity of a gene to itself is 0 rather than 1
+        pos = np.searchsorted(cols, rows)
+        pos = np.clip(pos, 0, len(cols) - 1)
+        self_pairs = np.flatnonzero(cols[pos] == rows)
+        sums[self_pairs] -= weights[pos[self_pairs]]
+
+        return sums
+
+
+def _block(dist, rows, cols):
+    '''dist[rows, cols] (rows and cols sorted), reading only the given
+       rows'''
+
+    if isinstance(dist, SparseDissimilarity):
+        return dist.block(rows, cols)
+
+    return np.asarray(dist[rows])[:, cols]
+
+
+def _weighted_sums(dist, rows, cols, weights):
+    '''dist[rows, cols] @ weights (rows and cols sorted)'''
+
+    if isinstance(dist, SparseDissimilarity):
+        return dist.weighted_sums(rows, cols, weights)
+
+    return _block(dist, rows, cols) @ weights
+
+
+def cutree_hybrid(dist, merge, height, min_cluster_size=20, deep_split=1,
+                  cut_height=None, pam_stage=True, respect_small_clusters=True,
+                  tile_size=2000):
+    '''Cut a tree with the dynamic hybrid method.
+
+       dist is the (memory-mapped) square dissimilarity matrix or a
+       SparseDissimilarity, merge and height describe the tree as
+       returned by to_hclust(). Returns the
+       module labels, 0 for unassigned genes and 1, 2, .. for the modules
+       in order of decreasing size.
+    '''
+
+    n_merge = len(height)
+    n_points = n_merge + 1
+
+    ref_merge = max(int(np.round(n_merge * 0.05)), 1)
+    ref_height = height[ref_merge - 1]
+
+    if cut_height is None:
+        cut_height = 0.99 * (height.max() - ref_height) + ref_height
+    else:
+        cut_height = min(cut_height, height.max())
+
+    max_pam_dist = cut_height
+
+    labels = np.zeros(n_points, dtype=np.int32)
+
+    if np.sum(height <= cut_height) < min_cluster_size:
+        return labels
+
+    max_core_scatter = _interpolate(DEFAULT_MAX_CORE_SCATTER, deep_split)
+    min_gap = _interpolate(DEFAULT_MIN_GAP, deep_split)
+
+    max_abs_core_scatter = ref_height + max_core_scatter * (cut_height
+                                                            - ref_height)
+    min_abs_gap = min_gap * (cut_height - ref_height)
+    min_abs_split_height = ref_height
+
+    # the branches
+    is_basic, is_top_basic, fail_size = [], [], []
+    size, attach_height, singletons, basic_clusters = [], [], [], []
+
+    scatter_cache = {}
+
+    def _core_scatter(branch):
+        core_size = _core_size(len(singletons[branch]), min_cluster_size)
+        cache_key = (branch, core_size)
+
+        if cache_key not in scatter_cache:
+            core = np.sort(singletons[branch][:core_size])
+            block = _block(dist, core, core)
+            scatter_cache[cache_key] = block.sum() / (core_size
+                                                      * (core_size - 1))
+
+        return scatter_cache[cache_key]
+
+    def _new_branch(basic, genes, branch_size, clusters):
+        is_basic.append(basic)
+        is_top_basic.append(basic)
+        fail_size.append(False)
+        size.append(branch_size)
+        attach_height.append(np.nan)
+        singletons.append(genes)
+        basic_clusters.append(clusters)
+        return len(is_basic) - 1
+
+    merge_to_branch = np.full(n_merge, -1, dtype=np.int64)
+
+    for step in range(n_merge):
+
+        h = height[step]
+        if h > cut_height:
+            continue
+
+        a, b = int(merge[step, 0]), int(merge[step, 1])
+
+        if a < 0 and b < 0:
+            # two genes start a new basic branch
+            branch = _new_branch(True, [-a - 1, -b - 1], 2, [])
+            basic_clusters[branch] = [branch]
+            merge_to_branch[step] = branch
+
+        elif a < 0 or b < 0:
+            # a gene joins a branch
+            branch = merge_to_branch[max(a, b) - 1]
+            if is_basic[branch]:
+                singletons[branch].append(-min(a, b) - 1)
+            size[branch] += 1
+            merge_to_branch[step] = branch
+
+        else:
+            # two branches meet
+            branches = [merge_to_branch[a - 1], merge_to_branch[b - 1]]
+            if size[branches[1]] < size[branches[0]]:
+                branches = branches[::-1]
+            small, large = branches
+
+            def _fails(branch):
+                if not is_basic[branch]:
+                    return False, False
+                scatter = _core_scatter(branch)
+                too_scattered = scatter > max_abs_core_scatter
+                no_gap = h - scatter < min_abs_gap
+                return (size[branch] < min_cluster_size or too_scattered
+                        or no_gap or h < min_abs_split_height,
+                        not (too_scattered or no_gap))
+
+            do_merge, small_fails_size = _fails(small)
+
+            if not do_merge:
+                do_merge, small_fails_size = _fails(large)
+                if do_merge:
+                    small, large = large, small
+
+            if do_merge:
+                # the small branch is absorbed by the large one
+                fail_size[small] = small_fails_size
+                attach_height[small] = h
+                is_top_basic[small] = False
+
+                if is_basic[large]:
+                    singletons[large] = singletons[large] + singletons[small]
+
+                size[large] += size[small]
+                merge_to_branch[step] = large
+
+            else:
+                if is_basic[large] and not is_basic[small]:
+                    small, large = large, small
+
+                clusters = (basic_clusters[small] if not is_basic[small]
+                            else [small])
+
+                if is_basic[large]:
+                    # start a composite branch
+                    attach_height[small] = h
+                    attach_height[large] = h
+                    branch = _new_branch(False, [], size[small] + size[large],
+                                         clusters + [large])
+                    merge_to_branch[step] = branch
+                else:
+                    basic_clusters[large] = basic_clusters[large] + clusters
+                    size[large] += size[small]
+                    attach_height[small] = h
+                    merge_to_branch[step] = large
+
+    # the clusters are the top basic branches that pass the criteria
+    small_labels = np.zeros(n_points, dtype=np.int64)
+    is_cluster = []
+
+    for branch in range(len(is_basic)):
+
+        if np.isnan(attach_height[branch]):
+            attach_height[branch] = cut_height
+
+        cluster = False
+        if is_top_basic[branch]:
+            scatter = _core_scatter(branch)
+            cluster = (size[branch] >= min_cluster_size
+                       and scatter < max_abs_core_scatter
+                       and attach_height[branch] - scatter > min_abs_gap)
+        is_cluster.append(cluster)
+
+        if fail_size[branch]:
+            small_labels[singletons[branch]] = branch + 1
+
+    if not respect_small_clusters:
+        small_labels[:] = 0
+
+    n_clusters = 0
+    for branch in np.flatnonzero(is_cluster):
+        n_clusters += 1
+        labels[singletons[branch]] = n_clusters
+        small_labels[singletons[branch]] = 0
+
+    labeled = np.flatnonzero(labels > 0)
+
+    if pam_stage and n_clusters > 0 and len(labeled) < n_points:
+
+        # the unassigned genes are given to the cluster with the lowest
+        # average dissimilarity (if it is below max_pam_dist)
+        indicator = np.zeros((len(labeled), n_clusters))
+        indicator[np.arange(len(labeled)), labels[labeled] - 1] = 1
+        indicator /= indicator.sum(axis=0)
+
+        # whole small clusters first
+        for small_label in np.unique(small_labels[small_labels > 0]):
+
+            genes = np.flatnonzero(small_labels == small_label)
+            if len(genes) < 2:
+                continue
+
+            cluster_dist = _weighted_sums(dist, genes, labeled,
+                                          indicator).mean(axis=0)
+            nearest = np.argmin(cluster_dist)
+
+            if cluster_dist[nearest] < max_pam_dist:
+                labels[genes] = nearest + 1
+            else:
+                labels[genes] = -1
+
+        unlabeled = np.flatnonzero(labels == 0)
+
+        for start, end in network.tiles(len(unlabeled), tile_size):
+
+            genes = unlabeled[start:end]
+            cluster_dist = _weighted_sums(dist, genes, labeled, indicator)
+            nearest = np.argmin(cluster_dist, axis=1)
+            assign = cluster_dist[np.arange(len(genes)), nearest] < max_pam_dist
+
+            labels[genes[assign]] = nearest[assign] + 1
+
+        labels[labels < 0] = 0
+
+    # number the clusters by decreasing size
+    sizes = np.bincount(labels, minlength=n_clusters + 1)[1:]
+    rank = np.zeros(n_clusters + 1, dtype=np.int32)
+    rank[1 + np.argsort(-sizes, kind="stable")] = np.arange(1, n_clusters + 1)
+
+    return rank[labels]
@@ -77,9 +77,11 @@ import sys
 import os
 import shutil
 import glob
+import json
 import sqlite3
 import numpy as np
 import pandas as pd
+import shlex
 import textwrap
 import subprocess
 from scipy.stats.mstats import gmean
@@ -89,6 +91,13 @@ import cgatcore.iotools as IOTools
 
 # import local pipeline utility functions
 from pipeline_utils import templates
+from pipeline_utils import cache
+from pipeline_utils import sweep
+from pipeline_utils import consensus
+from pipeline_utils import annotation
+from pipeline_utils import resources
+from pipeline_utils import runstats
+from pipeline_utils import latexreport
 
 
 # -------------------------- < parse parameters > --------------------------- #
@@ -150,15 +159,437 @@ if not PARAMS["input_meta_data"] is None:
 else:
     META_DATA_STAT = ""
 
+# optional additional data sets for a consensus network
 
+CONSENSUS_SETS = consensus.data_sets(PARAMS)
 
+for set_name, set_path in CONSENSUS_SETS:
+    if not os.path.exists(set_path):
+        raise ValueError("consensus data set %s not found" % set_name)
+
+
+# ########################################################################### #
+# ########################### Resource planning ############################# #
+# ########################################################################### #
+
+# When resources_plan is True the detection mode, tree engine, block size
+# and threads that are set to "auto" and the job_memory of each task are
+# chosen from the size of the input data and the resources_max_memory
+# and resources_max_threads that a job can use. The settings that are
+# given explicitly are kept (and the memory is planned for them).
+
+PLANNED = {"module_detection": "detection",
+           "module_tree_engine": "tree_engine",
+           "module_block_size": "block_size",
+           "module_threads": "threads"}
+
+if PARAMS["resources_plan"]:
+
+    # always the input (not the clean data, which only exists after the
+    # first run) so that the plan is the same in every run
+    PLAN = resources.plan(
+        *resources.dimensions(EXPRESSION_DATA_PATH),
+        max_memory=PARAMS["resources_max_memory"],
+        max_threads=PARAMS["resources_max_threads"],
+        tile_size=PARAMS["module_tile_size"],
+        knn=PARAMS["module_knn"],
+        **{y: PARAMS[x] for x, y in PLANNED.items()
+           if PARAMS[x] != "auto"})
+
+    print(PLAN.table())
+
+    # (the tree engine or block size is not used by the other mode)
+    for x, y in PLANNED.items():
+        if PARAMS[x] == "auto" and getattr(PLAN, y) is not None:
+            PARAMS[x] = getattr(PLAN, y)
+
+else:
+    PLAN = None
+
+    for x in PLANNED:
+        if PARAMS[x] == "auto":
+            raise ValueError('%s can only be "auto" when resources_plan is '
+                             "True" % x)
+
+# the sparse network is computed from the clean data, not from the
+# incremental correlation statistics
+if PARAMS["module_knn"] and PARAMS["module_incremental"]:
+    raise ValueError("module_knn cannot be used with module_incremental: "
+                     "unset one")
+
+# the bootstrap replicates detect the modules with the dense stepwise
+# python engines, which do not reproduce the other modes
+if PARAMS["stability_replicates"] > 0:
+    if PARAMS["module_detection"] != "stepwise":
+        raise ValueError("stability_replicates requires stepwise detection")
+
+    if PARAMS["module_knn"]:
+        raise ValueError("stability_replicates cannot be used with "
+                         "module_knn: unset one")
+
+    # the replicates are drawn from the reference set only
+    if CONSENSUS_SETS:
+        raise ValueError("stability_replicates cannot be used with a "
+                         "consensus network (consensus set_* given)")
+
+if CONSENSUS_SETS:
+    if PARAMS["module_detection"] != "stepwise":
+        raise ValueError("A consensus network requires stepwise detection")
+
+    # the consensus TOM is dense, there is no sparse (knn) consensus
+    if PARAMS["module_knn"]:
+        raise ValueError("module_knn cannot be used with a consensus "
+                         "network (consensus set_* given): unset one")
+
+    # the sweep would only be run on the reference set
+    if sweep.is_active(PARAMS):
+        raise ValueError("the parameter sweep cannot be used with a "
+                         "consensus network (consensus set_* given)")
+
+    if PARAMS["consensus_reference"] not in (
+            [consensus.REFERENCE] + [x for x, _ in CONSENSUS_SETS]):
+        raise ValueError('consensus_reference must be "%s" or the name of '
+                         "a consensus data set" % consensus.REFERENCE)
+
+
+def task_memory(task):
+    '''The (per thread) job_memory of a module task'''
+
+    if PLAN is None or task not in PLAN.peaks:
+        return PARAMS["module_memory"]
+
+    return PLAN.job_memory(task)
+
+
+# ########################################################################### #
+# ######################## Task output caching ############################## #
+# ########################################################################### #
+
+# Each task is keyed on its upstream keys, the digests of the raw files
+# it reads and exactly the PARAMS it consumes (see pipeline_utils/cache.py).
+# Only parameters that change the results are listed: e.g. the thread
+# count and tile size do not invalidate the outputs.
+
+CACHE = cache.TaskCache(PARAMS["cache_dir"],
+                        max_size=PARAMS["cache_max_size"],
+                        enabled=PARAMS["cache_enabled"])
+
+
+def _script(*path):
+    return os.path.join(PARAMS["wgcna_dir"], *path)
+
+
+CACHED_TASKS = {
+    "getGenesetAnnotations": {
+        "params": ["annotation_species", "annotation_ensembl_release",
+                   "annotation_ensembl_host", "annotation_store"],
+        "files": [_script("R", "wgcna_fetch_geneset_annotations.R")],
+        "outputs": ["*"]},
+    "cleanData": {
+        "params": ["annotation_idcol", "clean_min_fraction",
+                   "clean_min_n_samples", "clean_min_n_genes",
+                   "clean_min_relative_weight", "clean_cut_height",
+                   "clean_min_size"],
+        "files": [EXPRESSION_DATA_PATH, PARAMS["input_trait_data"],
+                  _script("python", "wgcna_ingest_data.py"),
+                  _script("pipelines", "pipeline_utils", "ingest.py"),
+                  _script("R", "wgcna_data_cleaning.R"),
+                  _script("R", "wgcna_matrixio.R"),
+                  _script("python", "wgcna_consensus_genes.py")],
+        "outputs": ["clean.*", "sampleClustering*"]},
+    "cleanConsensusSet": {
+        "params": ["annotation_idcol", "clean_min_fraction",
+                   "clean_min_n_samples", "clean_min_n_genes",
+                   "clean_min_relative_weight", "clean_cut_height",
+                   "clean_min_size"],
+        "files": [_script("python", "wgcna_ingest_data.py"),
+                  _script("pipelines", "pipeline_utils", "ingest.py"),
+                  _script("R", "wgcna_data_cleaning.R"),
+                  _script("R", "wgcna_matrixio.R")],
+        "outputs": ["clean.*", "sampleClustering*"]},
+    "softPower": {
+        "params": ["module_soft_power_grid", "module_network_type",
+                   "module_adj_cor_fnc"],
+        "files": [_script("python", "wgcna_soft_power.py"),
+                  _script("pipelines", "pipeline_utils", "softpower.py"),
+                  _script("R", "wgcna_soft_power.R")],
+        "outputs": ["*"]},
+    "computeAdjacency": {
+        "params": ["module_soft_power", "module_network_type",
+                   "module_adj_cor_fnc"],
+        "files": [_script("python", "wgcna_compute_adjacency.py"),
+                  _script("python", "wgcna_update_adjacency.py"),
+                  _script("pipelines", "pipeline_utils", "network.py"),
+                  _script("pipelines", "pipeline_utils", "incremental.py")],
+        "outputs": ["adjacency.*"]},
+    "computeTOM": {
+        "params": ["module_tom_type"],
+        "files": [_script("python", "wgcna_compute_TOM.py"),
+                  _script("pipelines", "pipeline_utils", "network.py")],
+        "outputs": ["dissTOM.*", "TOM.log"]},
+    "computeNetwork": {
+        "params": ["module_soft_power", "module_network_type",
+                   "module_adj_cor_fnc", "module_tom_type"],
+        "files": [_script("python", "wgcna_compute_network.py"),
+                  _script("pipelines", "pipeline_utils", "network.py")],
+        "outputs": ["dissTOM.*", "TOM.log"]},
+    "computeSparseNetwork": {
+        "params": ["module_soft_power", "module_network_type",
+                   "module_adj_cor_fnc", "module_tom_type", "module_knn"],
+        "files": [_script("python", "wgcna_compute_sparse_network.py"),
+                  _script("pipelines", "pipeline_utils", "network.py")],
+        "outputs": ["sparseTOM.*", "TOM.log"]},
+    "consensusNetwork": {
+        "params": ["module_soft_power", "module_network_type",
+                   "module_adj_cor_fnc", "module_tom_type",
+                   "consensus_name"],
+        "files": [_script("python", "wgcna_compute_network.py"),
+                  _script("python", "wgcna_consensus_genes.py"),
+                  _script("pipelines", "pipeline_utils", "network.py")],
+        "outputs": ["dissTOM.*", "TOM.log"]},
+    "consensusTOM": {
+        "params": ["consensus_quantile", "consensus_calibration",
+                   "consensus_calibration_quantile", "consensus_reference"],
+        "files": [_script("python", "wgcna_consensus_network.py"),
+                  _script("pipelines", "pipeline_utils", "consensus.py")],
+        "outputs": ["dissTOM.*", "TOM.log"]},
+    "detectModules": {
+        "params": ["module_soft_power", "module_min_size",
+                   "module_diss_threshold", "module_adj_cor_fnc",
+                   "module_deepsplit", "module_tree_engine",
+                   "module_merge_engine", "module_plot_engine"],
+        "files": [_script("python", "wgcna_cut_tree.py"),
+                  _script("pipelines", "pipeline_utils", "treecut.py"),
+                  _script("python", "wgcna_merge_modules.py"),
+                  _script("pipelines", "pipeline_utils", "eigengenes.py"),
+                  _script("R", "wgcna_detect_modules.R")],
+        "outputs": ["modules.*", "*.pdf"]},
+    "plotDendrograms": {
+        "params": [],
+        "files": [_script("python", "wgcna_plot_dendrograms.py"),
+                  _script("pipelines", "pipeline_utils", "dendrogram.py")],
+        "outputs": ["*.png", "dendrograms.log"]},
+    "moduleStability": {
+        "params": ["stability_replicates", "stability_seed",
+                   "module_soft_power", "module_network_type",
+                   "module_adj_cor_fnc", "module_tom_type",
+                   "module_min_size", "module_deepsplit",
+                   "module_diss_threshold"],
+        "files": [_script("python", "wgcna_module_stability.py"),
+                  _script("pipelines", "pipeline_utils", "stability.py"),
+                  _script("pipelines", "pipeline_utils", "network.py"),
+                  _script("pipelines", "pipeline_utils", "treecut.py"),
+                  _script("pipelines", "pipeline_utils", "eigengenes.py")],
+        "outputs": ["stability.*"]},
+    "detectModulesBlockwise": {
+        "params": ["module_block_size", "module_soft_power",
+                   "module_network_type", "module_adj_cor_fnc",
+                   "module_adj_dist_fnc", "module_tom_type",
+                   "module_min_size", "module_diss_threshold"],
+        "files": [_script("R", "wgcna_detect_modules_blockwise.R")],
+        "outputs": ["modules.*", "*.pdf"]},
+    "characteriseModules": {
+        "params": ["annotation_idcol", "annotation_namecol"],
+        "files": [PARAMS["input_trait_data"],
+                  _script("python", "wgcna_module_membership.py"),
+                  _script("pipelines", "pipeline_utils", "membership.py"),
+                  _script("R", "wgcna_modules_vs_traits.R")],
+        "outputs": ["*"]},
+    "characteriseEigengenes": {
+        # the trait colours are read directly from the pipeline.yml
+        "params": ["annotation_namecol", "plot_eigengene_heatmap_width",
+                   "plot_eigengene_heatmap_height"],
+        "files": [PARAMS["input_trait_data"], PARAMS["input_meta_data"],
+                  "pipeline.yml",
+                  _script("R", "wgcna_characterise_eigengenes.R")],
+        "outputs": ["eigengene_*", "eigengene.*", "eigengenes.log"]},
+    "eigengenesVsGenelists": {
+        "params": ["annotation_idcol", "annotation_namecol"],
+        "files": [PARAMS["input_genelists"],
+                  _script("R", "wgcna_eigengenes_vs_genelists.R")],
+        "outputs": ["genelist.*", "eigengenes.vs.genelists.log"]},
+    "genesetAnalysis": {
+        "params": ["annotation_idcol"],
+        "files": [_script("python", "wgcna_modules_vs_genesets.py"),
+                  _script("pipelines", "pipeline_utils", "enrichment.py"),
+                  _script("pipelines", "pipeline_utils", "genesetindex.py")],
+        "outputs": ["genesets.*", "geneset.analysis.*"]},
+    "summariseGenesetAnalysis": {
+        "params": ["genesets_min_fg_genes", "genesets_pvalue_threshold",
+                   "genesets_padjust_method",
+                   "genesets_use_adjusted_pvalues",
+                   "genesets_min_odds_ratio", "genesets_show_common",
+                   "genesets_show_detailed"],
+        "files": [_script("python", "wgcna_summarise_genesets.py"),
+                  _script("pipelines", "pipeline_utils", "enrichment.py"),
+                  _script("R", "wgcna_summariseGenesets.R")],
+        "outputs": ["cluster.genesets*", "summarise.geneset.analysis.log"]},
+    "reportFragment": {
+        "params": ["report_section", "report_section_number"],
+        "files": [_script("latex", "preamble.sty"),
+                  _script("pipelines", "pipeline_utils", "latexreport.py")],
+        "outputs": ["fragment.pdf", "fragment.toc", "fragment.log"]},
+}
+
+
+def _sentinels(infiles):
+    '''Flatten a ruffus input parameter to a list of sentinels'''
+
+    if infiles is None:
+        return []
+
+    if isinstance(infiles, str):
+        return [infiles]
+
+    return [x for x in infiles if x is not None]
+
+
+def task_key(task, infiles, settings=None):
+    '''Compute the cache key of a task from its inputs and parameters.
+
+       Settings (e.g. from a parameter sweep) take precedence over PARAMS.
+    '''
+
+    spec = CACHED_TASKS[task]
+    task_params = dict(PARAMS, **(settings or {}))
+
+    files = spec["files"]
+
+    # the geneset tasks also read the user supplied GMT files
+    if task in ["genesetAnalysis", "summariseGenesetAnalysis"]:
+        files = files + [PARAMS[x] for x in PARAMS.keys()
+                         if x.startswith("gmt_")]
+
+    # each consensus data set is read from its own file
+    if task == "cleanConsensusSet":
+        files = files + [task_params["consensus_path"]]
+
+    # the report fragments also read their section and the variables
+    if task == "reportFragment":
+        files = files + task_params["report_section_files"]
+
+    return CACHE.key(task,
+                     sentinels=_sentinels(infiles),
+                     params={x: task_params[x] for x in spec["params"]},
+                     files=files)
+
+
+def is_current(task):
+    '''Return a ruffus check_if_uptodate function for a task.
+
+       A task needs to run when its sentinel does not record the key
+       computed from its current inputs and parameters.
+    '''
+
+    def _check(infiles, outfile, *extras):
+
+        if not all(os.path.exists(x) for x in _sentinels(infiles)):
+            return True, "missing input"
+
+        settings = extras[0] if extras else None
+
+        if not cache.is_current(outfile, task_key(task, infiles, settings)):
+            return True, "inputs or parameters changed"
+
+        return False, "up to date"
+
+    return _check
+
+
+def fetch_outputs(task, key, outfile):
+    '''True if the outputs for the key are already in place or could
+       be restored from the cache'''
+
+    if cache.is_current(outfile, key):
+        return True
+
+    return CACHE.fetch(key, os.path.dirname(outfile),
+                       CACHED_TASKS[task]["outputs"])
+
+
+def store_outputs(task, key, outfile):
+    '''Add the outputs to the cache and record the key in the sentinel'''
+
+    CACHE.store(key, os.path.dirname(outfile),
+                CACHED_TASKS[task]["outputs"])
+
+    cache.write_key(outfile, key)
+
+
+# ########################################################################### #
+# ########################## Run statistics ################################# #
+# ########################################################################### #
+
+# The wall time, CPU time and largest process peak (memory) of every job
+# (and the timings of the steps of the R scripts) are recorded in the
+# runstats_database.
+
+RUN_DB = runstats.RunDatabase(PARAMS["runstats_database"])
+
+
+def instrument(statement, outfile):
+    '''Wrap a statement so that the statistics of the job are recorded
+       (see python/wgcna_job_stats.py)'''
+
+    if not PARAMS["runstats_enabled"]:
+        return statement
+
+    stats_file = runstats.stats_path(outfile)
+    os.makedirs(os.path.dirname(stats_file), exist_ok=True)
+
+    if os.path.exists(stats_file):
+        os.remove(stats_file)
+
+    return ("python %s/python/wgcna_job_stats.py --stats=%s -- bash -c %s"
+            % (PARAMS["wgcna_dir"], stats_file, shlex.quote(statement)))
+
+
+def record_stats(task, outfile, settings=None, extra=None,
+                 dimensions=None):
+    '''Add the statistics of a job to the run database together with
+       the size of the data and the parameters of the task (and any
+       extra fields, e.g. which pass of a task the job was).
+
+       The size of the data is that of the clean data unless the
+       (n_genes, n_samples) of the job are given as dimensions.
+
+       Called in the finally block of the P.run so that the failed jobs
+       are recorded (with their exit status) too.'''
+
+    stats_file = runstats.stats_path(outfile)
+
+    if not PARAMS["runstats_enabled"] or not os.path.exists(stats_file):
+        return
+
+    with open(stats_file) as fh:
+        stats = json.load(fh)
+
+    n_genes, n_samples = dimensions or (None, None)
+
+    clean_data_file = "wgcna.dir/clean.dir/clean.datExpr.npy"
+    if dimensions is None and os.path.exists(clean_data_file):
+        n_genes, n_samples = resources.dimensions(clean_data_file)
+
+    task_params = dict(PARAMS, **(settings or {}))
+    params = {x: task_params[x]
+              for x in CACHED_TASKS.get(task, {}).get("params", [])}
+    params.update(extra or {})
+
+    RUN_DB.record(task, outfile, stats,
+                  n_genes=n_genes, n_samples=n_samples, params=params)
 
 
 @follows(mkdir("annotation.dir"))
 @files(None, "annotation.dir/genesets.sentinel")
+@check_if_uptodate(is_current("getGenesetAnnotations"))
 def getGenesetAnnotations(infile, outfile):
     '''Get mappings between Ensembl gene_ids and (i) Entrez ids
        and (ii) KEGG pathways.
+
+       If an annotation_store is configured and holds the species and
+       release, the annotations are exported from it without network
+       access. Otherwise they are fetched from Ensembl and KEGG and
+       (for a specific release) added to the store.
     '''
 
     outdir = os.path.dirname(outfile)
@@ -173,262 +604,1029 @@ def getGenesetAnnotations(infile, outfile):
                  &> %(log_file)s
               ''' % dict(PARAMS, **locals())
 
+    key = task_key("getGenesetAnnotations", infile)
+
+    if fetch_outputs("getGenesetAnnotations", key, outfile):
+        cache.write_key(outfile, key)
+        return
+
+    species = PARAMS["annotation_species"]
+    release = str(PARAMS["annotation_ensembl_release"])
+
+    store = None
+    if PARAMS["annotation_store"] is not None:
+        store = annotation.AnnotationStore(PARAMS["annotation_store"])
+        stored_release = store.resolve(species, release)
+
+        if stored_release is not None:
+            store.export(species, stored_release, outdir)
+
+            with open(log_file, "w") as log:
+                log.write("exported release %s for %s from %s\n"
+                          % (stored_release, species,
+                             PARAMS["annotation_store"]))
+
+            store_outputs("getGenesetAnnotations", key, outfile)
+            return
+
     # requires internet connectivity.
     # and the BMRC cluster is broken by to_cluster = FALSE!
-    process = subprocess.Popen(statement.replace("\n", ""),
+    process = subprocess.Popen(instrument(statement, outfile)
+                               .replace("\n", ""),
                                shell=True, stdout=subprocess.PIPE)
     process.wait()
+    record_stats("getGenesetAnnotations", outfile)
 
     if process.returncode != 0:
         raise ValueError("failed to get annotation")
 
-    IOTools.touch_file(outfile)
+    # "latest" cannot be stored as the release number is not known
+    if store is not None and release != "latest":
+        store.load(species, release, outdir)
 
+    store_outputs("getGenesetAnnotations", key, outfile)
 
-@files(None,
-       "wgcna.dir/clean.dir/clean.sentinel")
-def cleanData(infile, outfile):
-    '''
-    Prepare the data for a WGCNA run
-    '''
 
-    results_file = outfile.replace(".sentinel", ".RData")
-    log_file = outfile.replace(".sentinel", ".log")
+def cleanStatement(expression_data_path, outfile, trait_data_stat=""):
+    '''Return the statement that parses and cleans an expression data
+       file into the directory of the outfile'''
 
-    #infile_path = os.path.abspath(infile)
-
-    expression_data_path = EXPRESSION_DATA_PATH
-    trait_data_stat = TRAIT_DATA_STAT
+    results_file = outfile.replace(".sentinel", ".datExpr.npy")
+    log_file = outfile.replace(".sentinel", ".log")
 
     out_dir = os.path.dirname(os.path.abspath(outfile))
     results_filename = os.path.basename(results_file)
 
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
+    gsg_file = outfile.replace(".sentinel", ".gsg.npy")
 
-    statement = '''Rscript %(wgcna_dir)s/R/wgcna_data_cleaning.R
+    return '''python %(wgcna_dir)s/python/wgcna_ingest_data.py
                    --input=%(expression_data_path)s
                    --idcol=%(annotation_idcol)s
-                   --outdir=%(out_dir)s
-                   --outfilename=%(results_filename)s
+                   --cachedir=%(input_cache_dir)s
+                   --outfile=%(gsg_file)s
+                   --threads=%(clean_threads)s
                    --minfraction=%(clean_min_fraction)s
                    --minnsamples=%(clean_min_n_samples)s
                    --minngenes=%(clean_min_n_genes)s
                    --minrelativeweight=%(clean_min_relative_weight)s
+                   &> %(log_file)s &&
+                   Rscript %(wgcna_dir)s/R/wgcna_data_cleaning.R
+                   --input=%(gsg_file)s
+                   --outdir=%(out_dir)s
+                   --outfilename=%(results_filename)s
                    --cutheight=%(clean_cut_height)s
                    --minsize=%(clean_min_size)s
                    %(trait_data_stat)s
-                   &> %(log_file)s
-                '''
+                   &>> %(log_file)s
+                ''' % dict(PARAMS, **locals())
 
-    P.run(statement)
 
-    IOTools.touch_file(outfile)
+# ------------------------- < consensus data sets > ------------------------- #
+
+# The additional data sets of a consensus network (see the consensus
+# section of the pipeline.yml) are cleaned in wgcna.dir/consensus.dir.
+# The clean data of the input (reference) set is then restricted to the
+# genes present in all of the sets.
+
+CONSENSUS_DIR = "wgcna.dir/consensus.dir"
+
+
+def cleanConsensusSetJobs():
+    '''One cleaning job per additional data set'''
+
+    for set_name, set_path in CONSENSUS_SETS:
+
+        yield [None,
+               os.path.join(CONSENSUS_DIR, set_name + ".dir",
+                            "clean.sentinel"),
+               {"consensus_name": set_name,
+                "consensus_path": set_path}]
+
+
+@active_if(consensus.is_active(PARAMS))
+@files(cleanConsensusSetJobs)
+@check_if_uptodate(is_current("cleanConsensusSet"))
+def cleanConsensusSet(infile, outfile, settings):
+    '''Parse and clean an additional data set of the consensus'''
+
+    out_dir = os.path.dirname(outfile)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    job_threads = PARAMS["clean_threads"]
+
+    if PLAN is not None:
+        job_memory = PLAN.job_memory("cleanData", job_threads)
+
+    clean = cleanStatement(settings["consensus_path"], outfile)
+
+    statement = '''%(clean)s'''
+
+    key = task_key("cleanConsensusSet", infile, settings)
+
+    if not fetch_outputs("cleanConsensusSet", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("cleanConsensusSet", outfile, settings)
+
+    store_outputs("cleanConsensusSet", key, outfile)
+
+
+def consensusCleanData():
+    '''The clean data sentinels of the additional data sets (or None)'''
+
+    if not CONSENSUS_SETS:
+        return None
+
+    return [os.path.join(CONSENSUS_DIR, set_name + ".dir", "clean.sentinel")
+            for set_name, _ in CONSENSUS_SETS]
+
+
+@follows(cleanConsensusSet)
+@files(consensusCleanData(),
+       "wgcna.dir/clean.dir/clean.sentinel")
+@check_if_uptodate(is_current("cleanData"))
+def cleanData(infile, outfile):
+    '''
+    Prepare the data for a WGCNA run
+
+    For a consensus network the clean data is restricted to the genes
+    that are present in the clean data of all of the data sets.
+    '''
+
+    results_file = outfile.replace(".sentinel", ".datExpr.npy")
+    log_file = outfile.replace(".sentinel", ".log")
+
+    out_dir = os.path.dirname(os.path.abspath(outfile))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    job_threads = PARAMS["clean_threads"]
+
+    if PLAN is not None:
+        job_memory = PLAN.job_memory("cleanData", job_threads)
+
+    clean = cleanStatement(EXPRESSION_DATA_PATH, outfile, TRAIT_DATA_STAT)
+
+    consensus_genes = ""
+
+    if infile is not None:
+        set_data = ",".join(x.replace(".sentinel", ".datExpr.npy")
+                            for x in infile)
+
+        consensus_genes = '''&&
+                   python %(wgcna_dir)s/python/wgcna_consensus_genes.py
+                   --input=%(results_file)s
+                   --sets=%(set_data)s
+                   --outfile=%(results_file)s
+                   &>> %(log_file)s
+                ''' % dict(wgcna_dir=PARAMS["wgcna_dir"],
+                           results_file=results_file,
+                           set_data=set_data,
+                           log_file=log_file)
+
+    statement = '''%(clean)s %(consensus_genes)s'''
+
+    key = task_key("cleanData", infile)
+
+    if not fetch_outputs("cleanData", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("cleanData", outfile)
+
+    store_outputs("cleanData", key, outfile)
 
 
 @transform(cleanData,
            regex(r"(.*)/.*/clean.sentinel"),
            r"\1/soft.power.dir/soft.power.sentinel")
+@check_if_uptodate(is_current("softPower"))
 def softPower(infile, outfile):
     '''
-    Run the soft power analysis
+    Run the soft power analysis
+
+    The correlation matrix is computed once and the connectivity for
+    every power in module_soft_power_grid is evaluated in the same pass.
+    '''
+
+    log_file = outfile.replace(".sentinel", ".log")
+
+    clean_data = infile.replace(".sentinel", ".datExpr.npy")
+    fit_file = outfile.replace(".sentinel", ".tsv")
+
+    job_threads = PARAMS["module_threads"]
+    job_memory = task_memory("softPower")
+
+    out_dir = os.path.dirname(outfile)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    statement = '''python %(wgcna_dir)s/python/wgcna_soft_power.py
+                   --input=%(clean_data)s
+                   --outfile=%(fit_file)s
+                   --powers=%(module_soft_power_grid)s
+                   --networktype=%(module_network_type)s
+                   --adjcorfnc=%(module_adj_cor_fnc)s
+                   --threads=%(module_threads)s
+                   --tilesize=%(module_tile_size)s
+                   &> %(log_file)s &&
+                   Rscript %(wgcna_dir)s/R/wgcna_soft_power.R
+                   --fitindices=%(fit_file)s
+                   --outdir=%(out_dir)s
+                   &>> %(log_file)s
+                '''
+
+    key = task_key("softPower", infile)
+
+    if not fetch_outputs("softPower", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("softPower", outfile)
+
+    store_outputs("softPower", key, outfile)
+
+
+
+# ########################################################################### #
+# ################### Step by Step module detection ######################### #
+# ########################################################################### #
+
+
+@transform(cleanData,
+           regex(r"(.*)/.*/clean.sentinel"),
+           r"\1/modules.dir/adjacency.sentinel")
+@check_if_uptodate(is_current("computeAdjacency"))
+def computeAdjacency(infile, outfile):
+    '''Compute the adjacency matrix
+
+       The adjacency is computed in row tiles by the python network
+       engine and written to a memory-mapped .npy file.
+
+       When module_incremental is True the correlation statistics are
+       kept in incremental.dir and only the samples that have been
+       added (or removed) since the last run are folded into them.
+    '''
+
+    results_file = outfile.replace(".sentinel", ".npy")
+    log_file = outfile.replace(".sentinel", ".log")
+
+    clean_data = infile.replace(".sentinel", ".datExpr.npy")
+
+    job_threads = PARAMS["module_threads"]
+    job_memory = task_memory("computeAdjacency")
+
+    out_dir = os.path.dirname(outfile)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    if PARAMS["module_incremental"]:
+        state_dir = os.path.join(os.path.dirname(out_dir), "incremental.dir")
+        engine = "wgcna_update_adjacency.py --statedir=%s" % state_dir
+    else:
+        engine = "wgcna_compute_adjacency.py"
+
+    statement = '''python %(wgcna_dir)s/python/%(engine)s
+                   --input=%(clean_data)s
+                   --outfile=%(results_file)s
+                   --threads=%(module_threads)s
+                   --softpower=%(module_soft_power)s
+                   --networktype=%(module_network_type)s
+                   --adjcorfnc=%(module_adj_cor_fnc)s
+                   --tilesize=%(module_tile_size)s
+                   &> %(log_file)s
+                '''
+
+    key = task_key("computeAdjacency", infile)
+
+    if not fetch_outputs("computeAdjacency", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("computeAdjacency", outfile)
+
+    store_outputs("computeAdjacency", key, outfile)
+
+@transform(computeAdjacency,
+           regex(r"(.*)/modules.dir/adjacency.sentinel"),
+           r"\1/modules.dir/TOM.sentinel")
+@check_if_uptodate(is_current("computeTOM"))
+def computeTOM(infile, outfile):
+    '''Compute the TOM
+
+       The TOM-based dissimilarity is computed tile by tile from the
+       memory-mapped adjacency and written to a memory-mapped .npy file.
+    '''
+
+    results_file = outfile.replace("TOM.sentinel", "dissTOM.npy")
+    log_file = outfile.replace(".sentinel", ".log")
+
+    adjacency_data = infile.replace(".sentinel", ".npy")
+
+    job_threads = PARAMS["module_threads"]
+    job_memory = task_memory("computeTOM")
+
+    out_dir = os.path.dirname(outfile)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    statement = '''python %(wgcna_dir)s/python/wgcna_compute_TOM.py
+                   --input=%(adjacency_data)s
+                   --outfile=%(results_file)s
+                   --threads=%(module_threads)s
+                   --tomtype=%(module_tom_type)s
+                   --tilesize=%(module_tile_size)s
+                   &> %(log_file)s
+                '''
+
+    key = task_key("computeTOM", infile)
+
+    if not fetch_outputs("computeTOM", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("computeTOM", outfile)
+
+    store_outputs("computeTOM", key, outfile)
+
+
+@transform(cleanData,
+           regex(r"(.*)/.*/clean.sentinel"),
+           r"\1/modules.dir/TOM.sentinel")
+@check_if_uptodate(is_current("computeNetwork"))
+def computeNetwork(infile, outfile):
+    '''Compute the TOM directly from the clean data
+
+       Fused alternative to computeAdjacency and computeTOM (see the
+       module_fuse_network parameter). Correlation tiles are streamed
+       through the soft-power transform into the TOM computation so the
+       adjacency matrix is never written to disk.
+    '''
+
+    results_file = outfile.replace("TOM.sentinel", "dissTOM.npy")
+    log_file = outfile.replace(".sentinel", ".log")
+
+    clean_data = infile.replace(".sentinel", ".datExpr.npy")
+
+    job_threads = PARAMS["module_threads"]
+    job_memory = task_memory("computeNetwork")
+
+    out_dir = os.path.dirname(outfile)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    statement = '''python %(wgcna_dir)s/python/wgcna_compute_network.py
+                   --input=%(clean_data)s
+                   --outfile=%(results_file)s
+                   --threads=%(module_threads)s
+                   --softpower=%(module_soft_power)s
+                   --networktype=%(module_network_type)s
+                   --adjcorfnc=%(module_adj_cor_fnc)s
+                   --tomtype=%(module_tom_type)s
+                   --tilesize=%(module_tile_size)s
+                   &> %(log_file)s
+                '''
+
+    key = task_key("computeNetwork", infile)
+
+    if not fetch_outputs("computeNetwork", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("computeNetwork", outfile)
+
+    store_outputs("computeNetwork", key, outfile)
+
+
+@transform(cleanData,
+           regex(r"(.*)/.*/clean.sentinel"),
+           r"\1/modules.dir/TOM.sentinel")
+@check_if_uptodate(is_current("computeSparseNetwork"))
+def computeSparseNetwork(infile, outfile):
+    '''Compute a sparse k-nearest-neighbour approximation of the TOM
+
+       Used instead of the dense network when module_knn is set. Only
+       the module_knn strongest adjacencies of each gene are kept so
+       that memory is linear in the number of genes.
+    '''
+
+    results_file = outfile.replace("TOM.sentinel", "sparseTOM.npz")
+    log_file = outfile.replace(".sentinel", ".log")
+
+    clean_data = infile.replace(".sentinel", ".datExpr.npy")
+
+    job_threads = PARAMS["module_threads"]
+    job_memory = task_memory("computeSparseNetwork")
+
+    out_dir = os.path.dirname(outfile)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    statement = '''python %(wgcna_dir)s/python/wgcna_compute_sparse_network.py
+                   --input=%(clean_data)s
+                   --outfile=%(results_file)s
+                   --knn=%(module_knn)s
+                   --threads=%(module_threads)s
+                   --softpower=%(module_soft_power)s
+                   --networktype=%(module_network_type)s
+                   --adjcorfnc=%(module_adj_cor_fnc)s
+                   --tomtype=%(module_tom_type)s
+                   --tilesize=%(module_tile_size)s
+                   &> %(log_file)s
+                '''
+
+    key = task_key("computeSparseNetwork", infile)
+
+    if not fetch_outputs("computeSparseNetwork", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("computeSparseNetwork", outfile)
+
+    store_outputs("computeSparseNetwork", key, outfile)
+
+
+# ------------------------- < consensus network > --------------------------- #
+
+def consensusNetworkJobs():
+    '''One network job per data set of the consensus, the reference
+       (input) set first'''
+
+    reference = "wgcna.dir/clean.dir/clean.sentinel"
+
+    set_data = [(consensus.REFERENCE, reference)]
+    set_data += [(set_name, os.path.join(CONSENSUS_DIR, set_name + ".dir",
+                                         "clean.sentinel"))
+                 for set_name, _ in CONSENSUS_SETS]
+
+    for set_name, clean_sentinel in set_data:
+
+        yield [[clean_sentinel, reference],
+               os.path.join(CONSENSUS_DIR, set_name + ".dir", "TOM.sentinel"),
+               {"consensus_name": set_name}]
+
+
+@active_if(consensus.is_active(PARAMS))
+@follows(cleanData)
+@files(consensusNetworkJobs)
+@check_if_uptodate(is_current("consensusNetwork"))
+def consensusNetwork(infiles, outfile, settings):
+    '''Compute the TOM of a data set of the consensus
+
+       The TOM is computed as in computeNetwork over the genes of the
+       (restricted) reference clean data.
+    '''
+
+    results_file = outfile.replace("TOM.sentinel", "dissTOM.npy")
+    log_file = outfile.replace(".sentinel", ".log")
+
+    set_clean, reference_clean = infiles
+
+    clean_data = set_clean.replace(".sentinel", ".datExpr.npy")
+    genes = reference_clean.replace(".sentinel", ".datExpr.npy")
+
+    job_threads = PARAMS["module_threads"]
+    job_memory = task_memory("consensusNetwork")
+
+    out_dir = os.path.dirname(outfile)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    statement = '''python %(wgcna_dir)s/python/wgcna_compute_network.py
+                   --input=%(clean_data)s
+                   --genes=%(genes)s
+                   --outfile=%(results_file)s
+                   --threads=%(module_threads)s
+                   --softpower=%(module_soft_power)s
+                   --networktype=%(module_network_type)s
+                   --adjcorfnc=%(module_adj_cor_fnc)s
+                   --tomtype=%(module_tom_type)s
+                   --tilesize=%(module_tile_size)s
+                   &> %(log_file)s
+                '''
+
+    key = task_key("consensusNetwork", infiles, settings)
+
+    if not fetch_outputs("consensusNetwork", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            # the genes of the reference and the samples of the set
+            record_stats("consensusNetwork", outfile, settings,
+                         dimensions=(resources.dimensions(genes)[0],
+                                     resources.dimensions(clean_data)[1]))
+
+    store_outputs("consensusNetwork", key, outfile)
+
+
+@active_if(consensus.is_active(PARAMS))
+@merge(consensusNetwork,
+       "wgcna.dir/modules.dir/TOM.sentinel")
+@check_if_uptodate(is_current("consensusTOM"))
+def consensusTOM(infiles, outfile):
+    '''Combine the TOMs of the data sets into the consensus TOM
+
+       The set TOMs, calibrated to that of the consensus_reference set,
+       are combined tile by tile by taking their elementwise
+       consensus_quantile (0: the minimum).
+    '''
+
+    results_file = outfile.replace("TOM.sentinel", "dissTOM.npy")
+    log_file = outfile.replace(".sentinel", ".log")
+
+    set_toms = ",".join(x.replace("TOM.sentinel", "dissTOM.npy")
+                        for x in infiles)
+
+    reference_tom = os.path.join(CONSENSUS_DIR,
+                                 PARAMS["consensus_reference"] + ".dir",
+                                 "dissTOM.npy")
+
+    job_threads = PARAMS["module_threads"]
+    job_memory = task_memory("computeTOM")
+
+    out_dir = os.path.dirname(outfile)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    statement = '''python %(wgcna_dir)s/python/wgcna_consensus_network.py
+                   --inputs=%(set_toms)s
+                   --reference=%(reference_tom)s
+                   --outfile=%(results_file)s
+                   --quantile=%(consensus_quantile)s
+                   --calibration=%(consensus_calibration)s
+                   --calibrationquantile=%(consensus_calibration_quantile)s
+                   --threads=%(module_threads)s
+                   --tilesize=%(module_tile_size)s
+                   &> %(log_file)s
+                '''
+
+    key = task_key("consensusTOM", infiles)
+
+    if not fetch_outputs("consensusTOM", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("consensusTOM", outfile)
+
+    store_outputs("consensusTOM", key, outfile)
+
+
+if consensus.is_active(PARAMS):
+    collectTOM = consensusTOM
+
+elif PARAMS["module_knn"]:
+    collectTOM = computeSparseNetwork
+
+elif PARAMS["module_fuse_network"] and not PARAMS["module_incremental"]:
+    collectTOM = computeNetwork
+
+else:
+    collectTOM = computeTOM
+
+
+def cutTreeStatement(tom_data, out_dir, results_prefix, min_size, deepsplit):
+    '''Return the statement that clusters the genes and cuts the tree
+       in python (and the option that passes the results to
+       wgcna_detect_modules.R) when module_tree_engine is "python".
+
+       The python engine works on the memory-mapped dissTOM so that the
+       full matrix is never loaded into memory. It is always used for
+       a sparse (module_knn) TOM.
+    '''
+
+    sparse = tom_data.endswith(".npz")
+
+    if not sparse:
+        if PARAMS["module_tree_engine"] == "R":
+            return "", ""
+
+        if PARAMS["module_tree_engine"] != "python":
+            raise ValueError(
+                'module_tree_engine must be either "python" or "R"')
+
+    tree_prefix = os.path.join(out_dir, results_prefix)
+
+    statement = '''python %(wgcna_dir)s/python/wgcna_cut_tree.py
+                   --tomdata=%(tom_data)s
+                   --outprefix=%(tree_prefix)s
+                   --minmodulesize=%(min_size)s
+                   --deepsplit=%(deepsplit)s
+                   --tilesize=%(tile_size)s
+                   &> %(tree_prefix)s.tree.log &&
+                ''' % dict(wgcna_dir=PARAMS["wgcna_dir"],
+                           tom_data=tom_data,
+                           tree_prefix=tree_prefix,
+                           min_size=min_size,
+                           deepsplit=deepsplit,
+                           tile_size=PARAMS["module_tile_size"])
+
+    return statement, "--tree=" + tree_prefix
+
+
+@transform(collectTOM,
+           regex(r"(.*)/modules.dir/TOM.sentinel"),
+           add_inputs(cleanData),
+           r"\1/modules.dir/modules.sentinel")
+@check_if_uptodate(is_current("detectModules"))
+def detectModules(infiles, outfile):
+    '''Cluster the TOM, cut the tree and merge the modules'''
+
+    results_prefix = os.path.basename(outfile)[:-len(".sentinel")]
+    log_file = outfile.replace(".sentinel", ".log")
+
+    tomx, cleanx = infiles
+
+    if PARAMS["module_knn"]:
+        tom_data = tomx.replace("TOM.sentinel", "sparseTOM.npz")
+    else:
+        tom_data = tomx.replace("TOM.sentinel", "dissTOM.npy")
+
+    clean_data = cleanx.replace(".sentinel", ".datExpr.npy")
+
+    job_threads = PARAMS["module_threads"]
+    job_memory = task_memory("detectModules")
+
+    out_dir = os.path.dirname(outfile)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    cut_tree, tree_option = cutTreeStatement(tom_data, out_dir,
+                                             results_prefix,
+                                             PARAMS["module_min_size"],
+                                             PARAMS["module_deepsplit"])
+
+    statement = '''%(cut_tree)s
+                   Rscript %(wgcna_dir)s/R/wgcna_detect_modules.R
+                   --cleandata=%(clean_data)s
+                   --tomdata=%(tom_data)s
+                   %(tree_option)s
+                   --mergeengine=%(module_merge_engine)s
+                   --plotengine=%(module_plot_engine)s
+                   --outdir=%(out_dir)s
+                   --outprefix=%(results_prefix)s
+                   --threads=%(module_threads)s
+                   --softpower=%(module_soft_power)s
+                   --minmodulesize=%(module_min_size)s
+                   --medissthreshold=%(module_diss_threshold)s
+                   --adjcorfnc=%(module_adj_cor_fnc)s
+                   --deepsplit=%(module_deepsplit)s
+                   &> %(log_file)s
+                '''
+
+    key = task_key("detectModules", infiles)
+
+    if not fetch_outputs("detectModules", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("detectModules", outfile)
+
+    store_outputs("detectModules", key, outfile)
+
+
+# ########################################################################### #
+# ################# Blockwise module detection ############################## #
+# ########################################################################### #
+
+
+@transform(cleanData,
+           regex(r"(.*)/.*/clean.sentinel"),
+           r"\1/modules.dir/modules.sentinel")
+@check_if_uptodate(is_current("detectModulesBlockwise"))
+def detectModulesBlockwise(infile, outfile):
+    '''
+    Run the module detection
     '''
 
+    results_prefix = os.path.basename(outfile)[:-len(".sentinel")]
     log_file = outfile.replace(".sentinel", ".log")
 
-    clean_data = infile.replace(".sentinel", ".RData")
+    clean_data = infile.replace(".sentinel", ".datExpr.npy")
 
     job_threads = PARAMS["module_threads"]
-    job_memory = PARAMS["module_memory"]
+    job_memory = task_memory("detectModulesBlockwise")
 
     out_dir = os.path.dirname(outfile)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    statement = '''Rscript %(wgcna_dir)s/R/wgcna_soft_power.R
+    statement = '''Rscript %(wgcna_dir)s/R/wgcna_detect_modules_blockwise.R
                    --input=%(clean_data)s
                    --outdir=%(out_dir)s
+                   --outprefix=%(results_prefix)s
+                   --threads=%(module_threads)s
+                   --maxblocksize=%(module_block_size)s
+                   --softpower=%(module_soft_power)s
                    --networktype=%(module_network_type)s
                    --adjcorfnc=%(module_adj_cor_fnc)s
                    --adjdistfnc=%(module_adj_dist_fnc)s
-                   --threads=%(module_threads)s
+                   --tomtype=%(module_tom_type)s
+                   --minmodulesize=%(module_min_size)s
+                   --medissthreshold=%(module_diss_threshold)s
                    &> %(log_file)s
                 '''
 
-    P.run(statement)
+    key = task_key("detectModulesBlockwise", infile)
 
-    IOTools.touch_file(outfile)
+    if not fetch_outputs("detectModulesBlockwise", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("detectModulesBlockwise", outfile)
+
+    store_outputs("detectModulesBlockwise", key, outfile)
 
 
 
 # ########################################################################### #
-# ################### Step by Step module detection ######################### #
+# ################## integrate module detection options ##################### #
 # ########################################################################### #
 
+if PARAMS["module_detection"] == "stepwise":
+    collectModules = detectModules
+
+elif PARAMS["module_detection"] == "blockwise":
+    collectModules = detectModulesBlockwise
 
-@transform(cleanData,
-           regex(r"(.*)/.*/clean.sentinel"),
-           r"\1/modules.dir/adjacency.sentinel")
-def computeAdjacency(infile, outfile):
-    '''Compute the adjacency matrix'''
+else:
+    raise ValueError('Module detection must be set to either "stepwise" or "blockwise"')
 
-    results_file = os.path.basename(outfile).replace(".sentinel", ".RData")
-    log_file = outfile.replace(".sentinel", ".log")
 
-    clean_data = infile.replace(".sentinel", ".RData")
+@active_if(PARAMS["module_detection"] == "stepwise"
+           and PARAMS["module_plot_engine"] == "python")
+@transform(collectModules,
+           regex(r"(.*)/modules.dir/modules.sentinel"),
+           r"\1/dendrograms.dir/dendrograms.sentinel")
+@check_if_uptodate(is_current("plotDendrograms"))
+def plotDendrograms(infile, outfile):
+    '''Draw the gene dendrogram and module colors as PNG images
+
+       The tree and colors are written by detectModules when
+       module_plot_engine is "python" and are drawn here, out of the
+       module detection job.
+    '''
 
-    job_threads = PARAMS["module_threads"]
-    job_memory = PARAMS["module_memory"]
+    modules_prefix = infile[:-len(".sentinel")]
+    log_file = outfile.replace(".sentinel", ".log")
 
     out_dir = os.path.dirname(outfile)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    statement = '''Rscript %(wgcna_dir)s/R/wgcna_compute_adjacency.R
-                   --input=%(clean_data)s
+    statement = '''python %(wgcna_dir)s/python/wgcna_plot_dendrograms.py
+                   --tree=%(modules_prefix)s
+                   --dynamiccolors=%(modules_prefix)s.dynamicColors.hex.npy
+                   --mergedcolors=%(modules_prefix)s.mergedColors.hex.npy
                    --outdir=%(out_dir)s
-                   --outfilename=%(results_file)s
-                   --threads=%(module_threads)s
-                   --softpower=%(module_soft_power)s
-                   --networktype=%(module_network_type)s
-                   --adjcorfnc=%(module_adj_cor_fnc)s
-                   --adjdistfnc=%(module_adj_dist_fnc)s
                    &> %(log_file)s
                 '''
 
-    P.run(statement)
+    key = task_key("plotDendrograms", infile)
 
-    IOTools.touch_file(outfile)
+    if not fetch_outputs("plotDendrograms", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("plotDendrograms", outfile)
 
-@transform(computeAdjacency,
-           regex(r"(.*)/modules.dir/adjacency.sentinel"),
-           r"\1/modules.dir/TOM.sentinel")
-def computeTOM(infile, outfile):
-    '''Compute the TOM'''
+    store_outputs("plotDendrograms", key, outfile)
 
-    results_file = os.path.basename(outfile).replace(".sentinel", ".RData")
-    log_file = outfile.replace(".sentinel", ".log")
 
-    adjacency_data = infile.replace(".sentinel", ".RData")
+@active_if(PARAMS["stability_replicates"] > 0)
+@transform(collectModules,
+           regex(r"(.*)/modules.dir/modules.sentinel"),
+           add_inputs(cleanData),
+           r"\1/stability.dir/stability.sentinel")
+@check_if_uptodate(is_current("moduleStability"))
+def moduleStability(infiles, outfile):
+    '''Assess the stability of the modules in bootstrap replicates
+
+       The modules are detected again in stability_replicates bootstrap
+       samples of the clean data with the python network, tree cut and
+       merging engines. The replicates are run in stability_workers
+       processes that share the module_threads.
+    '''
+
+    modulesx, cleanx = infiles
+
+    colors = modulesx.replace(".sentinel", ".colors.npy")
+    clean_data = cleanx.replace(".sentinel", ".datExpr.npy")
+
+    results_prefix = outfile[:-len(".sentinel")]
+    log_file = outfile.replace(".sentinel", ".log")
 
     job_threads = PARAMS["module_threads"]
-    job_memory = PARAMS["module_memory"]
+    job_memory = task_memory("moduleStability")
+
+    replicate_threads = max(1, PARAMS["module_threads"]
+                            // PARAMS["stability_workers"])
 
     out_dir = os.path.dirname(outfile)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    statement = '''Rscript %(wgcna_dir)s/R/wgcna_compute_TOM.R
-                   --input=%(adjacency_data)s
-                   --outdir=%(out_dir)s
-                   --outfilename=%(results_file)s
-                   --threads=%(module_threads)s
+    statement = '''python %(wgcna_dir)s/python/wgcna_module_stability.py
+                   --cleandata=%(clean_data)s
+                   --colors=%(colors)s
+                   --outprefix=%(results_prefix)s
+                   --replicates=%(stability_replicates)s
+                   --seed=%(stability_seed)s
+                   --workers=%(stability_workers)s
+                   --threads=%(replicate_threads)s
+                   --softpower=%(module_soft_power)s
+                   --networktype=%(module_network_type)s
+                   --adjcorfnc=%(module_adj_cor_fnc)s
                    --tomtype=%(module_tom_type)s
+                   --minmodulesize=%(module_min_size)s
+                   --deepsplit=%(module_deepsplit)s
+                   --medissthreshold=%(module_diss_threshold)s
+                   --tilesize=%(module_tile_size)s
                    &> %(log_file)s
                 '''
 
-    P.run(statement)
+    key = task_key("moduleStability", infiles)
 
-    IOTools.touch_file(outfile)
+    if not fetch_outputs("moduleStability", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("moduleStability", outfile)
 
+    store_outputs("moduleStability", key, outfile)
 
-@transform(computeTOM,
-           regex(r"(.*)/modules.dir/TOM.sentinel"),
-           add_inputs(cleanData),
-           r"\1/modules.dir/modules.sentinel")
-def detectModules(infiles, outfile):
-    '''Cluster the TOM, cut the tree and merge the modules'''
 
-    results_file = os.path.basename(outfile).replace(".sentinel", ".RData")
+# ########################################################################### #
+# ########################### Parameter sweep ############################### #
+# ########################################################################### #
+
+# The combinations of the values given in the "sweep" section of the
+# pipeline.yml are run in wgcna.dir/sweep.dir. The TOM is computed once for
+# each distinct soft power and TOM type and the module detection runs fan
+# out from it. The sweep TOMs are computed (and cached) as in
+# computeNetwork, so a sweep TOM is only shared with the main run when
+# module_fuse_network is True; otherwise the main run computes its TOM
+# with computeAdjacency and computeTOM and nothing is shared. The sweep
+# is run with "make parameterSweep".
+
+SWEEP_DIR = "wgcna.dir/sweep.dir"
+
+
+def sweepNetworkJobs():
+    '''One job per distinct network of the sweep'''
+
+    for network_dir, settings in sweep.networks(PARAMS, SWEEP_DIR):
+
+        yield ["wgcna.dir/clean.dir/clean.sentinel",
+               os.path.join(network_dir, "TOM.sentinel"),
+               settings]
+
+
+@active_if(sweep.is_active(PARAMS))
+@follows(cleanData)
+@files(sweepNetworkJobs)
+@check_if_uptodate(is_current("computeNetwork"))
+def sweepNetwork(infile, outfile, settings):
+    '''Compute the TOM for a soft power and TOM type of the sweep
+
+       The TOM is computed directly from the clean data as in
+       computeNetwork.
+    '''
+
+    results_file = outfile.replace("TOM.sentinel", "dissTOM.npy")
     log_file = outfile.replace(".sentinel", ".log")
 
-    tom_data, clean_data = [x.replace(".sentinel", ".RData") for x in infiles]
+    clean_data = infile.replace(".sentinel", ".datExpr.npy")
+
+    soft_power = settings["module_soft_power"]
+    tom_type = settings["module_tom_type"]
 
     job_threads = PARAMS["module_threads"]
-    job_memory = PARAMS["module_memory"]
+    job_memory = task_memory("computeNetwork")
 
     out_dir = os.path.dirname(outfile)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    statement = '''Rscript %(wgcna_dir)s/R/wgcna_detect_modules.R
-                   --cleandata=%(clean_data)s
-                   --tomdata=%(tom_data)s
-                   --outdir=%(out_dir)s
-                   --outfilename=%(results_file)s
+    statement = '''python %(wgcna_dir)s/python/wgcna_compute_network.py
+                   --input=%(clean_data)s
+                   --outfile=%(results_file)s
                    --threads=%(module_threads)s
-                   --softpower=%(module_soft_power)s
-                   --minmodulesize=%(module_min_size)s
-                   --medissthreshold=%(module_diss_threshold)s
+                   --softpower=%(soft_power)s
+                   --networktype=%(module_network_type)s
                    --adjcorfnc=%(module_adj_cor_fnc)s
-                   --deepsplit=%(module_deepsplit)s
+                   --tomtype=%(tom_type)s
+                   --tilesize=%(module_tile_size)s
                    &> %(log_file)s
                 '''
 
-    P.run(statement)
+    # keyed as computeNetwork: shared with the main run only when
+    # module_fuse_network is True (see above)
+    key = task_key("computeNetwork", infile, settings)
 
-    IOTools.touch_file(outfile)
+    if not fetch_outputs("computeNetwork", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("computeNetwork", outfile, settings)
 
+    store_outputs("computeNetwork", key, outfile)
 
-# ########################################################################### #
-# ################# Blockwise module detection ############################## #
-# ########################################################################### #
 
+def sweepModulesJobs():
+    '''One job per module detection run of the sweep'''
 
-@transform(cleanData,
-           regex(r"(.*)/.*/clean.sentinel"),
-           r"\1/modules.dir/modules.sentinel")
-def detectModulesBlockwise(infile, outfile):
-    '''
-    Run the module detection
-    '''
+    for network_dir, detection_dir, settings in sweep.detections(PARAMS,
+                                                                 SWEEP_DIR):
+
+        yield [[os.path.join(network_dir, "TOM.sentinel"),
+                "wgcna.dir/clean.dir/clean.sentinel"],
+               os.path.join(detection_dir, "modules.sentinel"),
+               settings]
 
-    results_file = os.path.basename(outfile).replace(".sentinel", ".RData")
+
+@active_if(sweep.is_active(PARAMS))
+@follows(sweepNetwork)
+@files(sweepModulesJobs)
+@check_if_uptodate(is_current("detectModules"))
+def sweepModules(infiles, outfile, settings):
+    '''Detect the modules for one combination of the sweep parameters'''
+
+    results_prefix = os.path.basename(outfile)[:-len(".sentinel")]
     log_file = outfile.replace(".sentinel", ".log")
 
-    clean_data = infile.replace(".sentinel", ".RData")
+    tomx, cleanx = infiles
+
+    tom_data = tomx.replace("TOM.sentinel", "dissTOM.npy")
+    clean_data = cleanx.replace(".sentinel", ".datExpr.npy")
+
+    soft_power = settings["module_soft_power"]
+    min_size = settings["module_min_size"]
+    diss_threshold = settings["module_diss_threshold"]
+    deepsplit = settings["module_deepsplit"]
 
     job_threads = PARAMS["module_threads"]
-    job_memory = PARAMS["module_memory"]
+    job_memory = task_memory("detectModules")
 
     out_dir = os.path.dirname(outfile)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    statement = '''Rscript %(wgcna_dir)s/R/wgcna_detect_modules_blockwise.R
-                   --input=%(clean_data)s
+    cut_tree, tree_option = cutTreeStatement(tom_data, out_dir,
+                                             results_prefix,
+                                             min_size, deepsplit)
+
+    statement = '''%(cut_tree)s
+                   Rscript %(wgcna_dir)s/R/wgcna_detect_modules.R
+                   --cleandata=%(clean_data)s
+                   --tomdata=%(tom_data)s
+                   %(tree_option)s
+                   --mergeengine=%(module_merge_engine)s
+                   --plotengine=%(module_plot_engine)s
                    --outdir=%(out_dir)s
-                   --outfilename=%(results_file)s
+                   --outprefix=%(results_prefix)s
                    --threads=%(module_threads)s
-                   --maxblocksize=%(module_block_size)s
-                   --softpower=%(module_soft_power)s
-                   --networktype=%(module_network_type)s
+                   --softpower=%(soft_power)s
+                   --minmodulesize=%(min_size)s
+                   --medissthreshold=%(diss_threshold)s
                    --adjcorfnc=%(module_adj_cor_fnc)s
-                   --adjdistfnc=%(module_adj_dist_fnc)s
-                   --tomtype=%(module_tom_type)s
-                   --minmodulesize=%(module_min_size)s
-                   --medissthreshold=%(module_diss_threshold)s
+                   --deepsplit=%(deepsplit)s
                    &> %(log_file)s
                 '''
 
-    P.run(statement)
+    key = task_key("detectModules", infiles, settings)
 
-    IOTools.touch_file(outfile)
+    if not fetch_outputs("detectModules", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("detectModules", outfile, settings)
 
+    store_outputs("detectModules", key, outfile)
 
 
-# ########################################################################### #
-# ################## integrate module detection options ##################### #
-# ########################################################################### #
+@active_if(sweep.is_active(PARAMS))
+@merge(sweepModules,
+       os.path.join(SWEEP_DIR, "sweep.summary.tsv"))
+def summariseSweep(infiles, outfile):
+    '''Tabulate the number and sizes of the modules for each combination
+       of the sweep parameters'''
 
-if PARAMS["module_detection"] == "stepwise":
-    collectModules = detectModules
+    runs = {os.path.join(x[1], "modules.sentinel"): x[2]
+            for x in sweep.detections(PARAMS, SWEEP_DIR)}
 
-elif PARAMS["module_detection"] == "blockwise":
-    collectModules = detectModulesBlockwise
+    infiles = [x for x in infiles if x in runs]
 
-else:
-    raise ValueError('Module detection must be set to either "stepwise" or "blockwise"')
+    summary = sweep.summarise([x[:-len(".sentinel")] for x in infiles],
+                              [runs[x] for x in infiles])
+
+    summary.to_csv(outfile, sep="\t", index=False)
+
+
+@follows(summariseSweep)
+def parameterSweep():
+    pass
 
 
 # ########################################################################### #
@@ -440,6 +1638,7 @@ else:
            regex(r"(.*)/.*/modules.sentinel"),
            add_inputs(getGenesetAnnotations, cleanData),
            r"\1/membership.dir/membership.sentinel")
+@check_if_uptodate(is_current("characteriseModules"))
 def characteriseModules(infiles, outfile):
     '''
     Characterise the modules and compare to trait data
@@ -450,18 +1649,20 @@ def characteriseModules(infiles, outfile):
     results_file = os.path.basename(outfile).replace(".sentinel", ".tsv")
     log_file = outfile.replace(".sentinel", ".log")
 
-    clean_data = cleanx.replace(".sentinel", ".RData")
-    module_data = modulesx.replace(".sentinel", ".RData")
+    clean_data = cleanx.replace(".sentinel", ".datExpr.npy")
+    module_data = modulesx[:-len(".sentinel")]
     annotation_file = annotationsx.replace("genesets.sentinel", "ensembl.to.entrez.tsv.gz")
 
+    trait_data_stat = TRAIT_DATA_STAT
+
     job_threads = PARAMS["module_threads"]
-    job_memory = PARAMS["module_memory"]
+    job_memory = task_memory("characteriseModules")
 
     out_dir = os.path.dirname(outfile)
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    statement = '''Rscript %(wgcna_dir)s/R/wgcna_modules_vs_traits.R
+    statement = '''python %(wgcna_dir)s/python/wgcna_module_membership.py
                    --input=%(clean_data)s
                    --modules=%(module_data)s
                    --annotation=%(annotation_file)s
@@ -470,17 +1671,31 @@ def characteriseModules(infiles, outfile):
                    --outdir=%(out_dir)s
                    --outfilename=%(results_file)s
                    --threads=%(module_threads)s
-                   &> %(log_file)s
+                   &> %(log_file)s &&
+                   Rscript %(wgcna_dir)s/R/wgcna_modules_vs_traits.R
+                   --input=%(clean_data)s
+                   --modules=%(module_data)s
+                   %(trait_data_stat)s
+                   --outdir=%(out_dir)s
+                   --threads=%(module_threads)s
+                   &>> %(log_file)s
                 '''
 
-    P.run(statement)
+    key = task_key("characteriseModules", infiles)
 
-    IOTools.touch_file(outfile)
+    if not fetch_outputs("characteriseModules", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("characteriseModules", outfile)
+
+    store_outputs("characteriseModules", key, outfile)
 
 
 @transform(characteriseModules,
            regex(r"(.*)/.*/membership.sentinel"),
            r"\1/eigengenes.dir/eigengenes.sentinel")
+@check_if_uptodate(is_current("characteriseEigengenes"))
 def characteriseEigengenes(infile, outfile):
     '''
     Characterise the eigen genes
@@ -516,15 +1731,22 @@ def characteriseEigengenes(infile, outfile):
                    &> %(log_file)s
                 '''
 
-    P.run(statement)
+    key = task_key("characteriseEigengenes", infile)
 
-    IOTools.touch_file(outfile)
+    if not fetch_outputs("characteriseEigengenes", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("characteriseEigengenes", outfile)
+
+    store_outputs("characteriseEigengenes", key, outfile)
 
 @active_if(PARAMS["input_genelists"]!=None)
 @transform(collectModules,
            regex(r"(.*)/.*/modules.sentinel"),
            add_inputs(getGenesetAnnotations, cleanData),
            r"\1/eigengenes.dir/eigengenes.vs.genelists.sentinel")
+@check_if_uptodate(is_current("eigengenesVsGenelists"))
 def eigengenesVsGenelists(infiles, outfile):
     '''
     Characterise the eigen genes, compare to gene lists
@@ -534,8 +1756,8 @@ def eigengenesVsGenelists(infiles, outfile):
 
     log_file = outfile.replace(".sentinel", ".log")
 
-    clean_data = cleanx.replace(".sentinel", ".RData")
-    module_data = modulex.replace(".sentinel", ".RData")
+    clean_data = cleanx.replace(".sentinel", ".datExpr.npy")
+    module_data = modulex[:-len(".sentinel")]
     annotation_file = annotationx.replace("genesets.sentinel", "ensembl.to.entrez.tsv.gz")
 
     out_dir = os.path.dirname(outfile)
@@ -553,7 +1775,13 @@ def eigengenesVsGenelists(infiles, outfile):
                    &> %(log_file)s
                 '''
 
-    P.run(statement)
+    key = task_key("eigengenesVsGenelists", infiles)
+
+    if not fetch_outputs("eigengenesVsGenelists", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("eigengenesVsGenelists", outfile)
 
     # write the tex snippet.
     genelists = pd.read_csv(PARAMS["input_genelists"], sep="\t")
@@ -579,7 +1807,7 @@ def eigengenesVsGenelists(infiles, outfile):
                 templates.figure % heatmap_fig))
             tex.write("\n")
 
-    IOTools.touch_file(outfile)
+    store_outputs("eigengenesVsGenelists", key, outfile)
 
 
 
@@ -615,16 +1843,72 @@ def parseGMTs(param_keys=["gmt_pathway_files_"]):
 # ######################### Geneset Analysis ################################ #
 # ########################################################################### #
 
+def genesetCollections(anno_dir):
+    '''Return the names and paths of the geneset collections to test:
+       the GO and KEGG sets (see getGenesetAnnotations) followed by
+       the GMT files given in the pipeline.yml'''
+
+    names = ["GO.BP", "GO.MF", "GO.CC", "KEGG"]
+    files = [os.path.join(anno_dir, x + ".gmt") for x in names]
+
+    param_keys = ["gmt_celltype_files_",
+                  "gmt_pathway_files_"]
+    gmt_names, gmt_files = parseGMTs(param_keys=param_keys)
+
+    if gmt_names != "none":
+        names += gmt_names.split(",")
+        files += gmt_files.split(",")
+
+    return names, files
+
+
+@active_if(PARAMS["run_genesets"])
+@transform(getGenesetAnnotations,
+           regex(r"(.*)/genesets.sentinel"),
+           r"\1/geneset.index.sentinel")
+def buildGenesetIndex(infile, outfile):
+    '''
+    Compile the geneset collections into binary indexes.
+
+    The indexes are stored in genesets_index_dir under the checksum
+    of each GMT file so that they are shared between runs. This task
+    only depends on the annotations so it runs alongside the network
+    construction.
+    '''
+
+    gmt_names, gmt_files = genesetCollections(os.path.dirname(infile))
+    gmt_files = ",".join(gmt_files)
+
+    index_dir = PARAMS["genesets_index_dir"]
+    log_file = outfile.replace(".sentinel", ".log")
+
+    statement = '''python %(wgcna_dir)s/python/wgcna_geneset_index.py
+                   --gmt_files=%(gmt_files)s
+                   --indexdir=%(index_dir)s
+                   &> %(log_file)s
+                '''
+
+    try:
+        P.run(instrument(statement, outfile))
+    finally:
+        record_stats("buildGenesetIndex", outfile)
+
+    IOTools.touch_file(outfile)
+
+
 @active_if(PARAMS["run_genesets"])
+@follows(buildGenesetIndex)
 @transform(characteriseModules,
            regex(r"(.*)/membership.dir/.*.sentinel"),
            add_inputs(getGenesetAnnotations),
            r"\1/genesets.dir/geneset.analysis.sentinel")
+@check_if_uptodate(is_current("genesetAnalysis"))
 def genesetAnalysis(infiles, outfile):
     '''
     Naive geneset over-enrichment analysis of module genes.
 
-    Testing is performed with the gsfisher package.
+    All of the modules are tested against all of the genesets in a
+    single job by python/wgcna_modules_vs_genesets.py.
 
     GO categories and KEGG pathways are tested by default.
 
@@ -640,60 +1924,55 @@ def genesetAnalysis(infiles, outfile):
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
-    anno = os.path.join(os.path.dirname(genesetAnno),
-                        "ensembl.to.entrez.tsv.gz")
-
-    kegg_pathways = os.path.join(os.path.dirname(genesetAnno),
-                                 "kegg_pathways.rds")
-
-    param_keys = ["gmt_celltype_files_",
-                  "gmt_pathway_files_"]
-    gmt_names, gmt_files = parseGMTs(param_keys=param_keys)
+    anno_dir = os.path.dirname(genesetAnno)
+    anno = os.path.join(anno_dir, "ensembl.to.entrez.tsv.gz")
 
-    # get the set of modules
-    xx = pd.read_csv(membership_file, sep="\t")
-    modules = [x for x in set(xx["module"].values)]
+    gmt_names, gmt_files = genesetCollections(anno_dir)
 
-    job_memory = "20G"
+    gmt_names = ",".join(gmt_names)
+    gmt_files = ",".join(gmt_files)
 
-    statements = []
+    index_dir = PARAMS["genesets_index_dir"]
 
-    species = PARAMS["annotation_species"]
-    wgcna_dir = PARAMS["wgcna_dir"]
-    idcol = PARAMS["annotation_idcol"]
+    log_file = outfile.replace(".sentinel", ".log")
 
-    for module in modules:
+    job_memory = PARAMS["genesets_memory"]
 
-        logfile = os.path.join(outdir,
-                               "geneset.analysis." + module + ".log")
+    statement = '''python %(wgcna_dir)s/python/wgcna_modules_vs_genesets.py
+                   --input=%(membership_file)s
+                   --annotation=%(anno)s
+                   --idcol=%(annotation_idcol)s
+                   --gmt_names=%(gmt_names)s
+                   --gmt_files=%(gmt_files)s
+                   --indexdir=%(index_dir)s
+                   --outdir=%(outdir)s
+                   &> %(log_file)s
+                '''
 
-        statements.append('''Rscript %(wgcna_dir)s/R/wgcna_modules_vs_genesets.R
-                            --input=%(membership_file)s
-                            --module=%(module)s
-                            --species=%(species)s
-                            --annotation=%(anno)s
-                            --idcol=%(idcol)s
-                            --kegg_pathways=%(kegg_pathways)s
-                            --gmt_names=%(gmt_names)s
-                            --gmt_files=%(gmt_files)s
-                            --outdir=%(outdir)s
-                            &> %(logfile)s
-                      ''' % locals())
+    key = task_key("genesetAnalysis", infiles)
 
-    P.run(statements)
+    if not fetch_outputs("genesetAnalysis", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("genesetAnalysis", outfile)
 
-    IOTools.touch_file(outfile)
+    store_outputs("genesetAnalysis", key, outfile)
 
 @active_if(PARAMS["run_genesets"])
 @transform(genesetAnalysis,
            regex(r"(.*)/.*.sentinel"),
            add_inputs(characteriseModules),
            r"\1/summarise.geneset.analysis.sentinel")
+@check_if_uptodate(is_current("summariseGenesetAnalysis"))
 def summariseGenesetAnalysis(infiles, outfile):
     '''
     Summarise the geneset over-enrichment analyses of cluster marker genes.
 
     Enriched pathways are summarised in an Excel table and a heatmap.
+    The results of all of the modules are combined, filtered and
+    tabulated in python (wgcna_summarise_genesets.py) and the plots
+    are drawn in R.
     '''
 
     outdir = os.path.dirname(outfile)
@@ -723,25 +2002,37 @@ def summariseGenesetAnalysis(infiles, outfile):
 
     show_detailed = str(PARAMS["genesets_show_detailed"])
 
-    statement = '''Rscript %(wgcna_dir)s/R/wgcna_summariseGenesets.R
+    statement = '''python %(wgcna_dir)s/python/wgcna_summarise_genesets.py
                          --genesetdir=%(genesetdir)s
                          --gmt_names=%(gmt_names)s
-                         --show_detailed=%(show_detailed)s
                          --modulelist=%(module_list)s
                          --mingenes=%(genesets_min_fg_genes)s
                          --pvaluethreshold=%(genesets_pvalue_threshold)s
                          --padjustmethod=%(genesets_padjust_method)s
                          --useadjusted=%(use_adjusted)s
                          --minoddsratio=%(genesets_min_odds_ratio)s
-                         --showcommon=%(show_common)s
                          --outprefix=%(outdir)s/cluster.genesets
                          --prefix=genesets
+                    &> %(logfile)s &&
+                    Rscript %(wgcna_dir)s/R/wgcna_summariseGenesets.R
+                         --gmt_names=%(gmt_names)s
+                         --show_detailed=%(show_detailed)s
+                         --modulelist=%(module_list)s
+                         --pvaluethreshold=%(genesets_pvalue_threshold)s
+                         --showcommon=%(show_common)s
+                         --outprefix=%(outdir)s/cluster.genesets
                          --plotdirvar=clusterGenesetsDir
-                    &> %(logfile)s
+                    &>> %(logfile)s
                       '''
-    P.run(statement)
+    key = task_key("summariseGenesetAnalysis", infiles)
 
-    IOTools.touch_file(outfile)
+    if not fetch_outputs("summariseGenesetAnalysis", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("summariseGenesetAnalysis", outfile)
+
+    store_outputs("summariseGenesetAnalysis", key, outfile)
 
 
 # ------------------- < within cluster geneset analysis > ------------------- #
@@ -749,7 +2040,8 @@ def summariseGenesetAnalysis(infiles, outfile):
 @transform(summariseGenesetAnalysis,
            regex("(.*)/genesets.dir/summarise.geneset.analysis.sentinel"),
            add_inputs(softPower, characteriseModules,
-                      characteriseEigengenes, eigengenesVsGenelists),
+                      characteriseEigengenes, eigengenesVsGenelists,
+                      plotDendrograms, moduleStability),
            r"\1/latex.dir/report.vars.sty")
 
 def latexVars(infiles, outfile):
@@ -788,6 +2080,27 @@ def latexVars(infiles, outfile):
             "genesetDir": os.path.join(rundir, "genesets.dir"),
             "clusterGenesetsDir": os.path.join(rundir, "genesets.dir")}
 
+    # the gene dendrograms are PNG images drawn by plotDendrograms or
+    # PDFs drawn by the module detection
+    if (PARAMS["module_detection"] == "stepwise"
+            and PARAMS["module_plot_engine"] == "python"):
+        vars["dendrogramDir"] = os.path.join(rundir, "dendrograms.dir")
+    else:
+        vars["dendrogramDir"] = vars["moduleDir"]
+
+    if PARAMS["stability_replicates"] > 0:
+        vars["stabilityTable"] = os.path.join(rundir, "stability.dir",
+                                              "stability.modules.tex")
+        vars["stabilityReplicates"] = PARAMS["stability_replicates"]
+
+    if PARAMS["runstats_enabled"]:
+        vars["runStatsTable"] = os.path.join(os.path.dirname(outfile),
+                                             "run.statistics.tex")
+
+        summary, _ = RUN_DB.write_latex(vars["runStatsTable"])
+        summary.to_csv(os.path.join(rundir, "run.statistics.tsv"),
+                       sep="\t", index=False)
+
     with open(outfile, "w") as ofh:
         for command, value in vars.items():
 
@@ -795,19 +2108,142 @@ def latexVars(infiles, outfile):
 
 
 
-@transform(latexVars,
-           regex("(.*)/report.vars.sty"),
-           r"\1/summaryReport.pdf")
-def summaryReport(infile, outfile):
+REPORT_DIR = "wgcna.dir/latex.dir"
+
+
+def reportSections():
+    '''The sections of the summary report, in order, as (name, tex file,
+       sentinels of the tasks that made its figures and tables, other
+       files that it reads)'''
+
+    def _section(name, tex, sentinels=(), files=()):
+        return (name, str(_script("pipelines", "pipeline_wgcna", tex)),
+                list(sentinels), list(files))
+
+    dendrogram_sentinels = []
+    if (PARAMS["module_detection"] == "stepwise"
+            and PARAMS["module_plot_engine"] == "python"):
+        dendrogram_sentinels.append(
+            "wgcna.dir/dendrograms.dir/dendrograms.sentinel")
+
+    sections = [
+        _section("param", "paramSection.tex",
+                 ["wgcna.dir/soft.power.dir/soft.power.sentinel"]),
+        _section("clean", "cleanSection.tex",
+                 ["wgcna.dir/clean.dir/clean.sentinel"]),
+        _section("module", "moduleSection.tex",
+                 ["wgcna.dir/modules.dir/modules.sentinel"]
+                 + dendrogram_sentinels),
+        _section("eigengene", "eigengeneSection.tex",
+                 ["wgcna.dir/eigengenes.dir/eigengenes.sentinel"])]
+
+    if not PARAMS["input_genelists"] == None:
+        sections.append(_section(
+            "genelist", "genelistSection.tex",
+            ["wgcna.dir/eigengenes.dir/eigengenes.vs.genelists.sentinel"]))
+
+    sections.append(_section("membership", "membershipSection.tex",
+                             ["wgcna.dir/membership.dir/membership.sentinel"]))
+
+    if PARAMS["stability_replicates"] > 0:
+        sections.append(_section(
+            "stability", "stabilitySection.tex",
+            ["wgcna.dir/stability.dir/stability.sentinel"]))
+
+    if PARAMS["run_genesets"]:
+        sections.append(_section(
+            "geneset", "genesetSection.tex",
+            ["wgcna.dir/genesets.dir/summarise.geneset.analysis.sentinel"]))
+
+    if PARAMS["runstats_enabled"]:
+        sections.append(_section(
+            "runstats", "runStatsSection.tex",
+            files=[os.path.join(REPORT_DIR, "run.statistics.tex")]))
+
+    return sections
+
+
+def reportFragmentJobs():
+    '''One job per section of the summary report'''
+
+    latex_vars = os.path.join(REPORT_DIR, "report.vars.sty")
+
+    # section 1 is the introduction, which is part of the assembly
+    for number, (name, tex, sentinels, files) in enumerate(reportSections(),
+                                                           start=2):
+
+        yield [sentinels,
+               os.path.join(REPORT_DIR, "fragments.dir", name + ".dir",
+                            "fragment.sentinel"),
+               {"report_section": name,
+                "report_section_number": number,
+                "report_section_files": [tex, latex_vars] + files}]
+
+
+@follows(latexVars)
+@files(reportFragmentJobs)
+@check_if_uptodate(is_current("reportFragment"))
+def reportFragment(infiles, outfile, settings):
+    '''
+    Compile a section of the summary report as a separate PDF.
+
+    The fragments are keyed on the tasks that made their figures, so
+    only the sections whose inputs changed are compiled again, and
+    they are compiled in parallel.
+    '''
+
+    out_dir = os.path.dirname(outfile)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    tex_file = outfile.replace(".sentinel", ".tex")
+    log_file = outfile.replace(".sentinel", ".pdflatex.log")
+    latex_log = outfile.replace(".sentinel", ".log")
+
+    section_tex, latex_vars = settings["report_section_files"][:2]
+
+    latexreport.write_fragment(tex_file, os.path.abspath(latex_vars),
+                               section_tex,
+                               settings["report_section_number"])
+
+    # a second pass is only needed for cross-references in the section
+    statement = '''pdflatex -output-directory=%(out_dir)s
+                            -jobname=fragment
+                            %(tex_file)s
+                   &> %(log_file)s &&
+                   if grep -q "Rerun to get" %(latex_log)s; then
+                       pdflatex -output-directory=%(out_dir)s
+                                -jobname=fragment
+                                %(tex_file)s
+                       &>> %(log_file)s;
+                   fi
+                '''
+
+    key = task_key("reportFragment", infiles, settings)
+
+    if not fetch_outputs("reportFragment", key, outfile):
+        try:
+            P.run(instrument(statement, outfile))
+        finally:
+            record_stats("reportFragment", outfile, settings)
+
+    store_outputs("reportFragment", key, outfile)
+
+
+@merge(reportFragment,
+       os.path.join(REPORT_DIR, "summaryReport.pdf"))
+def summaryReport(infiles, outfile):
     '''
     Prepare a PDF summary report.
+
+    The title page, table of contents and introduction are typeset and
+    the compiled section fragments are added as pages.
     '''
 
     outfile_name = os.path.basename(outfile)
     jobName = outfile_name[:-len(".pdf")]
 
     outdir = os.path.dirname(outfile)
-    rundir = Path(outdir).parents[0]
 
     compilation_dir = os.path.join(outdir, ".latex_compilation.dir")
 
@@ -820,58 +2256,39 @@ def summaryReport(infile, outfile):
 
     os.mkdir(compilation_dir)
 
-    # get the latex variables
-    statement = '''pdflatex -output-directory=%(compilation_dir)s
-                            -jobname=%(jobName)s
-                            %(draft_mode)s
-      '\\input %(latexVars)s
-       \\def\\reportTitle{pipeline\\_wgcna.py: summary report}
-                '''
-    # get the intro
-    statement += '''
-      \\input %(wgcna_dir)s/pipelines/pipeline_wgcna/introReport.tex
-      '''
-
-    # add the section to visualise the soft power
-    statement += '''
-         \\input %(wgcna_dir)s/pipelines/pipeline_wgcna/paramSection.tex
-        '''
-
-    statement += '''
-         \\input %(wgcna_dir)s/pipelines/pipeline_wgcna/cleanSection.tex
-        '''
+    fragments = []
 
-    statement += '''
-         \\input %(wgcna_dir)s/pipelines/pipeline_wgcna/moduleSection.tex
-        '''
+    for name, _, _, _ in reportSections():
+        fragment_dir = os.path.abspath(
+            os.path.join(outdir, "fragments.dir", name + ".dir"))
 
-    statement += '''
-         \\input %(wgcna_dir)s/pipelines/pipeline_wgcna/eigengeneSection.tex
-        '''
+        fragments.append((name,
+                          os.path.join(fragment_dir, "fragment.pdf"),
+                          os.path.join(fragment_dir, "fragment.toc")))
 
-    if not PARAMS["input_genelists"] == None:
-        statement += '''
-        \\input %(wgcna_dir)s/pipelines/pipeline_wgcna/genelistSection.tex
-        '''
-
-    statement += '''
-         \\input %(wgcna_dir)s/pipelines/pipeline_wgcna/membershipSection.tex
-        '''
+    assembly = os.path.join(compilation_dir, jobName + ".tex")
 
-    if(PARAMS["run_genesets"]):
-        statement += '''
-        \\input %(wgcna_dir)s/pipelines/pipeline_wgcna/genesetSection.tex
-                     '''
+    latexreport.write_assembly(assembly, os.path.abspath(latexVars),
+                               PARAMS["wgcna_dir"], fragments)
 
-    statement += '''\\input %(wgcna_dir)s/latex/endmatter.tex'
-    '''
+    statement = '''pdflatex -output-directory=%(compilation_dir)s
+                            -jobname=%(jobName)s
+                            %(draft_mode)s
+                            %(assembly)s
+                '''
 
-    # Deliberately run twice - necessary for LaTeX compilation..
+    # Deliberately run twice - necessary for the table of contents
     draft_mode = "-draftmode"
-    P.run(statement)
+    try:
+        P.run(instrument(statement, outfile))
+    finally:
+        record_stats("summaryReport", outfile, extra={"pass": "draft"})
 
     draft_mode = ""
-    P.run(statement)
+    try:
+        P.run(instrument(statement, outfile))
+    finally:
+        record_stats("summaryReport", outfile, extra={"pass": "final"})
 
     # Move the compiled pdfs to report.dir
     shutil.move(os.path.join(compilation_dir, outfile_name),
@@ -901,7 +2318,8 @@ def report(infile, outfile):
                os.path.join(run_dir,"genesets.dir","cluster.genesets.xlsx"): "module.genesets.xlsx",
                os.path.join(run_dir,"latex.dir","summaryReport.pdf"): "summary.report.pdf",
                os.path.join(run_dir, "membership.dir", "eigengenes.tsv"): "module.eigengene.expression.matrix.tsv",
-               os.path.join(run_dir, "membership.dir", "membership.tsv"): "module.gene.membership.tsv"
+               os.path.join(run_dir, "membership.dir", "membership.tsv"): "module.gene.membership.tsv",
+               os.path.join(run_dir, "run.statistics.tsv"): "run.statistics.tsv"
                }
 
     for source_path, target_name in targets.items():
@@ -910,14 +2328,16 @@ def report(infile, outfile):
 
             target_path = os.path.join(out_dir, target_name)
 
+            # replace the links made by an earlier run
+            if os.path.lexists(target_path):
+                os.remove(target_path)
+
             os.symlink(os.path.relpath(source_path, start=out_dir),
                        target_path)
 
     IOTools.touch_file(outfile)
 
 
-
-
 # ########################################################################### #
 # ##################### full target: to run all tasks ####################### #
 # ########################################################################### #
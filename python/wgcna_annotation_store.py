@@ -0,0 +1,76 @@
+'''
+wgcna_annotation_store.py
+=========================
+
+Load annotations into, or export them from, the local annotation store
+(see pipelines/pipeline_utils/annotation.py).
+
+To populate the store for a new species or Ensembl release run
+R/wgcna_fetch_geneset_annotations.R on a machine with internet access
+and then load its output directory, e.g.
+
+    python wgcna_annotation_store.py --action=load
+        --database=/shared/annotation.store.db
+        --species=hs --release=110 --annotationdir=annotation.dir
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import annotation
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--action", required=True,
+                        choices=["load", "export", "list"],
+                        help="load or export a release, or list the releases")
+    parser.add_argument("--database", required=True,
+                        help="The SQLite annotation store")
+    parser.add_argument("--species", required=True,
+                        help="species - mm or hs")
+    parser.add_argument("--release", default="latest",
+                        help="The Ensembl release (or latest, for export)")
+    parser.add_argument("--annotationdir", default=None,
+                        help=("The directory containing (load) or to which "
+                              "to write (export) the annotation files"))
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    store = annotation.AnnotationStore(opt.database)
+
+    if opt.action == "list":
+        print("\n".join(store.releases(opt.species)))
+
+    elif opt.action == "load":
+        if opt.release == "latest":
+            raise ValueError("A specific release number must be given")
+
+        store.load(opt.species, opt.release, opt.annotationdir)
+
+    else:
+        release = store.resolve(opt.species, opt.release)
+
+        if release is None:
+            raise ValueError("release %s for species %s is not in the store"
+                             % (opt.release, opt.species))
+
+        store.export(opt.species, release, opt.annotationdir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
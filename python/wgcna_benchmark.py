@@ -0,0 +1,438 @@
+'''
+wgcna_benchmark.py
+==================
+
+Benchmark the pipeline stages on synthetic data at several scales.
+
+For each scale (genes x samples) a seeded synthetic data set with
+planted modules, traits and genesets is generated (see
+pipeline_utils/synthetic.py) and each of the stages
+
+    cleanData, softPower, computeAdjacency, computeTOM, detectModules,
+    detectModulesBlockwise, characteriseModules, genesetAnalysis
+
+is run in isolation, with the same scripts as the pipeline, under
+python/wgcna_job_stats.py to record its wall time, CPU time and peak
+memory. The stages read the synthetic clean data, and the planted
+modules (characteriseModules, genesetAnalysis), rather than the
+outputs of the previous stages, except that computeTOM and
+detectModules are given the adjacency and TOM (made, untimed, if the
+stage that makes them is not benchmarked).
+
+The modules found by detectModules and detectModulesBlockwise are
+compared to the planted modules by the adjusted Rand index (over the
+genes planted in modules, the noise genes being free to join any
+module). The results are written to "<outdir>/benchmark.tsv" and, if a
+--baseline (the benchmark.tsv of an earlier run) is given, the stages
+that became slower, used more memory, failed or recovered the modules
+less well are flagged in "<outdir>/benchmark.comparison.tsv" (see
+pipeline_utils/benchmark.py). The exit status is 1 if any stage was
+flagged.
+
+The data sets are kept in the output directory and reused.
+
+Usage
+-----
+
+python wgcna_benchmark.py --scales=1000x50,5000x200 --outdir=bench.dir
+'''
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import benchmark
+from pipeline_utils import eigengenes
+from pipeline_utils import matrixio
+from pipeline_utils import synthetic
+
+
+STAGES = ["cleanData", "softPower", "computeAdjacency", "computeTOM",
+          "detectModules", "detectModulesBlockwise", "characteriseModules",
+          "genesetAnalysis"]
+
+# the stages whose outputs are needed by another stage, and the file
+REQUIRES = {"computeTOM": ("computeAdjacency", "adjacency.npy"),
+            "detectModules": ("computeTOM", "dissTOM.npy")}
+
+STATEMENTS = {
+
+    "cleanData": '''python %(python)s/wgcna_ingest_data.py
+                    --input=%(expression)s
+                    --idcol=gene_id
+                    --cachedir=%(stage_dir)s/cache.dir
+                    --outfile=%(stage_dir)s/clean.gsg.npy
+                    --threads=%(threads)s &&
+                    Rscript %(R)s/wgcna_data_cleaning.R
+                    --input=%(stage_dir)s/clean.gsg.npy
+                    --outdir=%(stage_dir)s
+                    --outfilename=clean.datExpr.npy
+                    --cutheight=%(cutheight)s
+                    --minsize=10
+                    --traitdata=%(traits)s''',
+
+    "softPower": '''python %(python)s/wgcna_soft_power.py
+                    --input=%(datExpr)s
+                    --outfile=%(stage_dir)s/soft.power.tsv
+                    --threads=%(threads)s
+                    --powers=1:20:0.5
+                    --networktype=%(networktype)s
+                    --adjcorfnc=pearson
+                    --tilesize=%(tilesize)s''',
+
+    "computeAdjacency": '''python %(python)s/wgcna_compute_adjacency.py
+                           --input=%(datExpr)s
+                           --outfile=%(stage_dir)s/adjacency.npy
+                           --threads=%(threads)s
+                           --softpower=%(softpower)s
+                           --networktype=%(networktype)s
+                           --adjcorfnc=pearson
+                           --tilesize=%(tilesize)s''',
+
+    "computeTOM": '''python %(python)s/wgcna_compute_TOM.py
+                     --input=%(computeAdjacency)s
+                     --outfile=%(stage_dir)s/dissTOM.npy
+                     --threads=%(threads)s
+                     --tomtype=%(tomtype)s
+                     --tilesize=%(tilesize)s''',
+
+    "detectModules": '''%(cut_tree)s
+                        Rscript %(R)s/wgcna_detect_modules.R
+                        --cleandata=%(datExpr)s
+                        --tomdata=%(computeTOM)s
+                        %(tree_option)s
+                        --mergeengine=%(mergeengine)s
+                        --outdir=%(stage_dir)s
+                        --outprefix=modules
+                        --threads=%(threads)s
+                        --softpower=%(softpower)s
+                        --minmodulesize=%(minmodulesize)s
+                        --medissthreshold=%(medissthreshold)s
+                        --adjcorfnc=pearson
+                        --deepsplit=%(deepsplit)s''',
+
+    "detectModulesBlockwise": '''Rscript %(R)s/wgcna_detect_modules_blockwise.R
+                                 --input=%(datExpr)s
+                                 --outdir=%(stage_dir)s
+                                 --outprefix=modules
+                                 --threads=%(threads)s
+                                 --maxblocksize=%(blocksize)s
+                                 --softpower=%(softpower)s
+                                 --networktype=%(networktype)s
+                                 --adjcorfnc=pearson
+                                 --adjdistfnc=dist
+                                 --tomtype=%(tomtype)s
+                                 --minmodulesize=%(minmodulesize)s
+                                 --medissthreshold=%(medissthreshold)s''',
+
+    "characteriseModules": '''python %(python)s/wgcna_module_membership.py
+                              --input=%(datExpr)s
+                              --modules=%(modules)s
+                              --annotation=%(annotation)s
+                              --idcol=ensembl_id
+                              --namecol=gene_name
+                              --outdir=%(stage_dir)s
+                              --outfilename=membership.tsv
+                              --threads=%(threads)s &&
+                              Rscript %(R)s/wgcna_modules_vs_traits.R
+                              --input=%(datExpr)s
+                              --modules=%(modules)s
+                              --traitdata=%(traits)s
+                              --outdir=%(stage_dir)s
+                              --threads=%(threads)s''',
+
+    "genesetAnalysis": '''python %(python)s/wgcna_modules_vs_genesets.py
+                          --input=%(truth)s
+                          --annotation=%(annotation)s
+                          --idcol=ensembl_id
+                          --gmt_names=synthetic
+                          --gmt_files=%(genesets)s
+                          --indexdir=%(stage_dir)s/index.dir
+                          --outdir=%(stage_dir)s
+                          --prefix=genesets'''}
+
+
+def make_data(n_genes, n_samples, seed, data_dir, threads):
+    '''Generate (or reuse) the synthetic data set and the planted module
+       files. Returns a dict of the paths.'''
+
+    data = synthetic.Synthetic(n_genes, n_samples, seed=seed)
+
+    paths = {x: os.path.join(data_dir, y) for x, y in [
+        ("expression", "expression.tsv"),
+        ("datExpr", "clean.datExpr.npy"),
+        ("traits", "traits.tsv"),
+        ("genesets", "genesets.gmt"),
+        ("annotation", "ensembl.to.entrez.tsv.gz"),
+        ("truth", "truth.tsv"),
+        ("modules", "truth")]}
+
+    sentinel = os.path.join(data_dir, "synthetic.sentinel")
+
+    if os.path.exists(sentinel):
+        print("Reusing the synthetic data in %s" % data_dir)
+        return paths, data
+
+    print("Generating %d genes x %d samples in %s"
+          % (n_genes, n_samples, data_dir))
+
+    data.write(data_dir)
+
+    # the planted modules, in the format written by module detection
+    datExpr, _, _ = matrixio.read(paths["datExpr"])
+
+    factors = eigengenes.module_factors(datExpr, data.colors,
+                                        threads=threads)
+    modules = sorted(factors)
+
+    matrixio.write(paths["modules"] + ".MEs.npy",
+                   eigengenes.eigengene_matrix(factors, modules),
+                   rownames=data.samples,
+                   colnames=["ME" + m for m in modules])
+    matrixio.write_labels(paths["modules"] + ".colors.npy", data.colors,
+                          names=data.genes)
+
+    open(sentinel, "w").close()
+
+    return paths, data
+
+
+def run_stage(stage, settings, stage_dir, job_stats):
+    '''Run a stage in a fresh directory. Returns the job statistics.'''
+
+    if os.path.exists(stage_dir):
+        shutil.rmtree(stage_dir)
+    os.makedirs(stage_dir)
+
+    statement = " ".join((STATEMENTS[stage]
+                          % dict(settings, stage_dir=stage_dir)).split())
+
+    stats_file = os.path.join(stage_dir, "stage.stats.json")
+
+    with open(os.path.join(stage_dir, "stage.log"), "w") as log:
+        subprocess.call([sys.executable, job_stats,
+                         "--stats=" + stats_file, "--",
+                         "bash", "-c", statement],
+                        stdout=log, stderr=subprocess.STDOUT)
+
+    if not os.path.exists(stats_file):
+        raise ValueError("no statistics were recorded for %s" % stage)
+
+    with open(stats_file) as fh:
+        return json.load(fh)
+
+
+def recovery(stage_dir, data):
+    '''The number of modules found and the adjusted Rand index of the
+       modules of the planted genes with the planted modules (or NaN if
+       no modules were written)'''
+
+    colors_file = os.path.join(stage_dir, "modules.colors.npy")
+    mods_file = os.path.join(stage_dir, "modules.dynamicMods.npy")
+
+    if os.path.exists(colors_file):
+        labels, genes = matrixio.read_labels(colors_file)
+        unassigned = synthetic.UNASSIGNED
+
+    elif os.path.exists(mods_file):
+        # the tree cut of the python tree engine, if R failed
+        labels, genes, _ = matrixio.read(mods_file, mmap=False)
+        labels = labels.ravel()
+        unassigned = 0
+
+    else:
+        return np.nan, np.nan
+
+    truth = pd.Series(data.colors, index=data.genes)
+
+    if genes is not None:
+        truth = truth[list(genes)]
+
+    n_modules = len(np.setdiff1d(labels, [unassigned]))
+
+    # the noise genes may be assigned to any module (e.g. by the PAM
+    # stage of the tree cut), so only the planted genes are compared
+    planted = truth.values != synthetic.UNASSIGNED
+
+    return n_modules, synthetic.adjusted_rand_index(truth.values[planted],
+                                                    labels[planted])
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--scales", default="1000x50,5000x200",
+                        help=("comma separated data set sizes, as "
+                              "<genes>x<samples> e.g. 1000x50,50000x5000"))
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help="comma separated stages to benchmark")
+    parser.add_argument("--outdir", required=True,
+                        help="directory for the data sets and results")
+    parser.add_argument("--baseline", default=None,
+                        help="the benchmark.tsv of a run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help=("the fraction by which the time or memory of "
+                              "a stage may grow before it is flagged"))
+    parser.add_argument("--minari", type=float, default=0.8,
+                        help=("the smallest adjusted Rand index of the "
+                              "detected and planted modules accepted"))
+    parser.add_argument("--seed", type=int, default=1,
+                        help="the seed of the synthetic data")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for parallel operations.")
+    parser.add_argument("--tilesize", type=int, default=2000,
+                        help="The number of genes (rows) in each tile")
+    parser.add_argument("--softpower", type=float, default=4,
+                        help="the soft power")
+    parser.add_argument("--networktype", default="signed_hybrid",
+                        help="the type of network")
+    parser.add_argument("--tomtype", default="unsigned",
+                        help="the TOM type")
+    parser.add_argument("--minmodulesize", type=int, default=30,
+                        help="minimum number of genes in a module")
+    parser.add_argument("--deepsplit", type=float, default=2,
+                        help="number from 0-4 for deep split parameter")
+    parser.add_argument("--medissthreshold", type=float, default=0.25,
+                        help="dissimilarity threshold for merging modules")
+    parser.add_argument("--blocksize", type=int, default=5000,
+                        help="the maximum block size for blockwise detection")
+    parser.add_argument("--treeengine", default="R",
+                        choices=["R", "python"],
+                        help="the tree engine used by detectModules")
+    parser.add_argument("--mergeengine", default="R",
+                        choices=["R", "python"],
+                        help="the merge engine used by detectModules")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    stages = opt.stages.split(",")
+
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError("unknown stage: %s" % stage)
+
+    wgcna_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir)
+    job_stats = os.path.join(wgcna_dir, "python", "wgcna_job_stats.py")
+
+    rows = []
+
+    for scale in opt.scales.split(","):
+
+        n_genes, n_samples = [int(x) for x in scale.split("x")]
+
+        scale_dir = os.path.abspath(
+            os.path.join(opt.outdir, "%s.seed%d" % (scale, opt.seed)))
+
+        paths, data = make_data(n_genes, n_samples, opt.seed,
+                                os.path.join(scale_dir, "data.dir"),
+                                opt.threads)
+
+        settings = dict(vars(opt), **paths)
+        settings.update(python=os.path.join(wgcna_dir, "python"),
+                        R=os.path.join(wgcna_dir, "R"),
+                        # so that no samples are removed as outliers
+                        cutheight=1e10,
+                        cut_tree="", tree_option="")
+
+        def _stage_dir(stage):
+            return os.path.join(scale_dir, stage + ".dir")
+
+        def _inputs(stage):
+            # make (untimed) the outputs of the stages that stage needs,
+            # unless they were made by a benchmarked stage
+            if stage not in REQUIRES:
+                return
+
+            required, outfile = REQUIRES[stage]
+            _inputs(required)
+
+            path = os.path.join(_stage_dir(required), outfile)
+
+            if not os.path.exists(path):
+                print("making the %s input of %s" % (required, stage))
+                run_stage(required, settings, _stage_dir(required),
+                          job_stats)
+
+            settings[required] = path
+
+        for stage in STAGES:
+            if stage not in stages:
+                continue
+
+            _inputs(stage)
+
+            if stage == "detectModules" and opt.treeengine == "python":
+                tree_prefix = os.path.join(_stage_dir(stage), "modules")
+
+                settings["cut_tree"] = (
+                    "python %s/wgcna_cut_tree.py --tomdata=%s "
+                    "--outprefix=%s --minmodulesize=%d --deepsplit=%s "
+                    "--tilesize=%d &&" % (settings["python"],
+                                          settings["computeTOM"],
+                                          tree_prefix, opt.minmodulesize,
+                                          opt.deepsplit, opt.tilesize))
+                settings["tree_option"] = "--tree=" + tree_prefix
+
+            print("benchmarking %s on %d genes x %d samples"
+                  % (stage, n_genes, n_samples))
+
+            stats = run_stage(stage, settings, _stage_dir(stage), job_stats)
+
+            n_modules, ari = np.nan, np.nan
+
+            if stage in ["detectModules", "detectModulesBlockwise"]:
+                n_modules, ari = recovery(_stage_dir(stage), data)
+
+            rows.append({"n_genes": n_genes,
+                         "n_samples": n_samples,
+                         "stage": stage,
+                         "status": stats["status"],
+                         "wall_time": stats["wall_time"],
+                         "cpu_time": stats["cpu_time"],
+                         "max_rss": stats["max_rss"],
+                         "n_modules": n_modules,
+                         "ari": ari})
+
+            print("%s: status %d, %.1fs, %.2fGB"
+                  % (stage, stats["status"], stats["wall_time"],
+                     stats["max_rss"] / 1e9))
+
+    results = pd.DataFrame(rows, columns=benchmark.COLUMNS)
+    results.to_csv(os.path.join(opt.outdir, "benchmark.tsv"), sep="\t",
+                   index=False)
+
+    baseline = None
+    if opt.baseline is not None:
+        baseline = pd.read_csv(opt.baseline, sep="\t")
+
+    table = benchmark.compare(results, baseline, tolerance=opt.tolerance,
+                              min_ari=opt.minari)
+    table.to_csv(os.path.join(opt.outdir, "benchmark.comparison.tsv"),
+                 sep="\t", index=False)
+
+    print(benchmark.report(table))
+
+    flagged = table[table["flags"] != ""]
+
+    if len(flagged) > 0:
+        print("%d stages were flagged" % len(flagged))
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+'''
+wgcna_compute_TOM.py
+====================
+
+Compute the TOM-based dissimilarity (dissTOM = 1 - TOM) from the
+memory-mapped adjacency matrix.
+
+The topological overlap is computed tile by tile (the A.A product plus
+the connectivity terms) and written directly into a memory-mapped .npy
+file so that only a few tiles are held in memory at any one time.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import network
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--input", required=True,
+                        help="the .npy file containing the adjacency matrix")
+    parser.add_argument("--outfile", required=True,
+                        help="The .npy file to which the dissTOM is written")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for parallel operations.")
+    parser.add_argument("--tomtype", default="unsigned",
+                        choices=network.TOM_TYPES,
+                        help="The TOM Type")
+    parser.add_argument("--tilesize", type=int, default=2000,
+                        help="The number of genes (rows) in each tile")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    adjMat, genes, _ = matrixio.read(opt.input)
+    n = adjMat.shape[0]
+
+    print("Computing the TOM for %d genes" % n)
+
+    dissTOM = matrixio.create(opt.outfile, (n, n),
+                              rownames=genes, colnames=genes)
+
+    network.compute_diss_tom(adjMat, dissTOM,
+                             tom_type=opt.tomtype,
+                             tile_size=opt.tilesize,
+                             threads=opt.threads)
+    dissTOM.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+'''
+wgcna_compute_adjacency.py
+==========================
+
+Compute the WGCNA adjacency matrix from the cleaned expression data.
+
+The correlation matrix is computed in row tiles with BLAS matrix
+products and each tile is transformed to adjacency and written
+directly into a memory-mapped .npy file so that the peak memory
+is bounded by the tile size.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import network
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--input", required=True,
+                        help="The clean expression data (.npy, samples x genes)")
+    parser.add_argument("--outfile", required=True,
+                        help="The .npy file to which the adjacency is written")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for parallel operations.")
+    parser.add_argument("--softpower", type=float, default=4,
+                        help="The soft thresholding power")
+    parser.add_argument("--networktype", required=True,
+                        choices=network.NETWORK_TYPES,
+                        help="the type of network")
+    parser.add_argument("--adjcorfnc", required=True,
+                        choices=network.COR_FNCS,
+                        help=("the function to be used to calculate "
+                              "co-expression similarity"))
+    parser.add_argument("--tilesize", type=int, default=2000,
+                        help="The number of genes (rows) in each tile")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    datExpr, _, genes = matrixio.read(opt.input)
+
+    z = network.standardise(datExpr, opt.adjcorfnc)
+    n = z.shape[0]
+
+    print("Computing the adjacency for %d genes" % n)
+
+    adjMat = matrixio.create(opt.outfile, (n, n),
+                             rownames=genes, colnames=genes)
+
+    network.compute_adjacency(z, adjMat,
+                              network_type=opt.networktype,
+                              power=opt.softpower,
+                              tile_size=opt.tilesize,
+                              threads=opt.threads)
+    adjMat.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+'''
+wgcna_compute_network.py
+========================
+
+Compute the TOM-based dissimilarity (dissTOM = 1 - TOM) directly from
+the cleaned expression data.
+
+This is the fused alternative to running wgcna_compute_adjacency.py and
+wgcna_compute_TOM.py in turn: correlation tiles are streamed through the
+soft-power transform and into the TOM products in a single process so
+that the adjacency matrix is never written to disk.
+
+For a consensus network (see pipeline_utils/consensus.py) "--genes"
+restricts the data of a set to the genes of the reference set, in the
+same order.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import network
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--input", required=True,
+                        help="The clean expression data (.npy, samples x genes)")
+    parser.add_argument("--outfile", required=True,
+                        help="The .npy file to which the dissTOM is written")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for parallel operations.")
+    parser.add_argument("--softpower", type=float, default=4,
+                        help="The soft thresholding power")
+    parser.add_argument("--networktype", required=True,
+                        choices=network.NETWORK_TYPES,
+                        help="the type of network")
+    parser.add_argument("--adjcorfnc", required=True,
+                        choices=network.COR_FNCS,
+                        help=("the function to be used to calculate "
+                              "co-expression similarity"))
+    parser.add_argument("--tomtype", default="unsigned",
+                        choices=network.TOM_TYPES,
+                        help="The TOM Type")
+    parser.add_argument("--tilesize", type=int, default=2000,
+                        help="The number of genes (rows) in each tile")
+    parser.add_argument("--genes", default=None,
+                        help=("A .npy matrix whose column names are the "
+                              "genes (and their order) to include"))
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    datExpr, _, genes = matrixio.read(opt.input)
+
+    if opt.genes is not None:
+        keep = matrixio.read(opt.genes)[2]
+        index = {x: i for i, x in enumerate(genes)}
+
+        missing = [x for x in keep if x not in index]
+        if missing:
+            raise ValueError("%d of the genes are not in the input, e.g. %s"
+                             % (len(missing), missing[0]))
+
+        datExpr = datExpr[:, [index[x] for x in keep]]
+        genes = keep
+
+    z = network.standardise(datExpr, opt.adjcorfnc)
+    n = z.shape[0]
+
+    print("Computing the TOM for %d genes" % n)
+
+    dissTOM = matrixio.create(opt.outfile, (n, n),
+                              rownames=genes, colnames=genes)
+
+    network.compute_diss_tom_fused(z, dissTOM,
+                                   network_type=opt.networktype,
+                                   power=opt.softpower,
+                                   tom_type=opt.tomtype,
+                                   tile_size=opt.tilesize,
+                                   threads=opt.threads)
+    dissTOM.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
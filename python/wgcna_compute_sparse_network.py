@@ -0,0 +1,88 @@
+'''
+wgcna_compute_sparse_network.py
+===============================
+
+Compute a sparse k-nearest-neighbour approximation of the TOM directly
+from the cleaned expression data.
+
+For each gene only the "--knn" strongest adjacencies are kept (an edge
+kept for either gene is kept for both). The topological overlap is then
+computed over this sparse graph, so memory is linear in the number of
+genes x knn rather than quadratic. The TOM is written as a sparse .npz
+matrix (see pipeline_utils/matrixio.py) for python/wgcna_cut_tree.py.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import network
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--input", required=True,
+                        help="The clean expression data (.npy, samples x genes)")
+    parser.add_argument("--outfile", required=True,
+                        help="The .npz file to which the sparse TOM is written")
+    parser.add_argument("--knn", type=int, default=50,
+                        help="The number of neighbours kept for each gene")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for parallel operations.")
+    parser.add_argument("--softpower", type=float, default=4,
+                        help="The soft thresholding power")
+    parser.add_argument("--networktype", required=True,
+                        choices=network.NETWORK_TYPES,
+                        help="the type of network")
+    parser.add_argument("--adjcorfnc", required=True,
+                        choices=network.COR_FNCS,
+                        help=("the function to be used to calculate "
+                              "co-expression similarity"))
+    parser.add_argument("--tomtype", default="unsigned",
+                        choices=network.TOM_TYPES,
+                        help="The TOM Type")
+    parser.add_argument("--tilesize", type=int, default=2000,
+                        help="The number of genes (rows) in each tile")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    datExpr, _, genes = matrixio.read(opt.input)
+
+    z = network.standardise(datExpr, opt.adjcorfnc)
+    n = z.shape[0]
+
+    print("Computing the %d nearest neighbour adjacency for %d genes"
+          % (opt.knn, n))
+
+    adj = network.knn_adjacency(z, opt.knn,
+                                network_type=opt.networktype,
+                                power=opt.softpower,
+                                tile_size=opt.tilesize,
+                                threads=opt.threads)
+
+    print("Computing the TOM over %d edges" % adj.nnz)
+
+    tom = network.sparse_tom(adj,
+                             tom_type=opt.tomtype,
+                             tile_size=opt.tilesize,
+                             threads=opt.threads)
+
+    matrixio.write_sparse(opt.outfile, tom, rownames=genes, colnames=genes)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+'''
+wgcna_consensus_genes.py
+========================
+
+Restrict the clean expression data of the reference set to the genes
+that are present in the clean data of all of the consensus data sets
+(see pipeline_utils/consensus.py). The genes keep their order.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import consensus
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--input", required=True,
+                        help=("The clean expression data of the reference "
+                              "set (.npy, samples x genes)"))
+    parser.add_argument("--sets", required=True,
+                        help=("Comma separated list of the clean expression "
+                              "data (.npy) of the other sets"))
+    parser.add_argument("--outfile", required=True,
+                        help="The .npy file for the restricted data")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    datExpr, samples, genes = matrixio.read(opt.input, mmap=False)
+
+    gene_lists = [genes] + [matrixio.read(x)[2]
+                            for x in opt.sets.split(",")]
+
+    keep = consensus.common_genes(gene_lists)
+
+    print("Keeping %d of %d genes (present in all %d sets)"
+          % (len(keep), len(genes), len(gene_lists)))
+
+    if len(keep) == 0:
+        raise ValueError("The data sets have no genes in common")
+
+    index = {x: i for i, x in enumerate(genes)}
+
+    matrixio.write(opt.outfile, datExpr[:, [index[x] for x in keep]],
+                   rownames=samples, colnames=keep)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+'''
+wgcna_consensus_network.py
+==========================
+
+Compute the consensus TOM-based dissimilarity of several data sets
+from the memory-mapped dissTOMs of the sets (see
+pipeline_utils/consensus.py). The TOMs are calibrated to that of the
+"--reference" set.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import consensus
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--inputs", required=True,
+                        help=("Comma separated list of the dissTOMs (.npy) "
+                              "of the sets"))
+    parser.add_argument("--reference", required=True,
+                        help=("The dissTOM (one of the inputs) of the set "
+                              "to which the TOMs are calibrated"))
+    parser.add_argument("--outfile", required=True,
+                        help="The .npy file to which the dissTOM is written")
+    parser.add_argument("--quantile", type=float, default=0,
+                        help=("The quantile of the set TOMs taken as the "
+                              "consensus (0: the minimum)"))
+    parser.add_argument("--calibration", default="single_quantile",
+                        choices=consensus.CALIBRATIONS,
+                        help="How the set TOMs are calibrated")
+    parser.add_argument("--calibrationquantile", type=float, default=0.95,
+                        help="The quantile matched by the calibration")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for parallel operations.")
+    parser.add_argument("--tilesize", type=int, default=2000,
+                        help="The number of genes (rows) in each tile")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    if not 0 <= opt.quantile <= 1:
+        raise ValueError("The quantile must be between 0 and 1")
+
+    inputs = opt.inputs.split(",")
+
+    if opt.reference not in inputs:
+        raise ValueError("The reference %s is not one of the inputs"
+                         % opt.reference)
+
+    diss_toms = []
+    for path in inputs:
+        diss_tom, genes, _ = matrixio.read(path)
+
+        if diss_toms and genes != reference_genes:
+            raise ValueError("The genes of %s do not match those of the "
+                             "reference set" % path)
+
+        reference_genes = genes
+        diss_toms.append(diss_tom)
+
+    n = diss_toms[0].shape[0]
+
+    print("Computing the consensus TOM of %d sets for %d genes"
+          % (len(diss_toms), n))
+
+    powers = None
+
+    if opt.calibration == "single_quantile":
+        powers, quantiles = consensus.calibration_powers(
+            diss_toms, quantile=opt.calibrationquantile,
+            reference=inputs.index(opt.reference))
+
+        for path, q, p in zip(inputs, quantiles, powers):
+            print("%s: TOM quantile %.4g, calibration power %.4g"
+                  % (path, q, p))
+
+    dissTOM = matrixio.create(opt.outfile, (n, n),
+                              rownames=reference_genes,
+                              colnames=reference_genes)
+
+    consensus.consensus_diss_tom(diss_toms, dissTOM,
+                                 quantile=opt.quantile,
+                                 powers=powers,
+                                 tile_size=opt.tilesize,
+                                 threads=opt.threads)
+    dissTOM.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
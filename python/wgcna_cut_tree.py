@@ -0,0 +1,111 @@
+'''
+wgcna_cut_tree.py
+=================
+
+Cluster the genes on the TOM-based dissimilarity and cut the tree with
+the dynamic hybrid method without loading the dissTOM into memory.
+
+The dissTOM is copied to a condensed float32 working file (removed on
+completion) on which the average linkage clustering is computed in
+place. The dynamic tree cut then reads only the rows of the
+memory-mapped dissTOM that it needs (see pipeline_utils/treecut.py).
+
+A sparse TOM (.npz, see python/wgcna_compute_sparse_network.py) is
+clustered directly on its edges, the TOM of genes that are not
+neighbours being taken to be 0.
+
+The following outputs are written for R/wgcna_detect_modules.R (--tree):
+
+    <outprefix>.geneTree.merge.npy: the hclust merge matrix
+    <outprefix>.geneTree.height.npy: the merge heights
+    <outprefix>.geneTree.order.npy: the leaf order
+    <outprefix>.dynamicMods.npy: the module numbers (0 = unassigned)
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import treecut
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--tomdata", required=True,
+                        help=("the .npy file containing the TOM-based "
+                              "dissimilarity (or a .npz sparse TOM)"))
+    parser.add_argument("--outprefix", required=True,
+                        help="prefix (including the directory) for the outfiles")
+    parser.add_argument("--minmodulesize", type=int, default=30,
+                        help="minimum number of genes in a module")
+    parser.add_argument("--deepsplit", type=float, default=2,
+                        help="number from 0-4 for deep split parameter")
+    parser.add_argument("--tilesize", type=int, default=2000,
+                        help="The number of rows of the dissTOM read at a time")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    if opt.tomdata.endswith(".npz"):
+
+        tom, genes, _ = matrixio.read_sparse(opt.tomdata)
+
+        print("Clustering %d genes (sparse TOM)" % tom.shape[0])
+
+        Z = treecut.sparse_average_linkage(tom)
+        dissTOM = treecut.SparseDissimilarity(tom)
+
+    else:
+
+        dissTOM, genes, _ = matrixio.read(opt.tomdata)
+        n = dissTOM.shape[0]
+
+        print("Clustering %d genes" % n)
+
+        working_file = opt.outprefix + ".condensed.tmp.npy"
+
+        condensed = treecut.condense(dissTOM, working_file,
+                                     tile_size=opt.tilesize)
+
+        Z = treecut.average_linkage(condensed, n)
+
+        del condensed
+        os.remove(working_file)
+
+    merge, height, order = treecut.to_hclust(Z)
+
+    matrixio.write(opt.outprefix + ".geneTree.merge.npy", merge)
+    matrixio.write(opt.outprefix + ".geneTree.height.npy", height)
+    matrixio.write(opt.outprefix + ".geneTree.order.npy", order)
+
+    print("Cutting the tree")
+
+    labels = treecut.cutree_hybrid(dissTOM, merge, height,
+                                   min_cluster_size=opt.minmodulesize,
+                                   deep_split=opt.deepsplit,
+                                   tile_size=opt.tilesize)
+
+    print("table of modules")
+    for label, count in zip(*np.unique(labels, return_counts=True)):
+        print("%d\t%d" % (label, count))
+
+    matrixio.write(opt.outprefix + ".dynamicMods.npy",
+                   labels.astype(np.int32), rownames=genes)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,51 @@
+'''
+wgcna_geneset_index.py
+======================
+
+Compile GMT files into binary geneset indexes.
+
+Each GMT file is compiled into a sparse (genesets x genes) incidence
+matrix with its gene and geneset maps and saved in the index directory
+under the checksum of the GMT file. Files that have already been
+compiled (e.g. by another run or project sharing the directory) are
+skipped.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import genesetindex
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--gmt_files", required=True,
+                        help="Comma separated list of gmt files")
+    parser.add_argument("--indexdir", required=True,
+                        help="The directory in which the indexes are stored")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    for gmt_file in opt.gmt_files.split(","):
+
+        path = genesetindex.build(gmt_file, opt.indexdir)
+
+        print("%s: %s" % (gmt_file, path))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+'''
+wgcna_ingest_data.py
+====================
+
+Read the expression data and remove the genes and samples with too
+many missing values (as WGCNA::goodSamplesGenes).
+
+The expression TSV is parsed in parallel into a memory-mappable matrix
+that is cached under the checksum of the file (see
+pipeline_utils/ingest.py), so that the text is only parsed once however
+often the cleaning parameters are changed. The filters are applied to
+the cached matrix and the good samples x genes matrix is written to
+"--outfile" for R/wgcna_data_cleaning.R.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import ingest
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--input", required=True,
+                        help=("the input data, genes in rows, samples in "
+                              "columns, with a column of gene identifiers"))
+    parser.add_argument("--idcol", default="gene_id",
+                        help="the column containing the gene identifiers")
+    parser.add_argument("--cachedir", required=True,
+                        help="the directory of the parsed expression matrices")
+    parser.add_argument("--outfile", required=True,
+                        help="the .npy file for the good samples x genes matrix")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="number of processes used to parse the input")
+    parser.add_argument("--minfraction", type=float, default=0.5,
+                        help='minimum fraction of non-missing samples for "good" genes')
+    parser.add_argument("--minnsamples", type=int, default=4,
+                        help=("The minimum number of non-missing samples for "
+                              "gene to be considered good."))
+    parser.add_argument("--minngenes", type=int, default=4,
+                        help="miminum number of good genes for dataset to be considered good.")
+    parser.add_argument("--minrelativeweight", type=float, default=0.1,
+                        help=("only used with observation weights, which are "
+                              "not supported (as goodSamplesGenes with "
+                              "weights = NULL)"))
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    x, genes, samples = ingest.load_expression(opt.input, opt.cachedir,
+                                               idcol=opt.idcol,
+                                               threads=opt.threads)
+
+    print("Dimensions of input data: %d genes x %d samples" % x.shape)
+
+    good_genes, good_samples = ingest.good_samples_genes(
+        x,
+        min_fraction=opt.minfraction,
+        min_n_samples=opt.minnsamples,
+        min_n_genes=opt.minngenes)
+
+    print("All genes have passed the cuts? %s"
+          % (good_genes.all() and good_samples.all()))
+
+    if not good_genes.all():
+        print("Removing genes: " + ", ".join(np.array(genes)[~good_genes]))
+
+    if not good_samples.all():
+        print("Removing samples: "
+              + ", ".join(np.array(samples)[~good_samples]))
+
+    clean = np.asarray(x[good_genes])[:, good_samples]
+
+    # samples x genes (Fortran ordered so that R reads it without a transpose)
+    matrixio.write(opt.outfile, np.ascontiguousarray(clean).T,
+                   rownames=np.array(samples)[good_samples],
+                   colnames=np.array(genes)[good_genes])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+'''
+wgcna_job_stats.py
+==================
+
+Run a command and record its wall time, CPU time and the largest
+process peak (the peak resident memory of the largest single process).
+
+The wall and CPU times cover the command and all of its child
+processes. The memory is getrusage's ru_maxrss of the children, which
+is the peak of the largest one of them, not the peak of the job: the
+memory of processes that run at the same time (e.g. the two sides of a
+pipe, or R and a python script it runs) is not added up, so it can
+under-report the memory used by the job.
+
+The statistics are written to the --stats JSON file, together with the
+timings of any steps that the command reported by appending
+"step<TAB>seconds" lines to the file named by the WGCNA_STEP_LOG
+environment variable (see R/wgcna_timing.R). The exit status of the command is returned.
+
+Usage
+-----
+
+python wgcna_job_stats.py --stats=job.json -- bash -c "..."
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import runstats
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--stats", required=True,
+                        help="the JSON file to which the statistics are written")
+    parser.add_argument("command", nargs=argparse.REMAINDER,
+                        help="the command to run (after --)")
+
+    opt = parser.parse_args(argv)
+
+    command = opt.command[1:] if opt.command[:1] == ["--"] else opt.command
+
+    if not command:
+        parser.error("no command given")
+
+    step_log = opt.stats + ".steps.tsv"
+
+    if os.path.exists(step_log):
+        os.remove(step_log)
+
+    env = dict(os.environ)
+    env[runstats.STEP_LOG] = os.path.abspath(step_log)
+
+    start = time.time()
+    status = subprocess.call(command, env=env)
+    wall_time = time.time() - start
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    stats = {"wall_time": wall_time,
+             "cpu_time": usage.ru_utime + usage.ru_stime,
+             # the largest process peak, kilobytes on linux
+             "max_rss": usage.ru_maxrss * 1024,
+             "status": status,
+             "steps": runstats.read_steps(step_log)}
+
+    with open(opt.stats, "w") as fh:
+        json.dump(stats, fh)
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+'''
+wgcna_merge_modules.py
+======================
+
+Compute the module eigengenes and merge the modules whose eigengenes
+are close (as WGCNA::moduleEigengenes and WGCNA::mergeCloseModules).
+
+Each module is reduced once to a small factor of its scaled expression
+(in parallel across the modules) from which its eigengene is computed.
+When modules are merged the factor of the merged module is computed
+from the factors of its parts, so that only the eigengenes of merged
+modules are recomputed (see pipeline_utils/eigengenes.py).
+
+The following outputs are read back by R/wgcna_detect_modules.R
+(--mergeengine=python):
+
+    <outprefix>.dynamicMEs.npy: the eigengenes of the dynamic modules
+    <outprefix>.mergedColors.npy: the module colors after merging
+    <outprefix>.mergedMEs.npy: the eigengenes of the merged modules
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import eigengenes
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--cleandata", required=True,
+                        help="The .npy file containing the clean expression data.")
+    parser.add_argument("--colors", required=True,
+                        help="The .npy labels file with the dynamic module colors.")
+    parser.add_argument("--outprefix", required=True,
+                        help="prefix (including the directory) for the outfiles")
+    parser.add_argument("--medissthreshold", type=float, default=0.25,
+                        help="dissimilarity threshold for merging modules")
+    parser.add_argument("--adjcorfnc", default="pearson",
+                        help=("the function used to compare the eigengenes: "
+                              "pearson, spearman or bicor"))
+    parser.add_argument("--rank", type=int, default=None,
+                        help=("the number of components kept for each module "
+                              "(default: all, exact)"))
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for parallel operations.")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    datExpr, samples, _ = matrixio.read(opt.cleandata)
+    colors, _ = matrixio.read_labels(opt.colors)
+
+    modules = np.unique(colors)
+
+    print("Computing the eigengenes of %d modules" % len(modules))
+
+    factors = eigengenes.module_factors(datExpr, colors, rank=opt.rank,
+                                        threads=opt.threads)
+
+    matrixio.write(opt.outprefix + ".dynamicMEs.npy",
+                   eigengenes.eigengene_matrix(factors, modules),
+                   rownames=samples, colnames=["ME" + m for m in modules])
+
+    print("Merging the modules")
+
+    merged_colors, merged = eigengenes.merge_close_modules(
+        factors, colors,
+        cut_height=opt.medissthreshold,
+        cor_fnc=opt.adjcorfnc,
+        rank=opt.rank)
+
+    merged_modules = sorted(merged)
+
+    print("%d modules after merging" % len(merged_modules))
+
+    matrixio.write_labels(opt.outprefix + ".mergedColors.npy", merged_colors)
+    matrixio.write(opt.outprefix + ".mergedMEs.npy",
+                   eigengenes.eigengene_matrix(merged, merged_modules),
+                   rownames=samples,
+                   colnames=["ME" + m for m in merged_modules])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
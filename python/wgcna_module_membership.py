@@ -0,0 +1,127 @@
+'''
+wgcna_module_membership.py
+==========================
+
+Compute the module membership (kME) of all the genes.
+
+The correlations of every gene with every module eigengene and their
+p-values (as WGCNA::corPvalueStudent) are computed in a single blocked
+pass (see pipeline_utils/membership.py). The following outputs are
+written to the output directory:
+
+    <outfilename>: the membership of each gene in its own module, with
+        the modules ordered by size and the genes by p-value
+    <prefix>.kME.npy: the (genes x modules) kME matrix
+    <prefix>.kME.pvalues.npy: the (genes x modules) p-values
+    eigengene.scaling.npy, eigengene.loadings.npy: the frozen module
+        definition used by python/wgcna_score_samples.py to score new
+        samples (see pipeline_utils/scoring.py)
+
+where <prefix> is the outfilename without its extension. The matrices
+are stored one module per contiguous column with the gene and module
+names in sidecar files (see pipeline_utils/matrixio.py) so that the
+membership of a module, or of a few genes, can be read without loading
+the whole matrix.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import eigengenes
+from pipeline_utils import matrixio
+from pipeline_utils import membership
+from pipeline_utils import scoring
+
+
+def gene_names(annotation, genes, idcol, namecol):
+    '''Look up the gene names, the first name given for an id is used'''
+
+    anno = pd.read_csv(annotation, sep="\t", usecols=[idcol, namecol],
+                       dtype=str)
+    anno = anno.drop_duplicates().drop_duplicates(idcol, keep="first")
+
+    return pd.Series(genes).map(anno.set_index(idcol)[namecol]).values
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--input", required=True,
+                        help="The .npy file containing the clean expression data.")
+    parser.add_argument("--modules", required=True,
+                        help=("the prefix of the <prefix>.MEs.npy and "
+                              "<prefix>.colors.npy module files."))
+    parser.add_argument("--annotation", required=True,
+                        help='A file containing the gene id and gene name columns')
+    parser.add_argument("--idcol", default="gene_id",
+                        help="the column containing the gene identifiers")
+    parser.add_argument("--namecol", default="gene_name",
+                        help="the column containing the gene names")
+    parser.add_argument("--outdir", required=True,
+                        help="where should the output files be saved")
+    parser.add_argument("--outfilename", default="membership.tsv",
+                        help="The name for the membership table")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for parallel operations.")
+    parser.add_argument("--tilesize", type=int, default=2000,
+                        help="The number of genes in each tile")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    if not os.path.exists(opt.outdir):
+        os.makedirs(opt.outdir)
+
+    datExpr, _, genes = matrixio.read(opt.input)
+    MEs, _, me_names = matrixio.read(opt.modules + ".MEs.npy", mmap=False)
+    colors, _ = matrixio.read_labels(opt.modules + ".colors.npy")
+
+    modules = [x[len("ME"):] if x.startswith("ME") else x for x in me_names]
+
+    print("Computing the membership of %d genes in %d modules"
+          % (len(genes), len(modules)))
+
+    kme = membership.kme(datExpr, MEs,
+                         tile_size=opt.tilesize, threads=opt.threads)
+
+    p_values = membership.cor_pvalue_student(kme, datExpr.shape[0])
+
+    table = membership.membership_table(
+        kme, p_values, genes, modules, colors,
+        gene_names=gene_names(opt.annotation, genes, opt.idcol, opt.namecol))
+
+    table.to_csv(os.path.join(opt.outdir, opt.outfilename), sep="\t",
+                 index=False, na_rep="NA")
+
+    prefix = os.path.join(opt.outdir, os.path.splitext(opt.outfilename)[0])
+
+    matrixio.write(prefix + ".kME.npy", np.asfortranarray(kme),
+                   rownames=genes, colnames=modules)
+    matrixio.write(prefix + ".kME.pvalues.npy", np.asfortranarray(p_values),
+                   rownames=genes, colnames=modules)
+
+    print("Freezing the module definition")
+
+    mean, sd, weights = eigengenes.loadings(datExpr, colors, modules,
+                                            threads=opt.threads)
+
+    scoring.save_model(os.path.join(opt.outdir, "eigengene"),
+                       mean, sd, weights, genes, modules)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
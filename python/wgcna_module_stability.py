@@ -0,0 +1,139 @@
+'''
+wgcna_module_stability.py
+=========================
+
+Assess the stability of the modules by detecting them again in
+bootstrap replicates of the samples (see pipeline_utils/stability.py).
+
+The replicates are run in a pool of "--workers" processes that each use
+"--threads" threads, and each writes a dissTOM of n_genes x n_genes x 8
+bytes to the output directory while it runs. The following files are
+written:
+
+    <outprefix>.replicates.npy: the module (0: unassigned) of each gene
+        in each replicate
+    <outprefix>.genes.tsv: the co-assignment of each gene
+    <outprefix>.modules.tsv (and .tex): the stability of each module
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import matrixio
+from pipeline_utils import network
+from pipeline_utils import stability
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--cleandata", required=True,
+                        help="The clean expression data (.npy, samples x genes)")
+    parser.add_argument("--colors", required=True,
+                        help="The .npy labels file with the module colors")
+    parser.add_argument("--outprefix", required=True,
+                        help="prefix (including the directory) for the outfiles")
+    parser.add_argument("--replicates", type=int, default=100,
+                        help="The number of bootstrap replicates")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="The seed for the bootstrap samples")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="The number of replicates run at once")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads used by each replicate.")
+    parser.add_argument("--softpower", type=float, default=4,
+                        help="The soft thresholding power")
+    parser.add_argument("--networktype", required=True,
+                        choices=network.NETWORK_TYPES,
+                        help="the type of network")
+    parser.add_argument("--adjcorfnc", required=True,
+                        choices=network.COR_FNCS,
+                        help=("the function to be used to calculate "
+                              "co-expression similarity"))
+    parser.add_argument("--tomtype", default="unsigned",
+                        choices=network.TOM_TYPES,
+                        help="The TOM Type")
+    parser.add_argument("--minmodulesize", type=int, default=30,
+                        help="minimum number of genes in a module")
+    parser.add_argument("--deepsplit", type=float, default=2,
+                        help="number from 0-4 for deep split parameter")
+    parser.add_argument("--medissthreshold", type=float, default=0.25,
+                        help="dissimilarity threshold for merging modules")
+    parser.add_argument("--tilesize", type=int, default=2000,
+                        help="The number of genes (rows) in each tile")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    _, samples, genes = matrixio.read(opt.cleandata)
+    colors, color_genes = matrixio.read_labels(opt.colors)
+
+    if color_genes is not None and list(color_genes) != list(genes):
+        raise ValueError("The genes of the colors do not match those of "
+                         "the clean data")
+
+    settings = {"soft_power": opt.softpower,
+                "network_type": opt.networktype,
+                "cor_fnc": opt.adjcorfnc,
+                "tom_type": opt.tomtype,
+                "min_size": opt.minmodulesize,
+                "deepsplit": opt.deepsplit,
+                "diss_threshold": opt.medissthreshold}
+
+    print("Detecting the modules of %d genes in %d bootstrap replicates "
+          "of %d samples" % (len(genes), opt.replicates, len(samples)))
+
+    out_dir = os.path.dirname(os.path.abspath(opt.outprefix))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    replicate_labels = np.zeros((len(genes), opt.replicates), dtype=np.int32)
+
+    start = time.time()
+
+    for replicate, labels in stability.bootstrap(
+            opt.cleandata, settings, opt.replicates,
+            work_dir=out_dir,
+            seed=opt.seed,
+            workers=opt.workers,
+            threads=opt.threads,
+            tile_size=opt.tilesize):
+
+        replicate_labels[:, replicate] = labels
+
+        print("replicate %d: %d modules (%.0f s)"
+              % (replicate + 1, labels.max(), time.time() - start))
+
+    matrixio.write(opt.outprefix + ".replicates.npy", replicate_labels,
+                   rownames=genes,
+                   colnames=["replicate.%d" % (x + 1)
+                             for x in range(opt.replicates)])
+
+    gene_table, module_table = stability.summarise(colors, genes,
+                                                   replicate_labels)
+
+    gene_table.to_csv(opt.outprefix + ".genes.tsv", sep="\t", index=False)
+    module_table.to_csv(opt.outprefix + ".modules.tsv", sep="\t",
+                        index=False)
+
+    stability.write_latex(module_table, opt.outprefix + ".modules.tex")
+
+    print("module stability complete")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+'''
+wgcna_modules_vs_genesets.py
+============================
+
+Test all of the modules for over-representation of genesets in a
+single process.
+
+The membership table, the annotation and the genesets are read once.
+The genesets are loaded from pre-compiled binary indexes (see
+pipeline_utils/genesetindex.py) when an index directory is given.
+The module and geneset memberships are held as sparse incidence
+matrices over the Entrez ids of the gene universe and all of the
+module x geneset tests are computed together.
+
+A "<prefix>.<module>.<geneset>.tsv.gz" table is written for every
+module and geneset collection, as expected by
+R/wgcna_summariseGenesets.R.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import csv
+import argparse
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import enrichment
+from pipeline_utils import genesetindex
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--input", required=True,
+                        help=("Table of module gene membership with "
+                              '"module" and "gene_id" columns'))
+    parser.add_argument("--annotation", required=True,
+                        help="Table mapping the gene ids to entrez_id")
+    parser.add_argument("--idcol", default="gene_id",
+                        help=("The column of the annotation containing "
+                              "the gene ids"))
+    parser.add_argument("--gmt_files", default="none",
+                        help="Comma separated list of gmt files")
+    parser.add_argument("--gmt_names", default="none",
+                        help="Comma separated list of names for the gmt files")
+    parser.add_argument("--indexdir", default=None,
+                        help=("Directory of compiled geneset indexes "
+                              "(built on demand)"))
+    parser.add_argument("--outdir", required=True,
+                        help="Where the result tables are written")
+    parser.add_argument("--prefix", default="genesets",
+                        help="Prefix for the output files")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    if opt.gmt_files == "none" or opt.gmt_names == "none":
+        raise ValueError("No gmt files were given")
+
+    gmt_files = opt.gmt_files.split(",")
+    gmt_names = opt.gmt_names.split(",")
+
+    if len(gmt_files) != len(gmt_names):
+        raise ValueError("The same number of gmt_names and gmt_files "
+                         "must be specified")
+
+    if not os.path.exists(opt.outdir):
+        os.makedirs(opt.outdir)
+
+    # ------------------- 1. the module gene lists ------------------- #
+
+    mm = pd.read_csv(opt.input, sep="\t", usecols=["module", "gene_id"])
+
+    if mm["gene_id"].nunique() < 100:
+        raise ValueError("Less than 100 genes in the gene universe!!")
+
+    anno = pd.read_csv(opt.annotation, sep="\t",
+                       usecols=[opt.idcol, "entrez_id"])
+    anno = anno.dropna()
+    anno["entrez_id"] = anno["entrez_id"].astype(int).astype(str)
+
+    mm = mm.merge(anno, left_on="gene_id", right_on=opt.idcol)
+    mm = mm[["module", "entrez_id"]].drop_duplicates()
+
+    universe = sorted(mm["entrez_id"].unique())
+    modules = sorted(mm["module"].unique())
+
+    print("no entrez_ids in universe: %d" % len(universe))
+
+    module_genes = mm.groupby("module")["entrez_id"].apply(list)
+
+    foreground = enrichment.incidence([module_genes[x] for x in modules],
+                                      universe)
+
+    # ---------------------- 2. the tests ---------------------------- #
+
+    for name, gmt_file in zip(gmt_names, gmt_files):
+
+        print("testing %s genesets" % name)
+
+        index = genesetindex.load(gmt_file, opt.indexdir)
+
+        results = enrichment.result_tables(foreground, modules,
+                                           index.incidence(universe),
+                                           index.ids,
+                                           index.descriptions,
+                                           universe)
+
+        for module, table in results:
+
+            outfile = os.path.join(opt.outdir,
+                                   ".".join([opt.prefix, module,
+                                             name, "tsv.gz"]))
+
+            table.to_csv(outfile, sep="\t", index=False,
+                         quoting=csv.QUOTE_NONE)
+
+    print("enrichment tests complete")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
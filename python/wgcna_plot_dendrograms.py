@@ -0,0 +1,97 @@
+'''
+wgcna_plot_dendrograms.py
+=========================
+
+Draw the gene dendrogram and the module colors as PNG images.
+
+The gene tree and the colors of the genes are written by
+R/wgcna_detect_modules.R (with --plotengine=python) and drawn here, in
+a separate job, so that the time taken to plot a large tree does not
+hold up the module detection. The tree is rasterised directly (see
+pipeline_utils/dendrogram.py) and only its "--maxmerges" highest
+merges are drawn, so the time and the size of the images are bounded
+whatever the number of genes. The following images are written to the
+output directory:
+
+    clustering_of_genes_by_topological_overlap.png: the gene tree
+    module_dendrogram.png: the tree and the dynamic tree cut modules
+    merged_module_dendrogram.png: the tree, the dynamic tree cut
+        (upper bar) and the merged modules (lower bar)
+
+The colour bars are not labelled in the images; the captions of the
+report say which bar is which.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import dendrogram
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--tree", required=True,
+                        help=("prefix of the <prefix>.geneTree.merge.npy, "
+                              ".height.npy and .order.npy files"))
+    parser.add_argument("--dynamiccolors", required=True,
+                        help=("the .npy labels file with the (#RRGGBB) "
+                              "colors of the dynamic tree cut modules"))
+    parser.add_argument("--mergedcolors", required=True,
+                        help=("the .npy labels file with the (#RRGGBB) "
+                              "colors of the merged modules"))
+    parser.add_argument("--outdir", required=True,
+                        help="where should the output files be saved")
+    parser.add_argument("--maxmerges", type=int, default=20000,
+                        help=("the number of (highest) merges drawn, lower "
+                              "branches are collapsed"))
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    merge, _, _ = matrixio.read(opt.tree + ".geneTree.merge.npy", mmap=False)
+    height, _, _ = matrixio.read(opt.tree + ".geneTree.height.npy",
+                                 mmap=False)
+    order, _, _ = matrixio.read(opt.tree + ".geneTree.order.npy", mmap=False)
+
+    height = height.ravel()
+    order = order.ravel()
+
+    dynamic_colors, _ = matrixio.read_labels(opt.dynamiccolors)
+    merged_colors, _ = matrixio.read_labels(opt.mergedcolors)
+
+    print("Drawing the dendrogram of %d genes" % len(order))
+
+    if not os.path.exists(opt.outdir):
+        os.makedirs(opt.outdir)
+
+    plots = [("clustering_of_genes_by_topological_overlap", [], 0.04),
+             ("module_dendrogram", [dynamic_colors], 0.03),
+             ("merged_module_dendrogram", [dynamic_colors, merged_colors],
+              0.03)]
+
+    for name, bars, hang in plots:
+
+        image = dendrogram.render(merge, height, order, bars=bars,
+                                  max_merges=opt.maxmerges, hang=hang)
+
+        dendrogram.write_png(os.path.join(opt.outdir, name + ".png"), image)
+
+    print("dendrograms complete")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+'''
+wgcna_score_samples.py
+======================
+
+Score new samples against an existing set of modules.
+
+The module definition frozen by the pipeline (the gene scaling and
+eigengene loadings written to "wgcna.dir/membership.dir/eigengene.*",
+see pipeline_utils/scoring.py) is used to project new expression data
+onto the module eigengenes without rerunning the pipeline. The samples
+are scored in chunks (--chunksize) so that matrices larger than memory
+can be scored.
+
+The input is either an expression TSV in the pipeline input format
+(genes in rows, samples in columns, with a gene identifier column),
+which is parsed into a memory-mapped matrix in --cachedir (see
+pipeline_utils/ingest.py), or such a parsed (genes x samples) .npy
+matrix.
+
+The scores are written as a table with a row per sample and a column
+per eigengene (as "eigengenes.tsv"). Genes of the modules that are not
+found in the new data are imputed by their mean.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import ingest
+from pipeline_utils import matrixio
+from pipeline_utils import scoring
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--model", default="wgcna.dir/membership.dir/eigengene",
+                        help=("the prefix of the <prefix>.scaling.npy and "
+                              "<prefix>.loadings.npy module definition"))
+    parser.add_argument("--input", required=True,
+                        help=("the new expression data, a TSV (genes in rows, "
+                              "samples in columns) or a (genes x samples) .npy"))
+    parser.add_argument("--idcol", default="gene_id",
+                        help="the column containing the gene identifiers")
+    parser.add_argument("--cachedir", default="wgcna.cache.dir/expression.dir",
+                        help="the directory of the parsed expression matrices")
+    parser.add_argument("--outfile", required=True,
+                        help="the table to which the scores are written")
+    parser.add_argument("--chunksize", type=int, default=1000,
+                        help="the number of samples scored at a time")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for parallel operations.")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    model = scoring.ModuleModel(opt.model)
+
+    if opt.input.endswith(".npy"):
+        x, genes, samples = matrixio.read(opt.input)
+    else:
+        x, genes, samples = ingest.load_expression(opt.input, opt.cachedir,
+                                                   idcol=opt.idcol,
+                                                   threads=opt.threads)
+
+    _, found = model.align(genes)
+
+    print("Scoring %d samples on %d eigengenes (%d of %d module genes found)"
+          % (len(samples), len(model.eigengenes), found.sum(), len(found)))
+
+    with open(opt.outfile, "w") as fh:
+
+        fh.write("\t".join(["sample_id"] + list(model.eigengenes)) + "\n")
+
+        for start, end, scores in scoring.score(model, x, genes,
+                                                chunk_size=opt.chunksize,
+                                                threads=opt.threads):
+
+            for sample, row in zip(samples[start:end], scores):
+                fh.write(sample + "\t"
+                         + "\t".join("%.10g" % v for v in row) + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
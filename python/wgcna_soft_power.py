@@ -0,0 +1,78 @@
+'''
+wgcna_soft_power.py
+===================
+
+Compute the scale-free topology fit and connectivity statistics for
+a grid of candidate soft-thresholding powers.
+
+The correlation matrix is computed once, in tiles, and the
+connectivity for every candidate power is accumulated in the same
+pass. The output table has the same columns as the "fitIndices"
+returned by WGCNA::pickSoftThreshold and is plotted by
+R/wgcna_soft_power.R.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import network
+from pipeline_utils import softpower
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--input", required=True,
+                        help="The clean expression data (.npy, samples x genes)")
+    parser.add_argument("--outfile", required=True,
+                        help="The tsv file to which the fit indices are written")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for parallel operations.")
+    parser.add_argument("--powers", default="1:10,12:20:2",
+                        help=("comma separated powers and from:to:by ranges "
+                              "e.g. 1:10,12:20:2"))
+    parser.add_argument("--networktype", required=True,
+                        choices=network.NETWORK_TYPES,
+                        help="the type of network")
+    parser.add_argument("--adjcorfnc", required=True,
+                        choices=network.COR_FNCS,
+                        help=("the function to be used to calculate "
+                              "co-expression similarity"))
+    parser.add_argument("--tilesize", type=int, default=2000,
+                        help="The number of genes (rows) in each tile")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    powers = softpower.parse_powers(opt.powers)
+    print("Evaluating powers: " + ", ".join("%g" % x for x in powers))
+
+    datExpr, _, _ = matrixio.read(opt.input)
+    z = network.standardise(datExpr, opt.adjcorfnc)
+
+    k = softpower.connectivity_sweep(z, powers,
+                                     network_type=opt.networktype,
+                                     tile_size=opt.tilesize,
+                                     threads=opt.threads)
+
+    fit = softpower.fit_indices(k, powers)
+    print(fit.to_string(index=False))
+
+    fit.to_csv(opt.outfile, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
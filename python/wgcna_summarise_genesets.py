@@ -0,0 +1,265 @@
+'''
+wgcna_summarise_genesets.py
+===========================
+
+Summarise the geneset over-representation results of all the modules.
+
+For each geneset collection the per-module result tables are read and
+concatenated once. Filtering, multiple testing correction and the
+counting of the number of modules in which each geneset is significant
+are then applied to the combined table.
+
+The following outputs are written:
+
+    <outprefix>.xlsx: one worksheet of significant genesets per collection
+    <outprefix>.table.tex: the top 5 genesets of each module (longtable)
+    <outprefix>.<collection>.results.tsv.gz: all the results with the
+        adjusted p-values of the significant genesets (for plotting by
+        R/wgcna_summariseGenesets.R)
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import re
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import enrichment
+
+
+def read_results(genesetdir, prefix, modules, geneset):
+    '''Read and concatenate the results for all modules'''
+
+    tables = []
+    for module in modules:
+
+        fn = os.path.join(genesetdir,
+                          ".".join([prefix, module, geneset, "tsv.gz"]))
+
+        if not os.path.exists(fn):
+            print("Skipping %s (file not found)" % fn)
+            continue
+
+        table = pd.read_csv(fn, sep="\t", quoting=3)
+        table.insert(0, "module", module)
+        tables.append(table)
+
+    if len(tables) == 0:
+        return None
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def signif(table):
+    '''Round the numeric columns to 3 significant figures (values
+       >= 1000 are rounded to integers)'''
+
+    table = table.copy()
+
+    for col in table.select_dtypes(include=[np.number]).columns:
+
+        x = table[col].values.astype(float)
+        finite = np.isfinite(x) & (x != 0)
+
+        small = finite & (np.abs(x) < 1000)
+        digits = 2 - np.floor(np.log10(np.abs(x[small]))).astype(int)
+        x[small] = [round(v, d) for v, d in zip(x[small], digits)]
+        x[finite & (np.abs(x) >= 1000)] = np.round(x[finite & (np.abs(x) >= 1000)])
+
+        table[col] = x
+
+    return table
+
+
+def format_descriptions(descriptions, prefixes=("REACTOME_", "BIOCARTA_"),
+                        maxl=45):
+    '''Trim the collection prefixes and truncate long descriptions'''
+
+    pattern = "^(" + "|".join(prefixes) + ")"
+
+    x = descriptions.astype(str).str.replace(pattern, "", regex=True)
+    x = x.str.replace("_", " ", regex=False)
+
+    return x.where(x.str.len() <= maxl, x.str.slice(0, maxl - 3) + "...")
+
+
+def latex_escape(x):
+    '''Escape the latex special characters'''
+
+    return re.sub(r"([&%$#_{}~^\\])", r"\\\1", str(x))
+
+
+def write_latex_table(top, outfile):
+    '''Write the top genesets per module as a latex longtable'''
+
+    caption = ("The top (lowest p-value) genesets found (uniquely) "
+               "in each module")
+
+    columns = ["module", "type", "description", "p.val", "p.adj",
+               "n_fg", "odds.ratio", "n.modules"]
+
+    with open(outfile, "w") as tex:
+
+        tex.write("{\\fontsize{6pt}{9pt}\\selectfont\n")
+
+        if top is None or len(top) == 0:
+            tex.write("\\begin{longtable}{l}\n\\caption{%s}\\\\\n\\hline\n"
+                      "x \\\\\n\\hline\n"
+                      "no significantly enriched genesets found \\\\\n"
+                      "\\hline\n\\end{longtable}\n}\n" % caption)
+            return
+
+        tex.write("\\begin{longtable}{lllrrrrr}\n")
+        tex.write("\\caption{%s}\\\\\n\\hline\n" % caption)
+        tex.write(" & ".join(latex_escape(x) for x in columns)
+                  + " \\\\\n\\hline\n")
+
+        for _, rows in top.groupby("module", sort=False):
+            for row in rows.itertuples(index=False):
+                values = [row.module, row.type, row.description,
+                          "%.2g" % row.p_val, "%.2g" % row.p_adj,
+                          "%d" % row.n_fg, "%.2f" % row.odds_ratio,
+                          "%d" % row.n_modules]
+                tex.write(" & ".join(latex_escape(x) for x in values)
+                          + " \\\\\n")
+            tex.write("\\hline\n")
+
+        tex.write("\\end{longtable}\n}\n")
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--genesetdir", required=True,
+                        help="directory containing the genesets to aggregate")
+    parser.add_argument("--modulelist", required=True,
+                        help="comma separated list of modules")
+    parser.add_argument("--gmt_names", default="none",
+                        help="comma separated list of names for the gmt files")
+    parser.add_argument("--pvaluethreshold", type=float, default=0.05,
+                        help="p value threshold for filtering sets")
+    parser.add_argument("--padjustmethod", default="BH",
+                        help="The multiple testing correction (as p.adjust)")
+    parser.add_argument("--useadjusted", default="TRUE",
+                        help="should adjusted p-values be used for filtering")
+    parser.add_argument("--mingenes", type=int, default=2,
+                        help="min no. genes in foreground set")
+    parser.add_argument("--maxgenes", type=int, default=500,
+                        help="the maximum number of genes allowed per geneset")
+    parser.add_argument("--minoddsratio", type=float, default=1.5,
+                        help="The minimum odds ratio.")
+    parser.add_argument("--prefix", default="genesets",
+                        help="expected prefix for source files")
+    parser.add_argument("--outprefix", required=True,
+                        help="prefix for outfiles")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    genesets = ["GO.BP", "GO.MF", "GO.CC", "KEGG"]
+    if opt.gmt_names != "none":
+        genesets += opt.gmt_names.split(",")
+
+    modules = opt.modulelist.split(",")
+
+    use_adjusted = opt.useadjusted.upper() == "TRUE"
+
+    sheets = {}
+    tops = []
+
+    for geneset in genesets:
+
+        print("Processing: %s annotations." % geneset)
+
+        results = read_results(opt.genesetdir, opt.prefix, modules, geneset)
+
+        if results is None:
+            continue
+
+        results = enrichment.filter_genesets(
+            results,
+            min_foreground_genes=opt.mingenes,
+            max_genes_geneset=opt.maxgenes,
+            min_odds_ratio=opt.minoddsratio,
+            padjust_method=opt.padjustmethod,
+            use_adjusted_pvalues=use_adjusted,
+            pvalue_threshold=opt.pvaluethreshold)
+
+        results.to_csv(".".join([opt.outprefix, geneset, "results.tsv.gz"]),
+                       sep="\t", index=False, quoting=3)
+
+        sig = results[results["p.adj"].notna()].copy()
+
+        if len(sig) == 0:
+            continue
+
+        sig["n_modules_sig"] = sig.groupby("geneset_id")["module"] \
+                                  .transform("size")
+
+        sig = sig.sort_values(["module", "p.val"], kind="stable")
+
+        firstcols = ["module", "geneset_id", "description", "p.adj",
+                     "p.val", "odds.ratio", "n_fg", "n_bg"]
+        firstcols = [x for x in firstcols if x in sig.columns]
+        sig = sig[firstcols + [x for x in sig.columns
+                               if x not in firstcols]]
+
+        sheets[geneset] = signif(sig)
+
+        # the top 5 genesets per module
+        top = sig.groupby("module", sort=False).head(5).copy()
+
+        if "description" not in top.columns:
+            top["description"] = top["geneset_id"]
+
+        top["description"] = format_descriptions(top["description"])
+        top["type"] = geneset
+        tops.append(top)
+
+    # -------------------- the excel workbook ------------------------ #
+
+    with pd.ExcelWriter(opt.outprefix + ".xlsx",
+                        engine="openpyxl") as workbook:
+
+        if len(sheets) == 0:
+            pd.DataFrame({"x": ["no significantly enriched genesets found"]}) \
+              .to_excel(workbook, sheet_name="none", index=False)
+
+        for geneset, table in sheets.items():
+            table.to_excel(workbook, sheet_name=geneset[:31], index=False)
+            worksheet = workbook.sheets[geneset[:31]]
+            worksheet.auto_filter.ref = worksheet.dimensions
+
+    # ----------------------- the latex table ------------------------ #
+
+    top = None
+    if len(tops) > 0:
+        top = pd.concat(tops, ignore_index=True)
+
+        # group the rows by module (in order of first appearance)
+        module_order = {m: i for i, m in
+                        enumerate(pd.unique(top["module"]))}
+        top = top.iloc[np.argsort(top["module"].map(module_order).values,
+                                  kind="stable")]
+
+        top = top.rename(columns={"p.val": "p_val", "p.adj": "p_adj",
+                                  "odds.ratio": "odds_ratio",
+                                  "n_modules_sig": "n_modules"})
+
+    write_latex_table(top, opt.outprefix + ".table.tex")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+'''
+wgcna_update_adjacency.py
+=========================
+
+Compute the WGCNA adjacency matrix from incrementally updated
+correlation statistics.
+
+The sufficient statistics of the Pearson correlation (the gene sums and
+the cross-product matrix) are kept in a state directory. When samples
+are added to (or removed from) the cleaned data only these samples are
+folded into the statistics with a rank-k update of the cross-product
+(see pipeline_utils/incremental.py). The adjacency is then computed
+from the statistics in row tiles and written to a memory-mapped .npy
+file, as by python/wgcna_compute_adjacency.py.
+
+Usage
+-----
+
+See options.
+'''
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "pipelines"))
+
+from pipeline_utils import incremental
+from pipeline_utils import network
+from pipeline_utils import matrixio
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("--input", required=True,
+                        help="The clean expression data (.npy, samples x genes)")
+    parser.add_argument("--outfile", required=True,
+                        help="The .npy file to which the adjacency is written")
+    parser.add_argument("--statedir", required=True,
+                        help="The directory in which the statistics are kept")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for parallel operations.")
+    parser.add_argument("--softpower", type=float, default=4,
+                        help="The soft thresholding power")
+    parser.add_argument("--networktype", required=True,
+                        choices=network.NETWORK_TYPES,
+                        help="the type of network")
+    parser.add_argument("--adjcorfnc", required=True,
+                        choices=["pearson"],
+                        help=("the function to be used to calculate "
+                              "co-expression similarity (only pearson "
+                              "can be updated incrementally)"))
+    parser.add_argument("--tilesize", type=int, default=2000,
+                        help="The number of genes (rows) in each tile")
+
+    opt = parser.parse_args(argv)
+
+    print("Running with options:")
+    print(vars(opt))
+
+    datExpr, samples, genes = matrixio.read(opt.input)
+
+    stats = incremental.CorrelationStats(opt.statedir)
+
+    stats.update(datExpr, samples, genes,
+                 tile_size=opt.tilesize, threads=opt.threads)
+
+    n = len(genes)
+
+    print("Computing the adjacency for %d genes" % n)
+
+    adjMat = matrixio.create(opt.outfile, (n, n),
+                             rownames=genes, colnames=genes)
+
+    stats.compute_adjacency(adjMat,
+                            network_type=opt.networktype,
+                            power=opt.softpower,
+                            tile_size=opt.tilesize,
+                            threads=opt.threads)
+    adjMat.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
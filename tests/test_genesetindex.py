@@ -0,0 +1,26 @@
+import numpy as np
+
+from pipeline_utils import genesetindex
+
+
+def test_incidence(tmp_path):
+
+    gmt = tmp_path / "sets.gmt"
+    gmt.write_text("S1\tfirst\tA\tB\nS2\tsecond\tB\n")
+
+    index = genesetindex.compile_gmt(str(gmt))
+
+    np.testing.assert_array_equal(
+        index.incidence(["A", "C", "B"]).toarray(), [[1, 0, 1], [0, 0, 1]])
+
+
+def test_incidence_empty_gmt(tmp_path):
+
+    gmt = tmp_path / "empty.gmt"
+    gmt.write_text("")
+
+    index = genesetindex.compile_gmt(str(gmt))
+    incidence = index.incidence(["A", "B"])
+
+    assert incidence.shape == (0, 2)
+    assert incidence.nnz == 0
@@ -0,0 +1,57 @@
+import gzip
+
+import numpy as np
+
+from pipeline_utils import ingest
+from pipeline_utils import resources
+
+
+TSV = ("gene_id\ts1\ts2\ts3\n"
+       "g1\t1.5\t2\t3\n"
+       "g2\t4\tNA\t6\n"
+       "g1\t7\t8\t9\n")
+
+
+def _write(path, compress):
+
+    if compress:
+        with gzip.open(path, "wt") as fh:
+            fh.write(TSV)
+    else:
+        with open(path, "w") as fh:
+            fh.write(TSV)
+
+
+def test_load_expression_gzipped(tmp_path):
+
+    plain = str(tmp_path / "data.tsv")
+    gzipped = str(tmp_path / "data.tsv.gz")
+
+    _write(plain, False)
+    _write(gzipped, True)
+
+    x, genes, samples = ingest.load_expression(
+        gzipped, str(tmp_path / "cache.dir"), threads=1)
+    y, _, _ = ingest.load_expression(
+        plain, str(tmp_path / "cache.dir"), threads=1)
+
+    assert genes == ["g1", "g2", "g1.1"]
+    assert samples == ["s1", "s2", "s3"]
+    np.testing.assert_array_equal(np.asarray(x), np.asarray(y))
+    assert np.isnan(x[1, 1])
+
+    # the decompressed copy is removed
+    assert not [p for p in (tmp_path / "cache.dir").iterdir()
+                if p.name.endswith(".tsv")]
+
+
+def test_dimensions_gzipped(tmp_path):
+
+    plain = str(tmp_path / "data.tsv")
+    gzipped = str(tmp_path / "data.tsv.gz")
+
+    _write(plain, False)
+    _write(gzipped, True)
+
+    assert resources.dimensions(plain) == (3, 3)
+    assert resources.dimensions(gzipped) == (3, 3)
@@ -0,0 +1,56 @@
+import numpy as np
+
+from pipeline_utils import stability
+
+
+REFERENCE = np.array(["a", "a", "a", "a", "b", "b", "grey"])
+GENES = ["g%d" % i for i in range(len(REFERENCE))]
+
+# module a is split in two and module b is kept
+SPLIT = np.array([1, 1, 2, 2, 3, 3, 0])
+UNASSIGNED = np.zeros(len(REFERENCE), dtype=int)
+
+
+def test_compare_split_module():
+
+    co_assignment, jaccard = stability.compare(REFERENCE, SPLIT)
+
+    np.testing.assert_allclose(co_assignment[:6], [1 / 3] * 4 + [1, 1])
+    assert np.isnan(co_assignment[6])
+    np.testing.assert_allclose(jaccard, [0.5, 1])
+
+
+def test_compare_all_unassigned():
+
+    co_assignment, jaccard = stability.compare(REFERENCE, UNASSIGNED)
+
+    np.testing.assert_array_equal(co_assignment[:6], 0)
+    assert np.isnan(co_assignment[6])
+    np.testing.assert_array_equal(jaccard, [0, 0])
+
+
+def test_summarise():
+
+    gene_table, module_table = stability.summarise(
+        REFERENCE, GENES, np.column_stack([SPLIT, UNASSIGNED]))
+
+    np.testing.assert_allclose(gene_table["co_assignment"][:6],
+                               [1 / 6] * 4 + [0.5, 0.5])
+    np.testing.assert_allclose(gene_table["assigned"],
+                               [0.5] * 6 + [0])
+
+    assert list(module_table["module"]) == ["b", "a"]
+    assert list(module_table["n_genes"]) == [2, 4]
+    np.testing.assert_allclose(module_table["stability"], [0.5, 0.25])
+
+    # too few replicates for the 5% quantile
+    assert module_table["stability_q05"].isna().all()
+
+
+def test_summarise_quantile():
+
+    replicates = np.column_stack([SPLIT] * stability.MIN_QUANTILE_REPLICATES)
+
+    _, module_table = stability.summarise(REFERENCE, GENES, replicates)
+
+    np.testing.assert_allclose(module_table["stability_q05"], [1, 0.5])